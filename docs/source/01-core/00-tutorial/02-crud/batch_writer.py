@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+
+"""
+按照数据库的参数个数上限分批写入.
+
+一次写入大量的行有三种方法:
+
+- ``executemany``: ``conn.execute(t.insert(), rows)``, 一条单行的 INSERT 加上多组参数, 由
+    DBAPI 的 ``cursor.executemany`` 执行. pysqlite 的 executemany 在 C 中循环, 很快.
+    psycopg2 等驱动上 SQLAlchemy 2.0 会自动改写成多行 VALUES ("insertmanyvalues").
+- ``values``: 一条语句中有多行 VALUES, ``INSERT INTO t (a, b) VALUES (?, ?), (?, ?), ...``.
+    每一行的每一列都是一个参数, 所以每条语句的行数受数据库的参数个数上限限制. SQLite 3.32
+    以前是 999, 之后是 32766, PostgreSQL 是 32767, SQL Server 是 2100. SQL Server 另外限制
+    一条 INSERT 最多 1000 行 VALUES.
+- ``insertmanyvalues``: 需要 RETURNING 拿到自增主键时, SQLAlchemy 2.0 把
+    ``conn.execute(t.insert().returning(t.c.id), rows)`` 改写成多行 VALUES ... RETURNING,
+    每批默认 1000 行 (``insertmanyvalues_page_size``).
+
+:class:`BatchWriter`:
+
+- :func:`max_parameters` 根据方言给出参数个数的上限. SQLite 的上限是编译时的选项, 还可以用
+    ``setlimit`` 调低, 所以优先用 ``sqlite3.Connection.getlimit`` (Python 3.11+) 读出实际的值,
+    没有时才按版本猜. 每批的行数是 ``max_parameters // 列数``, 再受 :func:`max_rows` 限制.
+- 多行 VALUES 的 INSERT 不能使用 SQLAlchemy 的编译缓存, 每次执行都要重新编译几万个参数,
+    比 executemany 还慢很多. 所以 ``values`` 自己缓存编译好的 SQL, 用
+    ``exec_driver_sql`` 直接交给 DBAPI 执行, 类型的 bind processor 也由自己调用.
+    不满一批的剩余部分用 executemany.
+- :meth:`BatchWriter.tune` 在一个回滚的事务中用样本数据分别测量 ``executemany`` 和
+    ``values``, 记住每种数据库上最快的方法.
+- ``returning=True`` 时使用 insertmanyvalues, 并把每批的行数设为参数上限允许的最大值,
+    返回的主键和输入的顺序一致. 数据库不支持 executemany RETURNING 时逐行插入.
+
+10 万行, 6 列, SQLite 内存数据库. 这里的 libsqlite3 (Debian 的 3.40.1) 编译时把上限设成了
+250000, 而不是默认的 32766, ``getlimit`` 读到的就是这个值::
+
+    row by row: 2.912 sec
+    executemany: 0.687 sec
+    values (41666 rows per statement): 0.359 sec
+    tuned strategy for sqlite: values
+    tuned: 0.326 sec
+    returning, page size 1000: 1.555 sec
+    returning, page size 41666: 1.495 sec
+
+- tune 的样本至少要有一批的行数 (这里是 41666 行), 否则 ``values`` 全部落到 executemany 上,
+    比较没有意义, 所以样本不够时 :meth:`BatchWriter.tune` 直接报错. 用一整批的样本时选了
+    ``values``, 比 executemany 快一倍左右.
+- RETURNING 的耗时主要在构造结果的 Row 上, 加大每批的行数没有明显的收益, 在参数上限更低的
+    数据库 (SQL Server) 上它保证了每批不会超过上限.
+"""
+
+import typing as T
+import time
+import random
+import sqlite3
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, mssql
+
+
+def max_parameters(dialect: sa.Dialect, dbapi_connection=None) -> int:
+    """
+    一条语句中最多可以有多少个参数.
+
+    :param dbapi_connection: SQLite 上给了 DBAPI 连接时读出这个连接实际的上限.
+    """
+    if dialect.name == "sqlite":
+        if hasattr(dbapi_connection, "getlimit") and hasattr(sqlite3, "SQLITE_LIMIT_VARIABLE_NUMBER"):
+            return dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        # SQLITE_MAX_VARIABLE_NUMBER 在 3.32.0 从 999 提高到 32766
+        dbapi = dialect.dbapi or sqlite3
+        if getattr(dbapi, "sqlite_version_info", (0,)) >= (3, 32, 0):
+            return 32766
+        return 999
+    if dialect.name == "postgresql":
+        return 32767
+    if dialect.name == "mssql":
+        return 2099
+    if dialect.name in ("mysql", "mariadb"):
+        return 65535
+    return dialect.insertmanyvalues_max_parameters
+
+
+def max_rows(dialect: sa.Dialect) -> T.Optional[int]:
+    """
+    一条多行 VALUES 的 INSERT 最多可以有多少行, None 表示只受参数个数限制.
+    """
+    if dialect.name == "mssql":
+        # The number of row value expressions in the INSERT statement exceeds
+        # the maximum allowed number of 1000 row values.
+        return 1000
+    return None
+
+
+class BatchWriter:
+    """
+    ``table`` 的批量写入. 同一批的所有行必须有相同的 key.
+
+    :param strategy: ``"executemany"`` 或 ``"values"``, None 表示用 :meth:`tune` 的结果,
+        没有 tune 过时用 ``"executemany"``.
+    """
+
+    strategies = ("executemany", "values")
+
+    def __init__(self, table: sa.Table, strategy: T.Optional[str] = None):
+        if strategy is not None and strategy not in self.strategies:
+            raise ValueError(f"unknown strategy {strategy!r}")
+        self.table = table
+        self.strategy = strategy
+        self.tuned: T.Dict[str, str] = dict()
+        self._values_sql_cache: T.Dict[T.Tuple[str, T.Tuple[str, ...], int], str] = dict()
+
+    def rows_per_statement(self, dialect: sa.Dialect, n_column: int, dbapi_connection=None) -> int:
+        """
+        每条多行 VALUES 的语句 (以及 insertmanyvalues 的每一批) 最多可以有多少行.
+        """
+        n_row = max(1, max_parameters(dialect, dbapi_connection) // max(1, n_column))
+        limit = max_rows(dialect)
+        return n_row if limit is None else min(n_row, limit)
+
+    def _values_sql(self, dialect: sa.Dialect, keys: T.Tuple[str, ...], n_row: int) -> str:
+        """
+        ``n_row`` 行的 VALUES 语句. 多行 VALUES 的 INSERT 没有 SQLAlchemy 的编译缓存,
+        几千行的语句编译一次要将近一秒, 所以在这里按 (数据库, 列, 行数) 缓存编译好的 SQL.
+        """
+        key = (dialect.name, keys, n_row)
+        if key in self._values_sql_cache:
+            return self._values_sql_cache[key]
+        if dialect.paramstyle in ("qmark", "format"):
+            # 位置参数, 把单行的 VALUES 重复 n_row 次即可, 不需要编译整条语句
+            stmt = sa.insert(self.table).values({name: sa.bindparam(name) for name in keys})
+            head, row = str(stmt.compile(dialect=dialect)).split(" VALUES ", 1)
+            sql = head + " VALUES " + ", ".join([row] * n_row)
+        else:
+            stmt = sa.insert(self.table).values([
+                {name: sa.bindparam(f"{name}__{i}") for name in keys}
+                for i in range(n_row)
+            ])
+            sql = str(stmt.compile(dialect=dialect))
+        self._values_sql_cache[key] = sql
+        return sql
+
+    def _can_use_values(self, keys: T.Tuple[str, ...]) -> bool:
+        # 直接交给 DBAPI 执行, 不会生成 Python 端的默认值
+        return all(
+            column.default is None
+            for column in self.table.columns
+            if column.name not in keys
+        )
+
+    def _insert_values(self, conn: sa.Connection, rows: T.List[dict]):
+        keys = tuple(rows[0])
+        if not self._can_use_values(keys):
+            return self._insert_executemany(conn, rows)
+        dialect = conn.dialect
+        size = self.rows_per_statement(dialect, len(keys), conn.connection.dbapi_connection)
+        # 类型的 bind processor 要自己调用
+        processors = [
+            self.table.c[name].type.dialect_impl(dialect).bind_processor(dialect)
+            for name in keys
+        ]
+        positional = dialect.paramstyle in ("qmark", "format")
+        n_full = len(rows) - len(rows) % size
+        for start in range(0, n_full, size):
+            chunk = rows[start:start + size]
+            values = [
+                processor(row[name]) if processor else row[name]
+                for row in chunk
+                for name, processor in zip(keys, processors)
+            ]
+            if positional:
+                params = tuple(values)
+            else:
+                names = [f"{name}__{i}" for i in range(len(chunk)) for name in keys]
+                params = dict(zip(names, values))
+            conn.exec_driver_sql(self._values_sql(dialect, keys, size), params)
+        # 不满一批的剩余部分用 executemany, 避免为每一种行数编译一条语句
+        if n_full < len(rows):
+            self._insert_executemany(conn, rows[n_full:])
+
+    def _insert_executemany(self, conn: sa.Connection, rows: T.List[dict]):
+        conn.execute(sa.insert(self.table), rows)
+
+    def _insert(self, conn: sa.Connection, rows: T.List[dict], strategy: str):
+        if strategy == "values":
+            self._insert_values(conn, rows)
+        else:
+            self._insert_executemany(conn, rows)
+
+    def _returning(self, conn: sa.Connection, rows: T.List[dict]) -> T.List[sa.Row]:
+        pk = list(self.table.primary_key.columns)
+        if not conn.dialect.insert_executemany_returning:
+            return [
+                conn.execute(sa.insert(self.table).returning(*pk), row).one()
+                if conn.dialect.insert_returning
+                else conn.execute(sa.insert(self.table), row).inserted_primary_key
+                for row in rows
+            ]
+        stmt = sa.insert(self.table).returning(*pk, sort_by_parameter_order=True)
+        page_size = self.rows_per_statement(
+            conn.dialect, len(rows[0]), conn.connection.dbapi_connection,
+        )
+        return conn.execute(
+            stmt, rows, execution_options=dict(insertmanyvalues_page_size=page_size)
+        ).all()
+
+    def insert(
+        self,
+        conn: sa.Connection,
+        rows: T.List[dict],
+        returning: bool = False,
+    ) -> T.Optional[T.List[sa.Row]]:
+        """
+        写入 ``rows``. ``returning=True`` 时返回每一行的主键, 顺序和 ``rows`` 一致.
+        """
+        if not rows:
+            return [] if returning else None
+        if returning:
+            return self._returning(conn, rows)
+        strategy = self.strategy or self.tuned.get(conn.dialect.name, "executemany")
+        self._insert(conn, rows, strategy)
+        return None
+
+    def tune(self, engine: sa.Engine, sample: T.List[dict], n_round: int = 3) -> T.Dict[str, float]:
+        """
+        用 ``sample`` 测量每种方法的耗时 (取 ``n_round`` 次中最快的一次), 写入的数据会被回滚.
+
+        ``sample`` 至少要有一条多行 VALUES 语句的行数 (:meth:`rows_per_statement`), 否则
+        ``values`` 全部落到 executemany 上, 测出来的只是噪音.
+        """
+        elapsed = dict()
+        with engine.connect() as conn:
+            size = self.rows_per_statement(
+                conn.dialect, len(sample[0]) if sample else 0, conn.connection.dbapi_connection,
+            )
+            if len(sample) < size:
+                raise ValueError(
+                    f"sample has {len(sample)} rows, "
+                    f"at least {size} rows are needed to fill one statement"
+                )
+            for strategy in self.strategies:
+                for _ in range(n_round):
+                    trans = conn.begin()
+                    st = time.perf_counter()
+                    self._insert(conn, sample, strategy)
+                    cost = time.perf_counter() - st
+                    trans.rollback()
+                    elapsed[strategy] = min(elapsed.get(strategy, cost), cost)
+        self.tuned[engine.dialect.name] = min(elapsed, key=elapsed.get)
+        return elapsed
+
+
+metadata = sa.MetaData()
+
+t_order = sa.Table(
+    "orders", metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("user_id", sa.Integer),
+    sa.Column("item", sa.String),
+    sa.Column("quantity", sa.Integer),
+    sa.Column("price", sa.Float),
+    sa.Column("note", sa.String),
+)
+
+engine = sa.create_engine("sqlite:///:memory:")
+metadata.create_all(engine)
+
+# 参数个数的上限
+assert max_parameters(postgresql.dialect()) == 32767
+assert max_parameters(mssql.dialect()) == 2099
+assert max_parameters(engine.dialect) == (32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999)
+# SQL Server 1 列时受 1000 行的限制, 6 列时受 2099 个参数的限制
+assert BatchWriter(t_order).rows_per_statement(mssql.dialect(), 1) == 1000
+assert BatchWriter(t_order).rows_per_statement(mssql.dialect(), 6) == 349
+
+# SQLite 上优先读连接实际的上限, 被 setlimit 调低之后也不会超过
+if hasattr(sqlite3, "SQLITE_LIMIT_VARIABLE_NUMBER"):
+    with engine.connect() as conn:
+        dbapi_connection = conn.connection.dbapi_connection
+        limit = dbapi_connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        assert max_parameters(conn.dialect, dbapi_connection) == limit
+        dbapi_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 600)
+        try:
+            assert BatchWriter(t_order).rows_per_statement(conn.dialect, 6, dbapi_connection) == 100
+            with conn.begin():
+                BatchWriter(t_order, strategy="values").insert(
+                    conn, [dict(id=i, user_id=i) for i in range(1, 1001)]
+                )
+                assert conn.execute(sa.select(sa.func.count()).select_from(t_order)).scalar() == 1000
+                conn.execute(t_order.delete())
+        finally:
+            dbapi_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+
+# --- Benchmark
+N_ROW = 100_000
+
+random.seed(1)
+
+
+def make_rows(with_id: bool) -> T.List[dict]:
+    rows = list()
+    for i in range(1, 1 + N_ROW):
+        row = dict(
+            user_id=random.randint(1, 1000),
+            item=f"item {random.randint(1, 100)}",
+            quantity=random.randint(1, 10),
+            price=random.random() * 100,
+            note="",
+        )
+        if with_id:
+            row = dict(id=i, **row)
+        rows.append(row)
+    return rows
+
+
+rows = make_rows(with_id=True)
+writer = BatchWriter(t_order)
+
+
+def count() -> int:
+    with engine.connect() as conn:
+        return conn.execute(sa.select(sa.func.count()).select_from(t_order)).scalar()
+
+
+def timeit(name: str, func: T.Callable[[sa.Connection], T.Any]):
+    with engine.begin() as conn:
+        conn.execute(t_order.delete())
+    with engine.begin() as conn:
+        st = time.perf_counter()
+        result = func(conn)
+        print(f"{name}: {time.perf_counter() - st:.3f} sec")
+    assert count() == N_ROW
+    return result
+
+
+def row_by_row(conn: sa.Connection):
+    stmt = sa.insert(t_order)
+    for row in rows:
+        conn.execute(stmt, row)
+
+
+timeit("row by row", row_by_row)
+timeit("executemany", lambda conn: writer._insert(conn, rows, "executemany"))
+with engine.connect() as conn:
+    size = writer.rows_per_statement(
+        conn.dialect, len(t_order.columns), conn.connection.dbapi_connection,
+    )
+timeit(f"values ({size} rows per statement)", lambda conn: writer._insert(conn, rows, "values"))
+
+with engine.begin() as conn:
+    conn.execute(t_order.delete())
+writer.tune(engine, rows[:size])
+print(f"tuned strategy for sqlite: {writer.tuned['sqlite']}")
+assert count() == 0
+timeit("tuned", lambda conn: writer.insert(conn, rows))
+
+# RETURNING 自增主键, 和 SQLAlchemy 默认的每批 1000 行比较
+rows_no_id = make_rows(with_id=False)
+
+
+def returning_default(conn: sa.Connection):
+    stmt = sa.insert(t_order).returning(t_order.c.id, sort_by_parameter_order=True)
+    return conn.execute(stmt, rows_no_id).all()
+
+
+ids_default = timeit("returning, page size 1000", returning_default)
+ids = timeit(f"returning, page size {size}", lambda conn: writer.insert(conn, rows_no_id, returning=True))
+assert len(ids) == N_ROW
+# 主键和输入的顺序一致
+assert [row.id for row in ids] == sorted(row.id for row in ids)
@@ -5,6 +5,8 @@
 - Read / Select
 - Update
 - Delete
+
+大量写入请参考 ``batch_writer.py``.
 """
 
 import sqlalchemy as sa
@@ -23,10 +25,12 @@ metadata.create_all(engine)
 #--- create
 
 # insert one
-engine.execute(t_user.insert(), {"id": 1, "name": "Alice"})
+with engine.begin() as conn:
+    conn.execute(t_user.insert(), {"id": 1, "name": "Alice"})
 
-# insert many
-engine.execute(t_user.insert(), [{"id": 2, "name": "Bob"}, {"id": 3, "name": "Cathy"}])
+# insert many, 传入一个 list 时使用 executemany
+with engine.begin() as conn:
+    conn.execute(t_user.insert(), [{"id": 2, "name": "Bob"}, {"id": 3, "name": "Cathy"}])
 
 # handle primary key conflict method 1
 connection = engine.connect()
@@ -37,46 +41,51 @@ try:
     trans.commit()
 except exc.IntegrityError:
     trans.rollback()
+connection.close()
 
 # handle primary key conflict method 2
 try:
-    engine.execute(t_user.insert(), {"id": 3, "name": "Cathy"})
+    with engine.begin() as conn:
+        conn.execute(t_user.insert(), {"id": 3, "name": "Cathy"})
 except exc.IntegrityError:
     pass
 
 #---read
 
-# fetch one record
-print(engine.execute(sa.select([t_user]).where(t_user.c.id==1)).fetchone())# (1, 'Alice')
+with engine.connect() as conn:
+    # fetch one record
+    print(conn.execute(sa.select(t_user).where(t_user.c.id==1)).fetchone()) # (1, 'Alice')
 
-# fetch many records
-print(engine.execute(sa.select([t_user])).fetchall()) # [(1, 'Alice'), (2, 'Bob'), (3, 'Cathy')]
+    # fetch many records
+    print(conn.execute(sa.select(t_user)).fetchall()) # [(1, 'Alice'), (2, 'Bob'), (3, 'Cathy')]
 
-# fetch only part of records
-cursor = engine.execute(sa.select([t_user]))
-print(cursor.fetchmany(2)) # [(1, 'Alice'), (2, 'Bob')]
-print(cursor.fetchmany(2)) # [(3, 'Cathy')]
+    # fetch only part of records
+    cursor = conn.execute(sa.select(t_user))
+    print(cursor.fetchmany(2)) # [(1, 'Alice'), (2, 'Bob')]
+    print(cursor.fetchmany(2)) # [(3, 'Cathy')]
 
-# convert sqlalchemy.engine.result.RowProxy' to tuple, list, dict
-for row in engine.execute(sa.select([t_user])):
-    print(type(row), tuple(row), list(row), dict(row))
+    # convert sqlalchemy.engine.Row to tuple, list, dict
+    for row in conn.execute(sa.select(t_user)):
+        print(type(row), tuple(row), list(row), dict(row._mapping))
 
 #--- update
 
-# update one
-engine.execute(t_user.update().where(t_user.c.id==1).values(name="Ana"))
-assert engine.execute(sa.select([t_user]).where(t_user.c.id==1)).fetchone()["name"] == "Ana"
+with engine.begin() as conn:
+    # update one
+    conn.execute(t_user.update().where(t_user.c.id==1).values(name="Ana"))
+    assert conn.execute(sa.select(t_user).where(t_user.c.id==1)).fetchone().name == "Ana"
 
-# update many
-engine.execute(t_user.update().values(name="Ana"))
-assert engine.execute(sa.select([t_user]).where(t_user.c.id==3)).fetchone()["name"] == "Ana"
+    # update many
+    conn.execute(t_user.update().values(name="Ana"))
+    assert conn.execute(sa.select(t_user).where(t_user.c.id==3)).fetchone().name == "Ana"
 
 #--- delete
 
-# delete one
-engine.execute(t_user.delete().where(t_user.c.id==1))
-assert engine.execute(sa.select([t_user]).count()).fetchone()[0] == 2
+with engine.begin() as conn:
+    # delete one
+    conn.execute(t_user.delete().where(t_user.c.id==1))
+    assert conn.execute(sa.select(sa.func.count()).select_from(t_user)).scalar() == 2
 
-# delete many
-engine.execute(t_user.delete())
-assert engine.execute(sa.select([t_user]).count()).fetchone()[0] == 0
+    # delete many
+    conn.execute(t_user.delete())
+    assert conn.execute(sa.select(sa.func.count()).select_from(t_user)).scalar() == 0
@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+
+"""
+``e2_index.py`` 是手动 ``EXPLAIN`` 一条 SQL, 发现没用到索引, 再手动建索引. 本例把这个过程
+自动化, :class:`IndexAdvisor` 分三步:
+
+1. :meth:`IndexAdvisor.record`: 在实际的 workload 运行期间, 用 ``before_cursor_execute`` /
+    ``after_cursor_execute`` 事件记录每一种 SQL (编译之后的 SQL 字符串相同就是同一种),
+    执行次数, 总耗时, 第一次执行时的参数, 以及编译之前的 SQL 表达式.
+2. :meth:`IndexAdvisor.analyze`: 用记录下来的参数对每一种 SQL 执行 ``EXPLAIN QUERY PLAN``
+    (SQLite) 或者 ``EXPLAIN`` (PostgreSQL), 找出全表扫描 (``SCAN event``) 和为排序 / 分组
+    建立的临时 B-tree (``USE TEMP B-TREE FOR ORDER BY``). 然后从 SQL 表达式中找到这张表在
+    WHERE / JOIN 中的等值条件, 范围条件, 以及 ORDER BY / GROUP BY 的列, 按照
+    "等值列在前, 然后是一个范围列或者排序列" 的规则生成单列或者复合索引. 已经被现有索引
+    (按最左前缀) 覆盖的, 以及是另一个候选索引前缀的候选会被去掉.
+3. :meth:`IndexAdvisor.evaluate`: 可选. 在一个副本 (:func:`sqlite_scratch_copy` 用 SQLite
+    的 backup API 复制一份内存数据库) 上逐个创建候选索引, 重放相关的 SQL, 测量加速比,
+    然后删掉索引, 不影响正在使用的数据库.
+
+最后 :meth:`IndexAdvisor.apply` 把推荐的索引加到 ``MetaData`` 中对应的 ``Table`` 上, 可以
+同时在数据库中创建.
+
+注意:
+
+- 只有通过 SQLAlchemy 表达式 (Core 或者 ORM) 执行的 SQL 才能推导出列, ``text()`` 只会
+    报告问题, 不会给出候选索引.
+- 索引会让写入变慢, 加速比只衡量了读. ``min_speedup`` 默认是 2 倍.
+- PostgreSQL 上需要自己准备 ``scratch_engine``, 例如用
+    ``CREATE DATABASE scratch TEMPLATE app`` 复制出来的数据库.
+
+20 万行的 event 表, 四种查询的 workload 的结果如下. 按 user_id 查最新的 10 条在没有
+索引时要扫描全表再排序, 有了 (user_id, time) 之后是一次覆盖索引的查找::
+
+    before: 0.168 sec
+    ix_event_user_id_time ('user_id', 'time'): 214.9x, SCAN event, USE TEMP B-TREE FOR ORDER BY
+    ix_event_type_time ('type', 'time'): 74.2x, SCAN event
+    ix_event_time ('time',): 8.0x, SCAN event
+    after: 0.004 sec
+
+一周的时间范围查询只返回 0.7% 的行, 索引的加速比在 5 ~ 12 倍之间波动. 范围越大加速比越小,
+一个月 (3%) 时只有 2 倍左右, 会在 ``min_speedup`` 附近时有时无.
+"""
+
+import typing as T
+import re
+import time
+import contextlib
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+import sqlalchemy.event as event
+from sqlalchemy.sql import visitors, operators, elements
+from learn_sqlalchemy.db import engine_sqlite as engine
+
+
+class QueryShape:
+    """
+    一种 SQL. ``statement`` 是发送给数据库的 SQL 字符串, ``clause`` 是编译之前的表达式.
+    """
+
+    def __init__(self, statement: str, parameters, clause: T.Optional[sa.ClauseElement]):
+        self.statement = statement
+        self.parameters = parameters
+        self.clause = clause
+        self.n_execute = 0
+        self.elapsed = 0.0
+        self.plan: T.List[str] = list()
+        self.issues: T.List[str] = list()
+
+    def __repr__(self):
+        return f"QueryShape({self.statement!r}, n_execute={self.n_execute})"
+
+
+class IndexCandidate:
+    """
+    一个候选索引. ``reasons`` 是查询计划中的问题, ``speedup`` 是 :meth:`IndexAdvisor.evaluate`
+    测量的加速比, 没有测量过时是 None.
+    """
+
+    def __init__(self, table: sa.Table, columns: T.Tuple[str, ...]):
+        self.table = table
+        self.columns = columns
+        self.queries: T.List[QueryShape] = list()
+        self.reasons: T.List[str] = list()
+        self.speedup: T.Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return "ix_{}_{}".format(self.table.name, "_".join(self.columns))
+
+    def to_index(self, table: T.Optional[sa.Table] = None) -> sa.Index:
+        """
+        创建 ``sa.Index``, 它会被加到 ``table`` (默认是 ``self.table``) 上.
+        """
+        if table is None:
+            table = self.table
+        return sa.Index(self.name, *[table.c[column] for column in self.columns])
+
+    def __repr__(self):
+        return f"IndexCandidate({self.name!r}, columns={self.columns}, speedup={self.speedup})"
+
+
+_EQUALITY_OPERATORS = {operators.eq, operators.in_op, operators.is_}
+_RANGE_OPERATORS = {
+    operators.lt, operators.le, operators.gt, operators.ge,
+    operators.between_op, operators.like_op, operators.startswith_op,
+}
+
+_FULL_SCAN = dict(
+    sqlite=re.compile(r"^SCAN (?:TABLE )?(\w+)$"),
+    postgresql=re.compile(r"Seq Scan on (\w+)(?: (\w+))?"),
+)
+_TEMP_SORT = dict(
+    sqlite=re.compile(r"USE TEMP B-TREE FOR (?:RIGHT PART OF )?(ORDER BY|GROUP BY|DISTINCT)"),
+    # 子节点的行是缩进的 "  ->  Sort ...", 只有最顶层的节点在行首
+    postgresql=re.compile(r"->\s+(Sort|HashAggregate)\b|^(Sort|HashAggregate)\b"),
+)
+_EXPLAIN = dict(
+    sqlite="EXPLAIN QUERY PLAN ",
+    postgresql="EXPLAIN ",
+)
+
+
+def _base_column(column: sa.Column) -> T.Optional[T.Tuple[str, sa.Table, str]]:
+    """
+    返回 (FROM 中的名字, 原始的表, 列名). 别名中的列会对应回原始的表.
+    """
+    table = column.table
+    name = getattr(table, "name", None)
+    while isinstance(table, sa.Alias):
+        table = table.element
+    if not isinstance(table, sa.Table):
+        return None
+    return name, table, column.name
+
+
+def _unique(values: T.Iterable) -> list:
+    return list(dict.fromkeys(values))
+
+
+class _TableUsage:
+    """
+    一条 SQL 中某个 FROM 元素 (表或者别名) 上被用到的列.
+    """
+
+    def __init__(self, table: sa.Table):
+        self.table = table
+        self.equality: T.List[str] = list()
+        self.range: T.List[str] = list()
+        self.order_by: T.List[str] = list()
+        self.group_by: T.List[str] = list()
+
+    def candidate_columns(self, sort_issue: bool) -> T.Tuple[str, ...]:
+        columns = _unique(self.equality)
+        if self.range:
+            columns += [c for c in self.range[:1] if c not in columns]
+        elif sort_issue:
+            sort_columns = self.order_by or self.group_by
+            columns += [c for c in sort_columns if c not in columns]
+        return tuple(columns)
+
+
+def _usages(clause: sa.ClauseElement) -> T.Dict[str, _TableUsage]:
+    usages: T.Dict[str, _TableUsage] = dict()
+
+    def usage(column) -> T.Optional[T.Tuple[_TableUsage, str]]:
+        if not isinstance(column, sa.Column):
+            return None
+        base = _base_column(column)
+        if base is None:
+            return None
+        name, table, column_name = base
+        if name not in usages:
+            usages[name] = _TableUsage(table)
+        return usages[name], column_name
+
+    criteria = list()
+    if isinstance(clause, (sa.Select, sa.Update, sa.Delete)) and clause.whereclause is not None:
+        criteria.append(clause.whereclause)
+    for element in visitors.iterate(clause):
+        if isinstance(element, sa.Join):
+            criteria.append(element.onclause)
+
+    for criterion in criteria:
+        for element in visitors.iterate(criterion):
+            if not isinstance(element, elements.BinaryExpression):
+                continue
+            if element.operator in _EQUALITY_OPERATORS:
+                kind = "equality"
+            elif element.operator in _RANGE_OPERATORS:
+                kind = "range"
+            else:
+                continue
+            # 两边都是列时是 JOIN 条件, 对两张表都是等值查找
+            for side in (element.left, element.right):
+                found = usage(side)
+                if found is not None:
+                    table_usage, column_name = found
+                    getattr(table_usage, kind).append(column_name)
+
+    if isinstance(clause, sa.Select):
+        for attr_name, clauses in [
+            ("order_by", clause._order_by_clauses),
+            ("group_by", clause._group_by_clauses),
+        ]:
+            for element in clauses:
+                if isinstance(element, elements.UnaryExpression):
+                    element = element.element
+                found = usage(element)
+                if found is not None:
+                    table_usage, column_name = found
+                    getattr(table_usage, attr_name).append(column_name)
+    return usages
+
+
+def _covered(table: sa.Table, columns: T.Tuple[str, ...]) -> bool:
+    """
+    是否已经有索引 (包括主键和 unique 约束) 以 ``columns`` 作为最左前缀.
+    """
+    existing = [tuple(c.name for c in table.primary_key.columns)]
+    existing += [tuple(c.name for c in index.columns) for index in table.indexes]
+    existing += [
+        tuple(c.name for c in constraint.columns)
+        for constraint in table.constraints
+        if isinstance(constraint, sa.UniqueConstraint)
+    ]
+    return any(index[:len(columns)] == columns for index in existing)
+
+
+class IndexAdvisor:
+    """
+    :param engine: 运行 workload 的 engine.
+    :param metadata: 推荐的索引会加到这个 ``MetaData`` 的表上.
+    """
+
+    def __init__(self, engine: sa.Engine, metadata: sa.MetaData):
+        self.engine = engine
+        self.metadata = metadata
+        self.queries: T.Dict[str, QueryShape] = dict()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("index_advisor_start", list()).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["index_advisor_start"].pop()
+        if executemany or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            return
+        shape = self.queries.get(statement)
+        if shape is None:
+            clause = None
+            if context is not None and context.compiled is not None:
+                clause = context.compiled.statement
+            shape = QueryShape(statement, parameters, clause)
+            self.queries[statement] = shape
+        shape.n_execute += 1
+        shape.elapsed += elapsed
+
+    @contextlib.contextmanager
+    def record(self):
+        """
+        在这个 context manager 中执行的 SQL 都会被记录下来.
+        """
+        event.listen(self.engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        try:
+            yield self
+        finally:
+            event.remove(self.engine, "before_cursor_execute", self._before_cursor_execute)
+            event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @staticmethod
+    def explain(conn: sa.Connection, shape: QueryShape) -> T.List[str]:
+        prefix = _EXPLAIN[conn.dialect.name]
+        rows = conn.exec_driver_sql(prefix + shape.statement, shape.parameters).all()
+        return [row[-1] for row in rows]
+
+    def analyze(self) -> T.List[IndexCandidate]:
+        """
+        返回候选索引, 按照相关 SQL 的总耗时从大到小排序.
+        """
+        dialect = self.engine.dialect.name
+        full_scan, temp_sort = _FULL_SCAN[dialect], _TEMP_SORT[dialect]
+        candidates: T.Dict[T.Tuple[str, T.Tuple[str, ...]], IndexCandidate] = dict()
+        with self.engine.connect() as conn:
+            for shape in self.queries.values():
+                shape.plan = self.explain(conn, shape)
+                # 可以多次调用 analyze, 每次重新分析
+                shape.issues = list()
+                scanned = set()
+                sort_issue = False
+                for line in shape.plan:
+                    match = full_scan.search(line)
+                    if match:
+                        scanned.update(name for name in match.groups() if name)
+                        shape.issues.append(line.strip())
+                    elif temp_sort.search(line):
+                        sort_issue = True
+                        shape.issues.append(line.strip())
+                if not shape.issues or shape.clause is None:
+                    continue
+
+                for name, usage in _usages(shape.clause).items():
+                    if name not in scanned and not sort_issue:
+                        continue
+                    columns = usage.candidate_columns(sort_issue)
+                    if not columns or _covered(usage.table, columns):
+                        continue
+                    key = (usage.table.name, columns)
+                    if key not in candidates:
+                        candidates[key] = IndexCandidate(usage.table, columns)
+                    candidate = candidates[key]
+                    candidate.queries.append(shape)
+                    candidate.reasons = _unique(candidate.reasons + shape.issues)
+
+        # (type, ) 是 (type, time) 的前缀, 后者也能服务前者的查询
+        result = list()
+        for candidate in candidates.values():
+            longer = [
+                other
+                for other in candidates.values()
+                if other is not candidate
+                and other.table is candidate.table
+                and other.columns[:len(candidate.columns)] == candidate.columns
+            ]
+            if longer:
+                longer[0].queries.extend(candidate.queries)
+                longer[0].reasons = _unique(longer[0].reasons + candidate.reasons)
+            else:
+                result.append(candidate)
+        result.sort(key=lambda c: sum(q.elapsed for q in c.queries), reverse=True)
+        return result
+
+    @staticmethod
+    def _replay(conn: sa.Connection, queries: T.List[QueryShape], repeat: int) -> float:
+        """
+        按照记录的执行次数的比例重放, 返回加权的耗时.
+        """
+        total = 0.0
+        for shape in queries:
+            elapsed = list()
+            for _ in range(repeat):
+                st = time.perf_counter()
+                conn.exec_driver_sql(shape.statement, shape.parameters).all()
+                elapsed.append(time.perf_counter() - st)
+            total += min(elapsed) * shape.n_execute
+        return total
+
+    def evaluate(
+        self,
+        candidates: T.List[IndexCandidate],
+        scratch_engine: sa.Engine,
+        repeat: int = 3,
+    ) -> T.List[IndexCandidate]:
+        """
+        在 ``scratch_engine`` (数据库的副本) 上逐个测量候选索引的加速比.
+        """
+        with scratch_engine.connect() as conn:
+            for candidate in candidates:
+                before = self._replay(conn, candidate.queries, repeat)
+                index = candidate.to_index(candidate.table.to_metadata(sa.MetaData()))
+                index.create(conn)
+                conn.commit()
+                after = self._replay(conn, candidate.queries, repeat)
+                index.drop(conn)
+                conn.commit()
+                candidate.speedup = before / after if after else float("inf")
+        return candidates
+
+    def recommend(
+        self,
+        scratch_engine: T.Optional[sa.Engine] = None,
+        min_speedup: float = 2.0,
+    ) -> T.List[IndexCandidate]:
+        """
+        analyze, 如果给了 ``scratch_engine`` 就 evaluate, 只保留加速比不小于 ``min_speedup``
+        的候选.
+        """
+        candidates = self.analyze()
+        if scratch_engine is None:
+            return candidates
+        self.evaluate(candidates, scratch_engine)
+        return [c for c in candidates if c.speedup >= min_speedup]
+
+    def apply(
+        self,
+        candidates: T.List[IndexCandidate],
+        engine: T.Optional[sa.Engine] = None,
+    ) -> T.List[sa.Index]:
+        """
+        把索引加到 ``self.metadata`` 中对应的表上. 给了 ``engine`` 时同时在数据库中创建.
+        """
+        indexes = list()
+        for candidate in candidates:
+            table = self.metadata.tables[candidate.table.key]
+            index = candidate.to_index(table)
+            if engine is not None:
+                index.create(engine)
+            indexes.append(index)
+        return indexes
+
+
+def sqlite_scratch_copy(engine: sa.Engine) -> sa.Engine:
+    """
+    用 SQLite 的 backup API 把数据库复制到一个新的内存数据库.
+    """
+    scratch = sa.create_engine("sqlite://", poolclass=sa.pool.StaticPool)
+    with engine.connect() as src, scratch.connect() as dst:
+        src.connection.dbapi_connection.backup(dst.connection.dbapi_connection)
+    return scratch
+
+
+metadata = sa.MetaData()
+
+t_user = sa.Table(
+    "user", metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String),
+)
+
+t_event = sa.Table(
+    "event", metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id")),
+    sa.Column("type", sa.String),
+    sa.Column("time", sa.String),
+    sa.Column("value", sa.Integer),
+)
+
+metadata.create_all(engine)
+
+N_USER = 1000
+N_EVENT = 200000
+TYPES = ["click", "view", "buy", "share", "like"]
+start_time = datetime(2000, 1, 1)
+
+with engine.begin() as conn:
+    conn.execute(
+        sa.insert(t_user),
+        [dict(id=i, name=f"user {i}") for i in range(1, 1 + N_USER)],
+    )
+    conn.execute(
+        sa.insert(t_event),
+        [
+            dict(
+                id=i,
+                user_id=i % N_USER + 1,
+                type=TYPES[i % len(TYPES)],
+                time=str(start_time + timedelta(minutes=i * 7)),
+                value=i % 100,
+            )
+            for i in range(1, 1 + N_EVENT)
+        ],
+    )
+
+stmt_time_range = (
+    sa.select(t_event)
+    .where(t_event.c.time.between("2001-01-01", "2001-01-07"))
+)
+stmt_user_latest = (
+    sa.select(t_event.c.id, t_event.c.time)
+    .where(t_event.c.user_id == sa.bindparam("user_id"))
+    .order_by(t_event.c.time.desc())
+    .limit(10)
+)
+stmt_type_since = (
+    sa.select(sa.func.count())
+    .select_from(t_event)
+    .where(t_event.c.type == "buy", t_event.c.time >= "2002-06-01")
+)
+stmt_user_by_id = sa.select(t_user).where(t_user.c.id == sa.bindparam("id"))
+
+
+def workload(conn: sa.Connection):
+    conn.execute(stmt_time_range).all()
+    for user_id in range(1, 11):
+        conn.execute(stmt_user_latest, dict(user_id=user_id)).all()
+        conn.execute(stmt_user_by_id, dict(id=user_id)).all()
+    conn.execute(stmt_type_since).all()
+
+
+advisor = IndexAdvisor(engine, metadata)
+with advisor.record():
+    with engine.connect() as conn:
+        st = time.perf_counter()
+        workload(conn)
+        print(f"before: {time.perf_counter() - st:.3f} sec")
+
+assert len(advisor.queries) == 4
+assert advisor.queries[str(stmt_user_latest.compile(engine))].n_execute == 10
+
+candidates = advisor.analyze()
+for candidate in candidates:
+    print(candidate, candidate.reasons)
+assert {c.name: c.columns for c in candidates} == {
+    "ix_event_time": ("time",),
+    "ix_event_user_id_time": ("user_id", "time"),
+    "ix_event_type_time": ("type", "time"),
+}
+issues = {key: list(shape.issues) for key, shape in advisor.queries.items()}
+
+# 在副本上测量, 原来的数据库不受影响
+scratch = sqlite_scratch_copy(engine)
+recommended = advisor.recommend(scratch_engine=scratch)
+# recommend 内部又分析了一次, issues 不会重复累加
+assert {key: shape.issues for key, shape in advisor.queries.items()} == issues
+assert len(t_event.indexes) == 0
+for candidate in recommended:
+    print(f"{candidate.name} {candidate.columns}: {candidate.speedup:.1f}x, {', '.join(candidate.reasons)}")
+assert {c.name for c in recommended} == {c.name for c in candidates}
+
+indexes = advisor.apply(recommended, engine=engine)
+assert {index.name for index in t_event.indexes} == {c.name for c in recommended}
+
+with engine.connect() as conn:
+    st = time.perf_counter()
+    workload(conn)
+    print(f"after: {time.perf_counter() - st:.3f} sec")
+
+    # 再分析一次, 已经没有问题了
+    advisor = IndexAdvisor(engine, metadata)
+    with advisor.record():
+        workload(conn)
+    assert advisor.analyze() == []
+    for shape in advisor.queries.values():
+        print(shape.plan)
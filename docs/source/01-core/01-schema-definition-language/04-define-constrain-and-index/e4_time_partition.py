@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+
+"""
+按月分区的 event 表.
+
+``e2_index.py`` 中的 event 表会一直增长, 范围查询越来越慢, 删除旧数据要执行一个很大的
+``DELETE``. :class:`PartitionManager` 把一张逻辑上的表按时间列拆成每月一张子表:
+
+- PostgreSQL: 使用原生的声明式分区. 父表用 ``PARTITION BY RANGE (time)`` 创建, 每个月是
+    ``CREATE TABLE event_2000_01 PARTITION OF event FOR VALUES FROM (...) TO (...)``.
+    写入父表时由数据库路由到子表, 带时间条件的查询由数据库的 partition pruning 只扫描相关的子表.
+- SQLite: 没有分区, 每个月建一张结构相同的表 (带有时间范围的 CHECK 约束和同样的索引),
+    再建一个同名的视图 ``CREATE VIEW event AS SELECT ... FROM event_2000_01 UNION ALL ...``,
+    原来针对 ``event`` 表的查询不需要修改. :meth:`PartitionManager.insert` 按月把数据写入
+    对应的子表, 需要时自动创建新的子表并重建视图. :meth:`PartitionManager.prune` 从 WHERE
+    中找出时间列的范围条件, 把 ``FROM event`` 换成只包含相关子表的 UNION ALL.
+    :meth:`PartitionManager.install` 用 ``before_execute`` 事件对所有 Core 的 SELECT 自动
+    做这个替换.
+
+两种数据库上删除旧数据都是 :meth:`PartitionManager.drop_before`, 直接 ``DROP TABLE`` 整个月
+的子表, 不需要逐行删除.
+
+注意:
+
+- 时间列必须是主键的一部分, 这是 PostgreSQL 分区表的要求. SQLite 上各个子表的主键是独立的,
+    跨月的主键唯一性要由应用保证.
+- 只有 AND 连接的, 时间列在左边的条件 (``==``, ``>``, ``>=``, ``<``, ``<=``, ``BETWEEN``)
+    会被用于 pruning, 其他情况查询全部子表, 结果仍然是正确的.
+- ORM 查询映射到 ``event`` 视图上, 可以正常读取但是不会自动 pruning, 需要的话对语句调用
+    :meth:`PartitionManager.prune`.
+
+36 个月, 72 万行, 时间列上有索引. 随机 20 个月, 查询一个月的汇总和一周的明细, 以及删除最早的
+12 个月::
+
+    --- single table
+    month summary: 0.064 sec
+    week detail: 0.172 sec
+    retention: 0.216 sec
+    --- partitioned, no pruning
+    month summary: 0.201 sec
+    week detail: 0.247 sec
+    --- partitioned, pruning
+    month summary: 0.080 sec
+    week detail: 0.293 sec
+    retention: 0.034 sec
+
+- 不做 pruning 时, 通过视图查询要在每一个子表上查一次索引, 比单表慢 3 倍.
+- pruning 之后和单表上用索引差不多. 单表的这个规模索引已经很快, 分区的主要好处是索引和表
+    不会无限增长, 以及删除旧数据.
+- 每个月的查询被改写成不同的 SQL, 第一次执行时要编译一次, 这是 week detail 比单表慢的原因.
+    编译结果会被缓存, 重复的查询没有这部分开销.
+- 删除 12 个月的数据, ``DROP TABLE`` 比 ``DELETE`` 快 6 倍, 而且不会产生大量的 WAL / undo.
+"""
+
+import typing as T
+import re
+import time
+import random
+from datetime import date, datetime, timedelta
+
+import sqlalchemy as sa
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+from sqlalchemy.sql import visitors, operators, elements
+from sqlalchemy.dialects import postgresql
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(value: datetime) -> datetime:
+    if value.month == 12:
+        return datetime(value.year + 1, 1, 1)
+    return datetime(value.year, value.month + 1, 1)
+
+
+def _to_datetime(value) -> T.Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return None
+
+
+class PartitionManager:
+    """
+    把 ``table`` 按 ``column`` 列分成每月一个分区.
+
+    :param table: 逻辑上的表. 在 PostgreSQL 上它是分区表的父表, 在 SQLite 上是同名的视图,
+        所以不要对它调用 ``metadata.create_all``, 用 :meth:`create`.
+    """
+
+    def __init__(self, table: sa.Table, column: str = "time"):
+        self.table = table
+        self.column: sa.Column = table.c[column]
+        if self.column not in set(table.primary_key.columns):
+            raise ValueError(f"partition column {column!r} must be part of the primary key")
+        table.dialect_options["postgresql"]["partition_by"] = f"RANGE ({column})"
+        self._pattern = re.compile(r"^{}_(\d{{4}})_(\d{{2}})$".format(re.escape(table.name)))
+        self._metadata = sa.MetaData()
+        self._months: T.List[datetime] = list()
+
+    def partition_name(self, month: datetime) -> str:
+        return f"{self.table.name}_{month.year:04d}_{month.month:02d}"
+
+    def partition_table(self, month: datetime) -> sa.Table:
+        """
+        SQLite 上一个月的子表. 列和索引和父表相同, 再加上时间范围的 CHECK 约束.
+        """
+        name = self.partition_name(month)
+        if name in self._metadata.tables:
+            return self._metadata.tables[name]
+        child = sa.Table(
+            name,
+            self._metadata,
+            *[column._copy() for column in self.table.columns],
+        )
+        column = child.c[self.column.name]
+        sa.CheckConstraint(
+            sa.and_(column >= month, column < next_month(month)),
+            name=f"ck_{name}_{self.column.name}",
+            table=child,
+        )
+        for index in self.table.indexes:
+            columns = [child.c[c.name] for c in index.columns]
+            sa.Index(
+                "ix_{}_{}".format(name, "_".join(c.name for c in columns)),
+                *columns,
+                unique=index.unique,
+            )
+        return child
+
+    def partition_ddl(self, month: datetime) -> sa.TextClause:
+        """
+        PostgreSQL 上创建一个月的分区的 DDL. 父表上的索引会自动在分区上创建.
+        """
+        return sa.text(
+            "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+            "FOR VALUES FROM ('{}') TO ('{}')".format(
+                self.partition_name(month),
+                self.table.name,
+                month.isoformat(sep=" "),
+                next_month(month).isoformat(sep=" "),
+            )
+        )
+
+    def _view_select(self) -> sa.Select:
+        if not self._months:
+            return sa.select(
+                *[sa.cast(sa.null(), c.type).label(c.name) for c in self.table.columns]
+            ).where(sa.false())
+        return sa.union_all(*[
+            sa.select(self.partition_table(month)) for month in self._months
+        ])
+
+    def _refresh_view(self, conn: sa.Connection):
+        self.partitions(conn)
+        conn.execute(sa.text(f"DROP VIEW IF EXISTS {self.table.name}"))
+        select = self._view_select().compile(conn, compile_kwargs=dict(literal_binds=True))
+        conn.execute(sa.text(f"CREATE VIEW {self.table.name} AS {select}"))
+
+    def create(self, conn: sa.Connection):
+        """
+        PostgreSQL 上创建分区表的父表, SQLite 上创建一个空的视图.
+        """
+        if conn.dialect.name == "postgresql":
+            self.table.create(conn, checkfirst=True)
+        self.partitions(conn)
+        if conn.dialect.name != "postgresql":
+            self._refresh_view(conn)
+
+    def partitions(self, conn: sa.Connection) -> T.List[datetime]:
+        """
+        从数据库中读出已经存在的分区, 返回每个分区的月初.
+        """
+        months = list()
+        for name in sa.inspect(conn).get_table_names():
+            match = self._pattern.match(name)
+            if match:
+                months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+        self._months = sorted(months)
+        return self._months
+
+    def ensure(self, conn: sa.Connection, months: T.Iterable[datetime]):
+        """
+        创建缺少的分区. 其他进程可能已经创建或删除了分区, 所以先从数据库中重新读一次.
+        """
+        self.partitions(conn)
+        missing = sorted(set(month_start(month) for month in months) - set(self._months))
+        if not missing:
+            return
+        for month in missing:
+            if conn.dialect.name == "postgresql":
+                conn.execute(self.partition_ddl(month))
+            else:
+                self.partition_table(month).create(conn)
+        if conn.dialect.name != "postgresql":
+            self._refresh_view(conn)
+
+    def insert(self, conn: sa.Connection, rows: T.List[dict]):
+        """
+        写入数据. PostgreSQL 由数据库路由, SQLite 按月分组后写入各个子表.
+        """
+        groups: T.Dict[datetime, T.List[dict]] = dict()
+        for row in rows:
+            groups.setdefault(month_start(row[self.column.name]), list()).append(row)
+        self.ensure(conn, groups)
+        if conn.dialect.name == "postgresql":
+            conn.execute(sa.insert(self.table), rows)
+            return
+        for month, group in groups.items():
+            conn.execute(sa.insert(self.partition_table(month)), group)
+
+    def drop_before(self, conn: sa.Connection, cutoff: datetime) -> T.List[str]:
+        """
+        删除所有完全早于 ``cutoff`` 的分区, 返回被删除的表名.
+        """
+        expired = [month for month in self.partitions(conn) if next_month(month) <= cutoff]
+        for month in expired:
+            conn.execute(sa.text(f"DROP TABLE {self.partition_name(month)}"))
+            name = self.partition_name(month)
+            if name in self._metadata.tables:
+                self._metadata.remove(self._metadata.tables[name])
+        if expired and conn.dialect.name != "postgresql":
+            self._refresh_view(conn)
+        return [self.partition_name(month) for month in expired]
+
+    def _bind_value(self, element, params: dict):
+        if isinstance(element, elements.BindParameter):
+            if element.key in params:
+                return _to_datetime(params[element.key])
+            return _to_datetime(element.effective_value)
+        return None
+
+    def time_range(
+        self,
+        whereclause: T.Optional[sa.ColumnElement],
+        params: T.Optional[dict] = None,
+    ) -> T.Tuple[T.Optional[datetime], T.Optional[datetime]]:
+        """
+        从 WHERE 中找出时间列的下界和上界 (都按闭区间处理), 找不到的一边是 None.
+        """
+        params = params or dict()
+        lower, upper = None, None
+        if whereclause is None:
+            return lower, upper
+        if isinstance(whereclause, elements.BooleanClauseList) and whereclause.operator is operators.and_:
+            conjuncts = list(whereclause.clauses)
+        else:
+            conjuncts = [whereclause]
+        for clause in conjuncts:
+            if not isinstance(clause, elements.BinaryExpression):
+                continue
+            if not (isinstance(clause.left, sa.Column) and clause.left.table is self.table
+                    and clause.left.name == self.column.name):
+                continue
+            if clause.operator is operators.between_op:
+                low, high = [self._bind_value(c, params) for c in clause.right.clauses]
+            else:
+                value = self._bind_value(clause.right, params)
+                if value is None:
+                    continue
+                # DateTime 的精度是微秒, ``< v`` 等价于 ``<= v - 1us``
+                low = high = None
+                if clause.operator in (operators.eq, operators.ge):
+                    low = value
+                elif clause.operator is operators.gt:
+                    low = value + timedelta(microseconds=1)
+                if clause.operator in (operators.eq, operators.le):
+                    high = value
+                elif clause.operator is operators.lt:
+                    high = value - timedelta(microseconds=1)
+            if low is not None and (lower is None or low > lower):
+                lower = low
+            if high is not None and (upper is None or high < upper):
+                upper = high
+        return lower, upper
+
+    def prune(self, stmt: sa.Select, params: T.Optional[dict] = None) -> sa.Select:
+        """
+        SQLite 上把 ``FROM event`` 换成只包含相关子表的 UNION ALL. 没有时间条件的查询原样返回.
+
+        这里在每次执行前调用, 不查询数据库, 用的是最近一次 :meth:`partitions` 读到的分区.
+        其他进程增删分区后, 需要调用一次 :meth:`partitions`.
+        """
+        if self.table not in stmt.get_final_froms():
+            return stmt
+        lower, upper = self.time_range(stmt.whereclause, params)
+        if lower is None and upper is None:
+            return stmt
+        months = [
+            month for month in self._months
+            if (lower is None or next_month(month) > lower)
+            and (upper is None or month <= upper)
+        ]
+        if len(months) == len(self._months) or not months:
+            return stmt
+        if len(months) == 1:
+            source = self.partition_table(months[0]).alias(self.table.name)
+        else:
+            source = sa.union_all(*[
+                sa.select(self.partition_table(month)) for month in months
+            ]).subquery(self.table.name)
+
+        def replace(element):
+            if element is self.table:
+                return source
+            if isinstance(element, sa.Column) and element.table is self.table:
+                return source.c[element.name]
+            return None
+
+        return visitors.replacement_traverse(stmt, {}, replace)
+
+    def install(self, engine: sa.Engine):
+        """
+        在 SQLite 上对所有 Core 的 SELECT 自动做 pruning. PostgreSQL 不需要.
+        """
+        if engine.dialect.name == "postgresql":
+            return
+
+        @event.listens_for(engine, "before_execute", retval=True)
+        def before_execute(conn, clauseelement, multiparams, params, execution_options):
+            if isinstance(clauseelement, sa.Select):
+                bound = params or (multiparams[0] if len(multiparams) == 1 else dict())
+                clauseelement = self.prune(clauseelement, bound)
+            return clauseelement, multiparams, params
+
+
+metadata = sa.MetaData()
+
+t_event = sa.Table(
+    "event", metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("time", sa.DateTime, primary_key=True),
+    sa.Column("user_id", sa.Integer),
+    sa.Column("value", sa.Integer),
+    sa.Index("ix_event_time", "time"),
+)
+
+manager = PartitionManager(t_event)
+
+# PostgreSQL 的 DDL, 这里只编译不执行
+print(str(sa.schema.CreateTable(t_event).compile(dialect=postgresql.dialect())).strip())
+print(manager.partition_ddl(datetime(2000, 1, 1)).text)
+assert "PARTITION BY RANGE (time)" in str(sa.schema.CreateTable(t_event).compile(dialect=postgresql.dialect()))
+
+# --- Benchmark
+N_MONTH = 36
+N_ROW_PER_DAY = 660
+N_QUERY = 20
+
+random.seed(1)
+start_time = datetime(2000, 1, 1)
+end_time = start_time
+for _ in range(N_MONTH):
+    end_time = next_month(end_time)
+n_second = int((end_time - start_time).total_seconds())
+n_row = N_ROW_PER_DAY * (end_time - start_time).days
+data = [
+    dict(
+        id=i,
+        time=start_time + timedelta(seconds=n_second * (i - 1) // n_row),
+        user_id=random.randint(1, 1000),
+        value=random.randint(1, 100),
+    )
+    for i in range(1, 1 + n_row)
+]
+
+month_list = [start_time]
+while len(month_list) < N_MONTH:
+    month_list.append(next_month(month_list[-1]))
+query_months = random.sample(month_list, N_QUERY)
+
+stmt_month_summary = sa.select(
+    sa.func.count(), sa.func.sum(t_event.c.value),
+).where(t_event.c.time >= sa.bindparam("start"), t_event.c.time < sa.bindparam("end"))
+stmt_week_detail = sa.select(t_event).where(
+    t_event.c.time.between(sa.bindparam("start"), sa.bindparam("end"))
+)
+
+
+def run_queries(engine: sa.Engine) -> T.Tuple[list, list]:
+    summary, detail = list(), list()
+    with engine.connect() as conn:
+        st = time.perf_counter()
+        for month in query_months:
+            summary.append(tuple(conn.execute(
+                stmt_month_summary, dict(start=month, end=next_month(month))
+            ).one()))
+        print(f"month summary: {time.perf_counter() - st:.3f} sec")
+        st = time.perf_counter()
+        for month in query_months:
+            detail.append(len(conn.execute(
+                stmt_week_detail, dict(start=month, end=month + timedelta(days=7))
+            ).all()))
+        print(f"week detail: {time.perf_counter() - st:.3f} sec")
+    return summary, detail
+
+
+cutoff = month_list[12]
+
+print("--- single table")
+engine_single = sam.EngineCreator().create_sqlite()
+metadata.create_all(engine_single)
+with engine_single.begin() as conn:
+    conn.execute(sa.insert(t_event), data)
+expected = run_queries(engine_single)
+with engine_single.begin() as conn:
+    st = time.perf_counter()
+    conn.execute(sa.delete(t_event).where(t_event.c.time < cutoff))
+    print(f"retention: {time.perf_counter() - st:.3f} sec")
+    n_left = conn.execute(sa.select(sa.func.count()).select_from(t_event)).scalar()
+
+print("--- partitioned, no pruning")
+engine_partition = sam.EngineCreator().create_sqlite()
+with engine_partition.begin() as conn:
+    manager.create(conn)
+    manager.insert(conn, data)
+    assert len(manager.partitions(conn)) == N_MONTH
+assert run_queries(engine_partition) == expected
+
+print("--- partitioned, pruning")
+manager.install(engine_partition)
+# 一个月的查询只剩一张子表
+pruned = manager.prune(stmt_month_summary, dict(start=month_list[3], end=next_month(month_list[3])))
+assert "FROM event_2000_04 AS event" in str(pruned)
+assert run_queries(engine_partition) == expected
+with engine_partition.begin() as conn:
+    st = time.perf_counter()
+    dropped = manager.drop_before(conn, cutoff)
+    print(f"retention: {time.perf_counter() - st:.3f} sec")
+    assert len(dropped) == 12
+    assert conn.execute(sa.select(sa.func.count()).select_from(t_event)).scalar() == n_left
+
+# 另一个进程的 PartitionManager 没有缓存的分区列表, 也能正确的删除分区和重建视图
+other_manager = PartitionManager(t_event)
+with engine_partition.begin() as conn:
+    dropped = other_manager.drop_before(conn, month_list[13])
+    assert dropped == [manager.partition_name(month_list[12])]
+    assert len(manager.partitions(conn)) == N_MONTH - 13
+    other_manager.ensure(conn, [month_list[12]])
+    assert len(manager.partitions(conn)) == N_MONTH - 12
+    assert conn.execute(sa.select(sa.func.count()).select_from(t_event)).scalar() == (
+        n_left - sum(1 for row in data if month_list[12] <= row["time"] < month_list[13])
+    )
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+
+"""
+用整数存储 date 和 datetime.
+
+``e2_index.py`` 中的 ``time`` 列是 ``sa.String``, SQLAlchemy 自带的 ``sa.DateTime`` 在
+SQLite 上也是存成 ``'2000-01-01 00:00:00.000000'`` 这样的字符串. 这样有三个问题:
+
+- 每个值要 26 个字节, 索引很宽.
+- 比较是字符串比较, 只有格式完全一致时才正确.
+- 每读一行都要在 Python 中解析字符串.
+
+:class:`EpochDate` 存储 1970-01-01 以来的天数, :class:`EpochDateTime` 存储 1970-01-01 UTC
+以来的微秒数. SQLite 的整数是变长编码, 常见的日期只要 3 个字节, 时间只要 8 个字节.
+
+- 直接实现 ``bind_processor`` 和 ``result_processor``, 而不是 ``process_bind_param`` /
+    ``process_result_value``, 每个值只经过一次函数调用. 写入只用整数运算 (``toordinal``,
+    ``timedelta // timedelta``), 微秒可以完整的 round trip.
+- ``coerce_compared_value`` 默认返回类型本身, 所以 ``col >= datetime(...)``, ``BETWEEN``
+    中的参数也会被转换成整数, 范围查询的语义和 datetime 一致. ``EpochDateTime`` 的参数也可以
+    是 ``date``, 表示那一天的 0 点.
+- 带时区的 datetime 先转换成 UTC, 不带时区的被当作 UTC. ``timezone=True`` 时读出的值带有
+    UTC 时区.
+- PostgreSQL 的 ``DATE`` 和 ``TIMESTAMP`` 本身就是 4 和 8 个字节的整数, 所以在 PostgreSQL
+    上使用原生类型.
+
+注意: 数据库中的值是整数, 不能直接用数据库的日期函数 (``date(time)``, ``strftime``), 也不能
+和 ``timedelta`` 做运算.
+
+50 万行, 时间列上有索引. 查询 200 个随机的 1 天的范围, 以及读取 20 万行. ``String`` 的
+编码和解码 (``datetime.fromisoformat``) 由应用完成, 其他的由类型完成::
+
+    --- String
+    index size: 20.07 MB
+    range scan: 0.007 sec
+    fetch + decode: 0.176 sec
+    --- DateTime
+    index size: 20.07 MB
+    range scan: 0.007 sec
+    fetch + decode: 0.239 sec
+    --- EpochDateTime
+    index size: 9.73 MB
+    range scan: 0.006 sec
+    fetch + decode: 0.290 sec
+    --- EpochDateTime(timezone=True)
+    index size: 9.73 MB
+    range scan: 0.006 sec
+    fetch + decode: 0.275 sec
+
+- 索引小了一半, 同样大小的缓存可以放下两倍的索引. 数据量超过内存时这是主要的收益.
+- 范围查询快 15% 左右, 整数比较比字符串比较便宜.
+- 读取反而慢了 15% ~ 20%. ``datetime.fromisoformat`` 和 ``sa.DateTime`` 在 SQLite 上用的
+    解析函数都是 C 实现的, 而从整数构造 datetime 最快的方法 (``timedelta``,
+    ``fromtimestamp``) 在 Python 中也要 0.5 微秒左右. 整数编码省掉的是空间和比较, 不是解码.
+"""
+
+import typing as T
+import time
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import sqlalchemy as sa
+import sqlalchemy_mate as sam
+from sqlalchemy.dialects import postgresql
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class EpochDate(sa.types.TypeDecorator):
+    """
+    存储 1970-01-01 以来的天数.
+    """
+    impl = sa.Integer
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(sa.Date())
+        return dialect.type_descriptor(sa.Integer())
+
+    def bind_processor(self, dialect):
+        if dialect.name == "postgresql":
+            return super(EpochDate, self).bind_processor(dialect)
+
+        def process(value):
+            if value is None:
+                return None
+            return value.toordinal() - EPOCH_ORDINAL
+
+        return process
+
+    def literal_processor(self, dialect):
+        bind = self.bind_processor(dialect)
+        if bind is None:
+            return super(EpochDate, self).literal_processor(dialect)
+        return lambda value: str(bind(value))
+
+    def result_processor(self, dialect, coltype):
+        if dialect.name == "postgresql":
+            return super(EpochDate, self).result_processor(dialect, coltype)
+
+        def process(value):
+            if value is None:
+                return None
+            return date.fromordinal(value + EPOCH_ORDINAL)
+
+        return process
+
+
+class EpochDateTime(sa.types.TypeDecorator):
+    """
+    存储 1970-01-01 UTC 以来的微秒数.
+
+    :param timezone: 为 True 时读出的 datetime 带有 UTC 时区.
+    """
+    impl = sa.BigInteger
+    cache_ok = True
+
+    def __init__(self, timezone: bool = False):
+        super(EpochDateTime, self).__init__()
+        self.timezone = timezone
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(sa.DateTime(timezone=self.timezone))
+        return dialect.type_descriptor(sa.BigInteger())
+
+    def bind_processor(self, dialect):
+        if dialect.name == "postgresql":
+            return super(EpochDateTime, self).bind_processor(dialect)
+
+        def process(value):
+            if value is None:
+                return None
+            if not isinstance(value, datetime):
+                return (value.toordinal() - EPOCH_ORDINAL) * 86400000000
+            if value.tzinfo is None:
+                return (value - EPOCH) // MICROSECOND
+            return (value - EPOCH_UTC) // MICROSECOND
+
+        return process
+
+    def literal_processor(self, dialect):
+        bind = self.bind_processor(dialect)
+        if bind is None:
+            return super(EpochDateTime, self).literal_processor(dialect)
+        return lambda value: str(bind(value))
+
+    def result_processor(self, dialect, coltype):
+        if dialect.name == "postgresql":
+            return super(EpochDateTime, self).result_processor(dialect, coltype)
+        if self.timezone:
+            # 秒数小于 2 ** 32 时 (公元 2106 年以前) 浮点数的误差小于 0.5 微秒,
+            # fromtimestamp 四舍五入到微秒之后是精确的, 而且比构造 timedelta 快
+            def process(value):
+                if value is None:
+                    return None
+                return fromtimestamp(value / 1000000, utc)
+
+            fromtimestamp, utc = datetime.fromtimestamp, timezone.utc
+            return process
+
+        def process(value):
+            if value is None:
+                return None
+            return epoch + new_timedelta(0, 0, value)
+
+        epoch, new_timedelta = EPOCH, timedelta
+        return process
+
+
+metadata = sa.MetaData()
+
+t_event = sa.Table(
+    "event", metadata,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("day", EpochDate),
+    sa.Column("time", EpochDateTime),
+    sa.Column("time_utc", EpochDateTime(timezone=True)),
+)
+
+engine = sam.EngineCreator().create_sqlite()
+metadata.create_all(engine)
+
+# round trip, 包括 1970 年以前的值和微秒
+rows = [
+    dict(
+        id=1,
+        day=date(1969, 12, 31),
+        time=datetime(1969, 12, 31, 23, 59, 59, 999999),
+        time_utc=datetime(2000, 1, 1, 8, tzinfo=timezone(timedelta(hours=8))),
+    ),
+    dict(
+        id=2,
+        day=date(2000, 2, 29),
+        time=datetime(2000, 2, 29, 12, 30, 0, 1),
+        time_utc=datetime(2000, 1, 1, 0, 0, 0, 1),
+    ),
+    dict(id=3, day=None, time=None, time_utc=None),
+]
+with engine.begin() as conn:
+    conn.execute(sa.insert(t_event), rows)
+    raw = conn.execute(sa.text("SELECT day, time FROM event WHERE id = 1")).one()
+    assert tuple(raw) == (-1, -1)
+    result = conn.execute(sa.select(t_event).order_by(t_event.c.id)).all()
+    assert result[0].day == date(1969, 12, 31)
+    assert result[0].time == datetime(1969, 12, 31, 23, 59, 59, 999999)
+    assert result[0].time_utc == datetime(2000, 1, 1, tzinfo=timezone.utc)
+    assert result[1].time == datetime(2000, 2, 29, 12, 30, 0, 1)
+    assert result[1].time_utc == datetime(2000, 1, 1, 0, 0, 0, 1, tzinfo=timezone.utc)
+    assert result[2].time is None
+
+    # 范围查询: 参数被转换成整数, date 表示那一天的 0 点
+    stmt = sa.select(t_event.c.id).where(
+        t_event.c.time.between(date(2000, 2, 29), datetime(2000, 2, 29, 12, 30, 0, 1))
+    )
+    assert conn.execute(stmt).scalars().all() == [2]
+    stmt = sa.select(t_event.c.id).where(t_event.c.time < datetime(2000, 2, 29, 12, 30, 0, 1))
+    assert conn.execute(stmt).scalars().all() == [1]
+    stmt = sa.select(t_event.c.id).where(t_event.c.day >= date(1970, 1, 1))
+    assert conn.execute(stmt).scalars().all() == [2]
+    print(stmt.compile(engine, compile_kwargs=dict(literal_binds=True)))
+
+# PostgreSQL 使用原生类型
+ddl = str(sa.schema.CreateTable(t_event).compile(dialect=postgresql.dialect()))
+assert "day DATE" in ddl and "time TIMESTAMP WITHOUT TIME ZONE" in ddl
+assert "time_utc TIMESTAMP WITH TIME ZONE" in ddl
+
+# --- Benchmark
+N_ROW = 500_000
+N_QUERY = 200
+N_FETCH = 200_000
+
+random.seed(1)
+start_time = datetime(2000, 1, 1)
+times = sorted(
+    start_time + timedelta(microseconds=random.randint(0, 10 * 365 * 86400 * 10 ** 6))
+    for _ in range(N_ROW)
+)
+query_days = [
+    start_time + timedelta(days=random.randint(0, 10 * 365)) for _ in range(N_QUERY)
+]
+
+
+def index_size(conn: sa.Connection, name: str) -> int:
+    return conn.execute(
+        sa.text("SELECT SUM(pgsize) FROM dbstat WHERE name = :name"), dict(name=name)
+    ).scalar()
+
+
+def run_benchmark(name: str, type_: sa.types.TypeEngine, encode: T.Callable, decode: T.Callable):
+    metadata = sa.MetaData()
+    table = sa.Table(
+        "event", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("time", type_),
+        sa.Index("ix_event_time", "time"),
+    )
+    engine = sam.EngineCreator().create_sqlite()
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            sa.insert(table),
+            [dict(id=i, time=encode(t)) for i, t in enumerate(times, start=1)],
+        )
+    stmt_range = sa.select(sa.func.count()).where(
+        table.c.time >= sa.bindparam("start"), table.c.time < sa.bindparam("end")
+    )
+    stmt_fetch = sa.select(table.c.time).where(table.c.id <= N_FETCH)
+    with engine.connect() as conn:
+        size = index_size(conn, "ix_event_time")
+        st = time.perf_counter()
+        counts = [
+            conn.execute(
+                stmt_range, dict(start=encode(day), end=encode(day + timedelta(days=1)))
+            ).scalar()
+            for day in query_days
+        ]
+        elapsed_range = time.perf_counter() - st
+        st = time.perf_counter()
+        values = [decode(value) for value in conn.execute(stmt_fetch).scalars()]
+        elapsed_fetch = time.perf_counter() - st
+    print(f"--- {name}")
+    print(f"index size: {size / 1000000:.2f} MB")
+    print(f"range scan: {elapsed_range:.3f} sec")
+    print(f"fetch + decode: {elapsed_fetch:.3f} sec")
+    return size, counts, values
+
+
+# 字符串需要自己编码和解码, 另外两个由类型完成
+string = run_benchmark(
+    "String", sa.String, lambda t: t.isoformat(sep=" ", timespec="microseconds"), datetime.fromisoformat
+)
+stock = run_benchmark("DateTime", sa.DateTime, lambda t: t, lambda t: t)
+epoch = run_benchmark("EpochDateTime", EpochDateTime, lambda t: t, lambda t: t)
+epoch_utc = run_benchmark(
+    "EpochDateTime(timezone=True)", EpochDateTime(timezone=True), lambda t: t, lambda t: t
+)
+
+assert string[1] == stock[1] == epoch[1] == epoch_utc[1]
+assert [t.replace(tzinfo=None) for t in epoch_utc[2]] == times[:N_FETCH]
+assert string[2] == stock[2] == epoch[2] == times[:N_FETCH]
+assert epoch[0] < string[0]
@@ -1,14 +1,72 @@
 # -*- coding: utf-8 -*-
 
+"""
+``AttrsJsonType`` 把 attrs 对象以 JSON 字符串的形式存在一个列中.
+
+性能上的两个问题:
+
+1. 标准库的 ``json`` 比较慢. ``JsonCodec`` 是可替换的编解码器, 默认在安装了 ``orjson``
+    或 ``msgspec`` 时使用它们, 都没有时用标准库. 也可以用
+    ``AttrsJsonType(attrs_class=..., codec=stdlib_codec)`` 指定.
+2. 原来每读一行都要把 JSON 解析并构造完整的 attrs 对象, 即使这个属性从来没被访问过.
+    现在返回的是一个 :class:`LazyAttrs` 代理, 第一次访问属性时才解析, 解析结果会缓存起来.
+    ``isinstance(user.profile, Profile)`` 仍然成立, 并且不会触发解析. 没有解析过的代理被
+    再次写入数据库时, 直接使用原来的 JSON 字符串, 不需要重新编码. ``copy`` 和 ``pickle``
+    得到的也是代理.
+
+注意: 和原来一样, 直接修改 attrs 对象的属性 (``user.profile.dob = ...``) 不会被 Session
+发现, 需要给 ``user.profile`` 重新赋值.
+
+每行带一个约 5 KB 的 JSON, 2 万行的结果如下. 只读 ``name`` 列时, lazy 的代价几乎就是把
+字符串从数据库读出来. 读取全部 JSON 时差别不大: 解析本身 orjson 更快, 但是这时大部分
+时间花在创建几十万个 dict / list, 以及它们触发的垃圾回收上, 和用哪个库解析无关::
+
+    write, json: 1.629 sec
+    write, orjson: 0.451 sec
+    scan name only, json eager: 3.125 sec
+    scan name only, orjson lazy: 0.483 sec
+    read payload, json eager: 2.678 sec
+    read payload, orjson lazy: 2.439 sec
+
+按 JSON 中的字段过滤时, 如果把整行读出来在 python 里判断, 每一行都要传输并解析整个
+JSON. :class:`AttrsJsonbType` 让数据库来做这件事:
+
+- 在 PostgreSQL 上列的类型是 ``JSONB``, 可以建 ``jsonb_path_ops`` 的 GIN 索引.
+    :class:`json_path_equals` 会编译成 ``paper @> '{"author": {"country": "US"}}'``,
+    这个运算符能用上 GIN 索引.
+- 在其他数据库上仍然存成字符串. SQLite 用 JSON1 的 ``json_extract``, 并且对常用的路径
+    建表达式索引. 和 ``hybird_attributes_expression_index.py`` 一样, 路径必须渲染成字面值
+    (``literal_execute``) 才能和索引中的表达式一致.
+- 路径 ``"author.country"`` 会按 attrs 的字段定义检查, 写错字段名时直接报错, 并且根据
+    字段类型决定用 ``as_string()`` 还是 ``as_integer()`` 等.
+
+10 万行 SQLite 的结果如下. PostgreSQL 的部分只在能连上数据库时, 在一个新建的 schema 中
+运行, 结束后删除这个 schema::
+
+    python filter: 979 rows, 3.220 sec, 156.75 MB
+    server side, no index: 979 rows, 0.276 sec, 0.01 MB
+    server side, expression index: 979 rows, 0.006 sec, 0.01 MB
+"""
+
+import typing as T
+import copy
+import pickle
+import time
+import random
+
 import attr
 from attrs_mate import AttrsClass
 import sqlalchemy as sa
 from sqlalchemy.orm import declarative_base, Session
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.visitors import InternalTraversal
 import sqlalchemy_mate as sam
 from learn_sqlalchemy.db import engine_sqlite as engine
+from learn_sqlalchemy.sql import inline_literals
 
 # --- Implement a json serializable attrs class
 import json
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql.base import ischema_names
 
 try:
@@ -28,6 +86,157 @@ except ImportError:
     ischema_names['json'] = PostgresJSONType
     has_postgres_json = False
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+
+def _default(value):
+    """
+    把 attrs 对象转换成 dict. 只转换一层, 更深的 attrs 对象会再次调用这个函数, 避免
+    ``attr.asdict`` 把整个 dict / list 树复制一遍.
+    """
+    if type(value) is LazyAttrs:
+        return value._load()
+    if attr.has(type(value)):
+        return attr.asdict(value, recurse=False)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    """
+    标准库 ``json`` 实现的编解码器. 其他实现只需要覆盖 ``dumps`` 和 ``loads``.
+    ``dumps`` 可以直接接受 attrs 对象.
+    """
+    name = "json"
+
+    def dumps(self, value: T.Any) -> str:
+        return json.dumps(value, default=_default)
+
+    def loads(self, value: T.Union[str, bytes]) -> T.Any:
+        return json.loads(value)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def dumps(self, value: T.Any) -> str:
+        # orjson 返回的是 bytes, 列的类型是 UnicodeText
+        return orjson.dumps(value, default=_default).decode("utf-8")
+
+    def loads(self, value: T.Union[str, bytes]) -> T.Any:
+        return orjson.loads(value)
+
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder(enc_hook=_default)
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, value: T.Any) -> str:
+        return self.encoder.encode(value).decode("utf-8")
+
+    def loads(self, value: T.Union[str, bytes]) -> T.Any:
+        return self.decoder.decode(value)
+
+
+stdlib_codec = JsonCodec()
+
+if orjson is not None:
+    default_codec = OrjsonCodec()
+elif msgspec is not None:  # pragma: no cover
+    default_codec = MsgspecCodec()
+else:  # pragma: no cover
+    default_codec = stdlib_codec
+
+_NOT_LOADED = object()
+
+
+class LazyAttrs:
+    """
+    数据库中读出的 JSON 字符串的代理, 第一次访问属性时才解析成 attrs 对象.
+    """
+    __slots__ = ("_attrs_class", "_codec", "_raw", "_value")
+
+    def __init__(self, attrs_class, codec: JsonCodec, raw: str):
+        object.__setattr__(self, "_attrs_class", attrs_class)
+        object.__setattr__(self, "_codec", codec)
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_value", _NOT_LOADED)
+
+    def _load(self):
+        value = object.__getattribute__(self, "_value")
+        if value is _NOT_LOADED:
+            attrs_class = object.__getattribute__(self, "_attrs_class")
+            codec = object.__getattribute__(self, "_codec")
+            value = attrs_class.from_dict(codec.loads(object.__getattribute__(self, "_raw")))
+            object.__setattr__(self, "_value", value)
+        return value
+
+    @property
+    def _is_loaded(self) -> bool:
+        return object.__getattribute__(self, "_value") is not _NOT_LOADED
+
+    # 让 isinstance(proxy, attrs_class) 成立, 并且不触发解析
+    @property
+    def __class__(self):
+        return object.__getattribute__(self, "_attrs_class")
+
+    def __getattr__(self, name: str):
+        # SQLAlchemy 会用 hasattr(value, "__clause_element__") 之类的方法探测参数,
+        # attrs 类上没有的 dunder 直接报错, 不触发解析. 有的 (例如 __dict__) 要从
+        # 解析后的对象上取, 而不是返回类上的同名属性
+        if name.startswith("__") and name.endswith("__"):
+            if not hasattr(object.__getattribute__(self, "_attrs_class"), name):
+                raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self._load(), name, value)
+
+    def __eq__(self, other):
+        if type(other) is LazyAttrs:
+            other = other._load()
+        return self._load() == other
+
+    def __hash__(self):
+        return hash(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+    # __class__ 被改成了 attrs 类, copy 和 pickle 默认的实现会按 attrs 类去重建对象,
+    # 得到一个空的 attrs 对象, 所以要自己实现. 复制出来的还是代理: 没有解析过的复制
+    # 原来的字符串, 解析过的 (可能已经被修改) 重新编码
+    def __reduce__(self):
+        attrs_class = object.__getattribute__(self, "_attrs_class")
+        codec = object.__getattribute__(self, "_codec")
+        if self._is_loaded:
+            raw = codec.dumps(self._load())
+        else:
+            raw = object.__getattribute__(self, "_raw")
+        return LazyAttrs, (attrs_class, codec, raw)
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
+    def __copy__(self):
+        return LazyAttrs(*self.__reduce__()[1])
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
 
 class AttrsJsonType(sa.types.TypeDecorator):
     """
@@ -54,6 +263,9 @@ class AttrsJsonType(sa.types.TypeDecorator):
             'max-speed': '400 mph'
         }
         session.commit()
+
+    :param codec: JSON 编解码器, 默认是 ``default_codec``.
+    :param lazy: 为 True 时读出的值是 :class:`LazyAttrs` 代理.
     """
     impl = sa.UnicodeText
     cache_ok = True
@@ -63,6 +275,8 @@ class AttrsJsonType(sa.types.TypeDecorator):
             self.attrs_class = kwargs.pop("attrs_class")
         else:
             raise ValueError
+        self.codec = kwargs.pop("codec", default_codec)
+        self.lazy = kwargs.pop("lazy", True)
 
         super(AttrsJsonType, self).__init__(*args, **kwargs)
 
@@ -80,29 +294,163 @@ class AttrsJsonType(sa.types.TypeDecorator):
         if dialect.name == 'postgresql' and has_postgres_json:
             return value
         if value is not None:
-            value = value.to_json()
+            if type(value) is LazyAttrs:
+                if not value._is_loaded:
+                    # 没有解析过, 也就不可能被修改过, 直接用原来的字符串
+                    return object.__getattribute__(value, "_raw")
+                value = value._load()
+            value = self.codec.dumps(value)
         return value
 
     def process_result_value(self, value, dialect):
         if dialect.name == 'postgresql':
             return value
         if value is not None:
-            value = self.attrs_class.from_json(value)
+            if self.lazy:
+                value = LazyAttrs(self.attrs_class, self.codec, value)
+            else:
+                value = self.attrs_class.from_dict(self.codec.loads(value))
         return value
 
 
+class AttrsJsonbType(AttrsJsonType):
+    """
+    PostgreSQL 上用原生的 ``JSONB`` 存储, 其他数据库上和 :class:`AttrsJsonType` 一样存 text
+    (SQLite 的 JSON1 函数可以直接处理 text). 和 ``sa.JSON`` 一样支持
+    ``column[("a", "b")].as_string()`` 这样的 JSON 表达式, 一般通过 :func:`json_extract`
+    和 :func:`json_path_equals` 使用.
+    """
+    impl = sa.JSON
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(JSONB())
+        return dialect.type_descriptor(sa.UnicodeText())
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name == 'postgresql':
+            if value is None:
+                return value
+            if type(value) is LazyAttrs:
+                value = value._load()
+            return attr.asdict(value)
+        return super(AttrsJsonbType, self).process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if dialect.name == 'postgresql':
+            # psycopg2 已经把 JSONB 解析成了 dict
+            if value is not None:
+                value = self.attrs_class.from_dict(value)
+            return value
+        return super(AttrsJsonbType, self).process_result_value(value, dialect)
+
+
+_AS_TYPE = {
+    str: "as_string",
+    int: "as_integer",
+    float: "as_float",
+    bool: "as_boolean",
+}
+
+
+def _resolve_path(attrs_class, path: str) -> T.Tuple[T.Tuple[T.Union[str, int], ...], T.Any]:
+    """
+    把 ``"author.name"`` 这样的路径拆开, 并用 attrs 类的字段检查路径是否存在.
+
+    :return: (路径中每一级的 key, 最后一级的类型). 进入 dict / list 之后不再检查,
+        数字被当作 list 的下标.
+    """
+    keys = list()
+    klass = attrs_class
+    leaf_type = None
+    for key in path.split("."):
+        if klass is None:
+            keys.append(int(key) if key.isdigit() else key)
+            leaf_type = None
+            continue
+        fields = attr.fields_dict(klass)
+        if key not in fields:
+            raise AttributeError(f"{klass.__name__} has no field {key!r}")
+        keys.append(key)
+        leaf_type = fields[key].type
+        klass = leaf_type if isinstance(leaf_type, type) and attr.has(leaf_type) else None
+    return tuple(keys), leaf_type
+
+
+def json_extract(column, path: str) -> sa.ColumnElement:
+    """
+    在数据库端取出 ``column`` 中 ``path`` 处的值. 字段是 str / int / float / bool 时,
+    返回对应类型的值, 否则返回 JSON.
+    """
+    keys, leaf_type = _resolve_path(column.type.attrs_class, path)
+    expr = column[keys] if len(keys) > 1 else column[keys[0]]
+    method = _AS_TYPE.get(leaf_type)
+    if method is not None:
+        expr = getattr(expr, method)()
+    # JSON path 默认是绑定参数, 数据库看不出它和表达式索引中的 path 是同一个
+    return inline_literals(expr, types=(sa.JSON.JSONPathType, sa.JSON.JSONIndexType))
+
+
+class json_path_equals(sa.sql.expression.ColumnElement):
+    """
+    ``column`` 中 ``path`` 处的值等于 ``value``.
+
+    - PostgreSQL: ``column @> '{"author": {"name": "Alice"}}'``, 可以用 GIN 索引.
+    - 其他数据库: ``json_extract(column, path) = value``, 可以用表达式索引.
+
+    ``value`` 只能是 str / int / float / bool. 对于 list / dict, ``@>`` 是包含而不是相等,
+    ``{"tags": ["a"]}`` 也能匹配 ``["a", "b"]``, 两种数据库的结果会不一样. ``None`` 在
+    ``@>`` 中匹配 JSON 的 null, 而 ``= NULL`` 永远不成立.
+    """
+    type = sa.Boolean()
+    # 本身就是一个比较, 不要在 WHERE 中再渲染成 "... = 1"
+    _is_implicitly_boolean = True
+    inherit_cache = True
+    _traverse_internals = [
+        ("column", InternalTraversal.dp_clauseelement),
+        ("document", InternalTraversal.dp_clauseelement),
+        ("generic", InternalTraversal.dp_clauseelement),
+    ]
+
+    def __init__(self, column, path: str, value):
+        keys, _ = _resolve_path(column.type.attrs_class, path)
+        if any(isinstance(key, int) for key in keys):
+            raise ValueError("list index is not supported in json_path_equals")
+        if not isinstance(value, (str, int, float, bool)):
+            raise ValueError(
+                f"json_path_equals only supports scalar values, got {type(value).__name__}"
+            )
+        document = value
+        for key in reversed(keys):
+            document = {key: document}
+        self.column = column.__clause_element__() if hasattr(column, "__clause_element__") else column
+        self.document = sa.bindparam(None, document, type_=JSONB(), unique=True)
+        self.generic = json_extract(column, path) == value
+
+
+@compiles(json_path_equals)
+def _compile_json_path_equals(element, compiler, **kw):
+    return compiler.process(element.generic, **kw)
+
+
+@compiles(json_path_equals, "postgresql")
+def _compile_json_path_equals_postgresql(element, compiler, **kw):
+    return compiler.process(element.column.op("@>", is_comparison=True)(element.document), **kw)
+
+
 # declarative base class
 Base = declarative_base()
 
 
 @attr.s
 class AttrsJsonColumn(AttrsClass):
-    def to_json(self) -> str:
-        return json.dumps(self.to_dict())
+    def to_json(self, codec: JsonCodec = default_codec) -> str:
+        return codec.dumps(self)
 
     @classmethod
-    def from_json(cls, value):
-        return cls.from_dict(json.loads(value))
+    def from_json(cls, value, codec: JsonCodec = default_codec):
+        return cls.from_dict(codec.loads(value))
 
 
 @attr.s
@@ -125,10 +473,293 @@ with Session(engine) as ses:
     ses.commit()
 
     user = ses.get(User, 1)
+    assert isinstance(user.profile, Profile)
+    assert user.profile._is_loaded is False  # isinstance 不会触发解析
     print(user.profile)
+    assert user.profile._is_loaded is True
+    assert user.profile == Profile(dob="2021-01-01")
+    assert user.profile.to_json(stdlib_codec) == '{"dob": "2021-01-01"}'
 
     user_data = user.to_dict()
     print(user.to_dict())
 
     user = User(**user_data)
     print(user)
+
+    # 没有解析过的代理写回数据库时, 直接用原来的字符串
+    user = ses.get(User, 1)
+    ses.expire(user)
+    profile = user.profile
+    assert profile._is_loaded is False
+    ses.add(User(id=2, name="Bob", profile=profile))
+    ses.commit()
+    assert profile._is_loaded is False
+    assert ses.get(User, 2).profile == Profile(dob="2021-01-01")
+
+    # copy 和 pickle 得到的还是代理, 并且和原来的互相独立
+    ses.expire(user)
+    profile = user.profile
+    for clone in [copy.copy(profile), copy.deepcopy(profile), pickle.loads(pickle.dumps(profile))]:
+        assert type(clone) is LazyAttrs
+        assert clone._is_loaded is False
+        assert clone == profile
+    profile.dob = "2022-02-02"
+    for clone in [copy.copy(profile), copy.deepcopy(profile), pickle.loads(pickle.dumps(profile))]:
+        assert type(clone) is LazyAttrs
+        assert clone == Profile(dob="2022-02-02")
+        clone.dob = "2023-03-03"
+        assert profile.dob == "2022-02-02"
+    # 访问 __dict__ 得到的是 attrs 对象的实例属性, 不是类的
+    assert profile.__dict__ == {"dob": "2022-02-02"}
+    ses.expire(user)
+    assert hasattr(user.profile, "__clause_element__") is False
+    assert user.profile._is_loaded is False
+
+# --- Benchmark
+N_ROW = 20000
+
+
+@attr.s
+class Document(AttrsJsonColumn):
+    title: str = attr.ib()
+    sections: list = attr.ib()
+
+
+class PostEager(Base, sam.ExtendedBase):
+    """
+    原来的实现: 标准库 json, 每读一行都立即解析.
+    """
+    __tablename__ = "post_eager"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    doc = sa.Column(AttrsJsonType(attrs_class=Document, codec=stdlib_codec, lazy=False))
+
+
+class PostLazy(Base, sam.ExtendedBase):
+    __tablename__ = "post_lazy"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    doc = sa.Column(AttrsJsonType(attrs_class=Document))
+
+
+Base.metadata.create_all(engine)
+
+documents = [
+    Document(
+        title=f"post {i}",
+        sections=[
+            dict(id=j, heading=f"section {j}", text="lorem ipsum " * 10, tags=["a", "b", "c"])
+            for j in range(25)
+        ],
+    )
+    for i in range(N_ROW)
+]
+assert len(documents[0].to_json()) > 4000
+
+for name, klass in [
+    (f"{stdlib_codec.name}", PostEager),
+    (f"{default_codec.name}", PostLazy),
+]:
+    with engine.begin() as conn:
+        st = time.perf_counter()
+        conn.execute(
+            sa.insert(klass),
+            [dict(id=i, name=f"post {i}", doc=doc) for i, doc in enumerate(documents, start=1)],
+        )
+        elapsed = time.perf_counter() - st
+    print(f"write, {name}: {elapsed:.3f} sec")
+
+for title, read in [
+    ("scan name only", lambda post: post.name),
+    ("read payload", lambda post: len(post.doc.sections)),
+]:
+    results = list()
+    for name, klass in [
+        (f"{stdlib_codec.name} eager", PostEager),
+        (f"{default_codec.name} lazy", PostLazy),
+    ]:
+        with Session(engine) as ses:
+            st = time.perf_counter()
+            results.append([read(post) for post in ses.scalars(sa.select(klass))])
+            elapsed = time.perf_counter() - st
+        print(f"{title}, {name}: {elapsed:.3f} sec")
+    assert results[0] == results[1]
+
+# --- JSONB / JSON1: 在数据库端取出和过滤嵌套字段
+N_ARTICLE = 100000
+COUNTRIES = [f"country-{i}" for i in range(100)]
+
+
+@attr.s
+class Author(AttrsJsonColumn):
+    name: str = attr.ib()
+    country: str = attr.ib()
+
+
+@attr.s
+class Paper(AttrsJsonColumn):
+    title: str = attr.ib()
+    year: int = attr.ib()
+    author: Author = attr.ib(converter=Author.from_dict)
+    sections: list = attr.ib(factory=list)
+
+
+class Article(Base, sam.ExtendedBase):
+    __tablename__ = "article"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    paper = sa.Column(AttrsJsonbType(attrs_class=Paper))
+
+    __table_args__ = (
+        # jsonb_path_ops 的 GIN 索引只支持 @>, 但比默认的 jsonb_ops 小很多
+        sa.Index(
+            "ix_article_paper",
+            "paper",
+            postgresql_using="gin",
+            postgresql_ops={"paper": "jsonb_path_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+# SQLite 上用表达式索引, 和 article 表一起创建
+ix_article_author_country = sa.Index(
+    "ix_article_author_country",
+    json_extract(Article.paper, "author.country"),
+).ddl_if(dialect="sqlite")
+
+
+def article_demo(engine: sa.Engine):
+    # 表已经存在时直接报错, 不会删除已有的数据
+    Article.__table__.create(engine)
+    with Session(engine) as ses:
+        ses.add_all([
+            Article(id=1, paper=Paper(title="A", year=2020, author=Author(name="Alice", country="US"))),
+            Article(id=2, paper=Paper(title="B", year=2021, author=Author(name="Bob", country="CN"))),
+            Article(id=3, paper=Paper(title="C", year=2022, author=Author(name="Cathy", country="US"))),
+        ])
+        ses.commit()
+
+        stmt = (
+            sa.select(Article.id, json_extract(Article.paper, "author.name"))
+            .where(json_path_equals(Article.paper, "author.country", "US"))
+            .where(json_extract(Article.paper, "year") >= 2021)
+        )
+        print(stmt.compile(engine))
+        assert ses.execute(stmt).all() == [(3, "Cathy")]
+
+        # 不存在的字段在构造查询时就会报错
+        try:
+            json_extract(Article.paper, "author.email")
+            raise AssertionError
+        except AttributeError:
+            pass
+
+        # list / dict / None 在两种数据库上的语义不同, 不支持
+        for value in [["a"], {"name": "Alice"}, None]:
+            try:
+                json_path_equals(Article.paper, "sections", value)
+                raise AssertionError
+            except ValueError:
+                pass
+
+        article = ses.get(Article, 3)
+        assert article.paper.author.name == "Cathy"
+
+
+article_demo(engine)
+# benchmark 中先去掉索引, 用来对比
+ix_article_author_country.drop(engine)
+
+random.seed(1)
+with engine.begin() as conn:
+    conn.execute(sa.delete(Article))
+    conn.execute(
+        sa.insert(Article),
+        [
+            dict(
+                id=i,
+                paper=Paper(
+                    title=f"paper {i}",
+                    year=random.randint(2000, 2023),
+                    author=Author(name=f"author {i}", country=random.choice(COUNTRIES)),
+                    sections=[
+                        dict(heading=f"section {j}", text="lorem ipsum " * 10)
+                        for j in range(10)
+                    ],
+                ),
+            )
+            for i in range(1, 1 + N_ARTICLE)
+        ],
+    )
+
+where_country = json_path_equals(Article.paper, "author.country", "country-7")
+with engine.connect() as conn:
+    bytes_full = conn.execute(
+        sa.select(sa.func.sum(sa.func.length(sa.cast(Article.paper, sa.UnicodeText))))
+    ).scalar()
+    bytes_title = conn.execute(
+        sa.select(sa.func.sum(sa.func.length(json_extract(Article.paper, "title"))))
+        .where(where_country)
+    ).scalar()
+
+
+def find_titles_in_python():
+    with Session(engine) as ses:
+        return sorted(
+            article.paper.title
+            for article in ses.scalars(sa.select(Article))
+            if article.paper.author.country == "country-7"
+        )
+
+
+def find_titles_in_database():
+    with engine.connect() as conn:
+        return sorted(conn.execute(
+            sa.select(json_extract(Article.paper, "title")).where(where_country)
+        ).scalars())
+
+
+for name, func, n_bytes in [
+    ("python filter", find_titles_in_python, bytes_full),
+    ("server side, no index", find_titles_in_database, bytes_title),
+    ("server side, expression index", find_titles_in_database, bytes_title),
+]:
+    if name == "server side, expression index":
+        ix_article_author_country.create(engine)
+    st = time.perf_counter()
+    titles = func()
+    elapsed = time.perf_counter() - st
+    print(f"{name}: {len(titles)} rows, {elapsed:.3f} sec, {n_bytes / 1024 / 1024:.2f} MB")
+    assert titles == find_titles_in_python()
+
+with engine.connect() as conn:
+    plan = conn.execute(
+        sa.text("EXPLAIN QUERY PLAN " + str(
+            sa.select(json_extract(Article.paper, "title"))
+            .where(where_country)
+            .compile(engine, compile_kwargs=dict(literal_binds=True))
+        ))
+    ).all()
+    print(plan)
+    assert "ix_article_author_country" in plan[0][-1]
+
+try:
+    from learn_sqlalchemy.db import engine_psql
+
+    with engine_psql.connect():
+        pass
+except Exception as e:  # pragma: no cover
+    print(f"skip postgres demo: {e.__class__.__name__}")
+else:
+    # 开发用的数据库中可能已经有 article 表, 所以在一个新建的 schema 中运行, 结束后只删除
+    # 这个 schema. schema 已经存在时 CREATE SCHEMA 会报错, 不会覆盖
+    PSQL_SCHEMA = "article_demo"
+    with engine_psql.begin() as conn:
+        conn.execute(sa.schema.CreateSchema(PSQL_SCHEMA))
+    try:
+        article_demo(engine_psql.execution_options(schema_translate_map={None: PSQL_SCHEMA}))
+    finally:
+        with engine_psql.begin() as conn:
+            conn.execute(sa.schema.DropSchema(PSQL_SCHEMA, cascade=True))
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+``e1`` 中的 ``User.address_count`` 是一个 correlated subquery, 返回的每一行 User 都要执行
+一次这个子查询. 对于 ``selectinload`` 我们很熟悉: 先查出所有的 User, 再用一条
+``WHERE user_id IN (...)`` 的查询把所有 Address 一次性读出来. 本例对 column_property 中的
+聚合也做同样的事:
+
+.. code-block:: python
+
+    stmt = sa.select(User).options(*selectin_aggregate(User.address_count))
+
+1. ``selectin_aggregate`` 返回 ``defer(User.address_count)``, 让主查询中不再包含
+    correlated subquery, 以及一个 ``UserDefinedOption``. 推导 (见第 2 步) 在这时就完成,
+    column_property 不是支持的形式时直接抛出 ``ArgumentError``.
+2. Session 的 ``do_orm_execute`` 事件看到这个 option 后, 先执行主查询, 然后从
+    column_property 的定义中自动推导出的 ``GROUP BY`` 查询::
+
+        SELECT address.user_id, count(address.id)
+        FROM address
+        WHERE address.user_id IN (1, 2, 3, ...)
+        GROUP BY address.user_id
+
+    推导的方法是在子查询的 WHERE 中找到 ``address.user_id = user.id`` 这样的关联条件,
+    把父表那一侧换成已经加载的对象的 key. 和 ``selectinload`` 一样, 每 500 个 key 一条
+    查询. 不重新执行主查询, 所以没有 ORDER BY 的 LIMIT 也不会查到另一批对象.
+3. 用 ``set_committed_value`` 把结果写入对象. GROUP BY 中没有出现的 key (例如没有 Address
+    的 User) 取聚合函数在空集上的值 (count 是 0). 这个值在第一次查询时用 UNION ALL 一起
+    算出来 (``SELECT NULL, count(address.id) FROM address WHERE false``), 不需要额外的查询,
+    之后每个属性都用缓存的值.
+
+注意:
+
+- 目前只支持 WHERE 中有一个 "子表列 = 父表列" 的关联条件的 correlated subquery, 其他
+    条件会原样保留.
+
+5000 个 User, 平均每个 5 个 Address, 结果如下. 和 ``e1`` 一样 ``address.user_id`` 上没有
+索引时, correlated subquery 对每个 User 都要扫描一遍 address 表, 是 O(N * M) 的. 有索引时
+SQLite 在同一条查询里执行 correlated subquery 非常快, 这时多出来的查询和 Python 开销
+反而更慢; 在 PostgreSQL 这类 correlated subquery 代价更高的数据库上, 或者聚合本身比较重时,
+GROUP BY 一次算完才有优势. 查询次数是 1 + User 的个数 / 500::
+
+    no index, correlated subquery: 6.739 sec, 1 queries, 25110 addresses
+    no index, selectin_aggregate: 0.081 sec, 11 queries, 25110 addresses
+    index on address.user_id, correlated subquery: 0.027 sec, 1 queries, 25110 addresses
+    index on address.user_id, selectin_aggregate: 0.058 sec, 11 queries, 25110 addresses
+"""
+
+import typing as T
+import time
+import random
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+
+Base = orm.declarative_base()
+
+
+class Address(Base, sam.ExtendedBase):
+    __tablename__ = "address"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    user_id = sa.Column(sa.Integer, sa.ForeignKey("user.id"))
+
+
+class User(Base, sam.ExtendedBase):
+    __tablename__ = "user"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    address_count = orm.column_property(
+        sa.select(sa.func.count(Address.id)).
+            where(Address.user_id == id).
+            correlate_except(Address).
+            scalar_subquery()
+    )
+    # 没有关联条件, 不能用 selectin_aggregate
+    all_address_count = orm.column_property(
+        sa.select(sa.func.count(Address.id)).scalar_subquery(),
+        deferred=True,
+    )
+
+
+class SelectinAggregate(orm.UserDefinedOption):
+    """
+    payload 是需要批量加载的 column_property 列表.
+    """
+
+
+def selectin_aggregate(*attrs: orm.InstrumentedAttribute) -> T.List[orm.interfaces.ORMOption]:
+    for attr in attrs:
+        _get_aggregate(attr)
+    return [orm.defer(attr) for attr in attrs] + [SelectinAggregate(attrs)]
+
+
+IN_CHUNK_SIZE = 500
+
+
+class _Aggregate:
+    """
+    从 column_property 的 correlated subquery 中推导出来的 GROUP BY 查询.
+    """
+
+    def __init__(self, attr: orm.InstrumentedAttribute):
+        self.key = attr.key
+        self.class_ = attr.class_
+        mapper = orm.class_mapper(attr.class_)
+        prop: orm.ColumnProperty = mapper.attrs[attr.key]
+        select: sa.Select = prop.columns[0].element.element
+        parent_table = mapper.local_table
+
+        criteria = [select.whereclause]
+        if isinstance(select.whereclause, sa.sql.elements.BooleanClauseList):
+            criteria = list(select.whereclause.clauses)
+        self.parent_column = None
+        self.child_column = None
+        self.criteria = list()
+        for criterion in criteria:
+            if (
+                self.parent_column is None
+                and isinstance(criterion, sa.sql.elements.BinaryExpression)
+                and criterion.operator is sa.sql.operators.eq
+            ):
+                left, right = criterion.left, criterion.right
+                if getattr(right, "table", None) is parent_table:
+                    left, right = right, left
+                if (
+                    getattr(left, "table", None) is parent_table
+                    and getattr(right, "table", None) is not parent_table
+                ):
+                    self.parent_column, self.child_column = left, right
+                    continue
+            self.criteria.append(criterion)
+        if self.parent_column is None:
+            raise sa.exc.ArgumentError(
+                f"cannot find the correlation between {parent_table.name!r} "
+                f"and the subquery of {attr}"
+            )
+        self.parent_attr_key = mapper.get_property_by_column(self.parent_column).key
+        self.aggregate = select.selected_columns[0]
+        self._empty_value = None
+        self._has_empty_value = False
+
+        self._stmt = (
+            sa.select(self.child_column.label("key"), self.aggregate.label("value"))
+            .where(*self.criteria)
+            .where(self.child_column.in_(sa.bindparam("aggregate_keys", expanding=True)))
+            .group_by(self.child_column)
+        )
+        # 聚合函数在空集上的值, key 是 NULL. IN 中的 key 不会是 NULL, 不会和它冲突
+        self._stmt_with_empty = sa.union_all(
+            self._stmt,
+            sa.select(sa.null().label("key"), self.aggregate.label("value"))
+            .where(*self.criteria)
+            .where(sa.false()),
+        )
+
+    def load(self, ses: orm.Session, keys: T.List[T.Any]) -> T.Dict[T.Any, T.Any]:
+        """
+        返回 ``{key: 聚合的值}``, 没有出现的 key 用 :meth:`empty_value`.
+        """
+        values = dict()
+        for start in range(0, len(keys), IN_CHUNK_SIZE):
+            chunk = keys[start:start + IN_CHUNK_SIZE]
+            stmt = self._stmt if self._has_empty_value else self._stmt_with_empty
+            for key, value in ses.execute(stmt, dict(aggregate_keys=chunk)):
+                if key is None:
+                    self._empty_value = value
+                    self._has_empty_value = True
+                else:
+                    values[key] = value
+        return values
+
+    def empty_value(self):
+        return self._empty_value
+
+
+_aggregates: T.Dict[orm.InstrumentedAttribute, _Aggregate] = dict()
+
+
+def _get_aggregate(attr: orm.InstrumentedAttribute) -> _Aggregate:
+    if attr not in _aggregates:
+        _aggregates[attr] = _Aggregate(attr)
+    return _aggregates[attr]
+
+
+@event.listens_for(orm.Session, "do_orm_execute")
+def _load_aggregates(orm_execute_state: orm.ORMExecuteState):
+    if not orm_execute_state.is_select:
+        return
+    attrs = [
+        attr
+        for opt in orm_execute_state.user_defined_options
+        if isinstance(opt, SelectinAggregate)
+        for attr in opt.payload
+    ]
+    if not attrs:
+        return
+
+    ses = orm_execute_state.session
+    frozen = orm_execute_state.invoke_statement().freeze()
+    # 用 ses.scalars() 执行时 frozen.data 中的每一行就是对象本身, 而不是 tuple
+    rows = [row if isinstance(row, tuple) else (row,) for row in frozen.data]
+    for attr in attrs:
+        aggregate = _get_aggregate(attr)
+        objects = [
+            obj
+            for row in rows
+            for obj in row
+            if isinstance(obj, aggregate.class_)
+        ]
+        if not objects:
+            continue
+        # 用已经加载的对象的 key, 而不是把主查询再执行一次
+        keys = list(dict.fromkeys(
+            key
+            for key in (getattr(obj, aggregate.parent_attr_key) for obj in objects)
+            if key is not None
+        ))
+        values = aggregate.load(ses, keys)
+        for obj in objects:
+            key = getattr(obj, aggregate.parent_attr_key)
+            if key in values:
+                value = values[key]
+            else:
+                value = aggregate.empty_value()
+            orm.attributes.set_committed_value(obj, aggregate.key, value)
+    return frozen()
+
+
+engine = sam.EngineCreator().create_sqlite()
+Base.metadata.create_all(engine)
+
+n_query = 0
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    global n_query
+    n_query += 1
+
+
+with orm.Session(engine) as ses:
+    ses.add_all([User(id=1), User(id=2), User(id=3)])
+    ses.add_all([
+        Address(id=1, user_id=1),
+        Address(id=2, user_id=1),
+        Address(id=3, user_id=1),
+        Address(id=4, user_id=2),
+        Address(id=5, user_id=2),
+    ])
+    ses.commit()
+
+    stmt = (
+        sa.select(User)
+        .where(User.id >= 2)
+        .order_by(User.id)
+        .options(*selectin_aggregate(User.address_count))
+    )
+    print(stmt.compile(engine))
+    n_query = 0
+    users = ses.scalars(stmt).all()
+    assert n_query == 2  # 主查询, GROUP BY (第一次 UNION ALL 了空集上的 count)
+    assert [(user.id, user.address_count) for user in users] == [(2, 2), (3, 0)]
+    assert n_query == 2  # 访问 address_count 不会再查询
+
+    # 也可以和普通的查询条件, limit 一起用
+    ses.expunge_all()
+    n_query = 0
+    stmt = (
+        sa.select(User)
+        .order_by(User.id.desc())
+        .limit(2)
+        .options(*selectin_aggregate(User.address_count))
+    )
+    users = ses.scalars(stmt).all()
+    assert n_query == 2
+    assert [(user.id, user.address_count) for user in users] == [(3, 0), (2, 2)]
+
+    # 没有 ORDER BY 的 LIMIT, 聚合的是这次实际加载的对象
+    ses.expunge_all()
+    stmt = sa.select(User).limit(1).options(*selectin_aggregate(User.address_count))
+    user = ses.scalars(stmt).one()
+    assert user.address_count == {1: 3, 2: 2, 3: 0}[user.id]
+
+# 找不到关联条件的 column_property 在创建 option 时就报错
+try:
+    selectin_aggregate(User.all_address_count)
+except sa.exc.ArgumentError:
+    pass
+else:  # pragma: no cover
+    raise AssertionError
+
+with engine.begin() as conn:
+    conn.execute(sa.delete(Address))
+    conn.execute(sa.delete(User))
+
+# --- Benchmark
+N_USER = 5000
+
+random.seed(1)
+with engine.begin() as conn:
+    conn.execute(sa.insert(User), [dict(id=i) for i in range(1, 1 + N_USER)])
+    conn.execute(
+        sa.insert(Address),
+        [
+            dict(user_id=user_id)
+            for user_id in range(1, 1 + N_USER)
+            for _ in range(random.randint(0, 10))
+        ],
+    )
+
+
+def benchmark(title: str):
+    global n_query
+    for name, options in [
+        ("correlated subquery", []),
+        ("selectin_aggregate", selectin_aggregate(User.address_count)),
+    ]:
+        elapsed = list()
+        for _ in range(3):
+            with orm.Session(engine) as ses:
+                n_query = 0
+                st = time.perf_counter()
+                users = ses.scalars(sa.select(User).options(*options)).all()
+                total = sum(user.address_count for user in users)
+                elapsed.append(time.perf_counter() - st)
+        print(f"{title}, {name}: {min(elapsed):.3f} sec, {n_query} queries, {total} addresses")
+
+
+benchmark("no index")
+sa.Index("ix_address_user_id", Address.user_id).create(engine)
+benchmark("index on address.user_id")
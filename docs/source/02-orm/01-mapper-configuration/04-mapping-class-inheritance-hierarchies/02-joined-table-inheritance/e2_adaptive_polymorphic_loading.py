@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+"""
+``e1`` 中直接 ``select(Employee)`` 时, 只查询 ``employee`` 表, 访问子类的属性
+(例如 ``Manager.manager_name``) 时每个对象都要再查一次子类的表, 是典型的 N + 1 问题.
+SQLAlchemy 提供了两种一次性加载子类的方法:
+
+- ``with_polymorphic``: 一条查询, 把子类的表全部 LEFT OUTER JOIN 进来. 行数多, 而绝大多数
+    行都不是子类时, 每一行都要付出 JOIN 和解析一堆 NULL 列的代价.
+- ``selectin_polymorphic``: 先查 ``employee``, 再对每个子类用 ``WHERE id IN (...)``
+    (每 500 个一批) 查询子类的表. 只有子类的行付出额外的代价, 但每一行都要再被 ORM
+    处理一次, 而且多了若干次查询.
+
+哪一种更快取决于结果中有多少行, 以及每个子类占多少. :class:`AdaptivePolymorphicLoader`
+对每一种查询记录结果中各子类的行数, 用一个简单的代价模型选择加载方式:
+
+1. 分布按查询条件的结构 (SQLAlchemy 的 cache key, 不含参数的值) 记录, 所以
+    ``company_id == 1`` 和 ``company_id == 2`` 共用一份分布. 最多记录 ``MAX_STATS``
+    种查询, 最近最少使用的先淘汰.
+2. 第一次遇到某种查询时, 用一条 ``SELECT type, count(*) ... GROUP BY type`` 估计.
+    之后直接用上一次结果中观察到的分布, 不再额外查询.
+3. ``with_polymorphic`` 只 JOIN 分布中出现过的子类的表, ``selectin_polymorphic`` 也
+    只加载出现过的子类. 分布中全是 ``Employee`` 时不加载任何子类. 结果中出现了计划
+    之外的子类时, 按子类用一条 IN 查询补齐, 不会退化成逐个对象的 lazy load, 下一次
+    的计划也会包括它.
+4. 选择的结果 (:class:`PolymorphicPlan`) 保存在 ``loader.last_plan`` 中, 也可以用
+    :meth:`AdaptivePolymorphicLoader.plan` 只看计划不执行.
+
+代价模型中的常数是在本地 SQLite 上测出来的 (单位是微秒), 远程数据库的网络往返更贵,
+可以在子类中调整 ``COST_QUERY`` 等常数.
+
+10 万个 Employee, 分成三个 company: company 1 中 5 种类型各占 1/5, company 2 中 96% 是
+``Employee``, company 3 全部是 ``SoftwareEngineer``. 每种方法都访问所有子类的属性. lazy
+只测了前 1000 行, 其他的是整个 company. adaptive 取三次执行中最快的一次. 三个 company
+的查询结构相同, 共用一份分布, 被 company 1 主导, 所以都选了 ``with_polymorphic``. 这是
+按结构记录分布的代价: 对 company 2 来说不是最优, 但不会比最优差很多, 也不会因为参数
+的取值很多而让记录无限增长::
+
+    company 1, 50000 rows:
+        lazy (1000 rows): 0.386 sec, 821 queries
+        with_polymorphic: 0.771 sec, 1 queries
+        selectin_polymorphic: 1.425 sec, 5 queries
+        adaptive: 0.865 sec, 1 queries, with_polymorphic [Engineer, Manager, SoftwareEngineer, HardwareEngineer]
+    company 2, 40000 rows:
+        lazy (1000 rows): 0.018 sec, 39 queries
+        with_polymorphic: 0.523 sec, 1 queries
+        selectin_polymorphic: 0.489 sec, 5 queries
+        adaptive: 0.625 sec, 1 queries, with_polymorphic [Engineer, Manager, SoftwareEngineer, HardwareEngineer]
+    company 3, 10000 rows:
+        lazy (1000 rows): 0.308 sec, 1001 queries
+        with_polymorphic: 0.116 sec, 1 queries
+        selectin_polymorphic: 0.335 sec, 3 queries
+        adaptive: 0.137 sec, 1 queries, with_polymorphic [Engineer, Manager, SoftwareEngineer, HardwareEngineer]
+"""
+
+import typing as T
+import collections
+import math
+import time
+import random
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+
+Base = orm.declarative_base()
+
+
+class Company(Base, sam.ExtendedBase):
+    __tablename__ = "company"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    employees = orm.relationship("Employee", back_populates="company")
+
+
+class Employee(Base, sam.ExtendedBase):
+    __tablename__ = "employee"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    enroll_date = sa.Column(sa.String(50))
+
+    # a special column stores the subclass information
+    type = sa.Column(sa.String(50))
+
+    company_id = sa.Column(sa.ForeignKey("company.id"), index=True)
+    company = orm.relationship("Company", back_populates="employees")
+
+    __mapper_args__ = {
+        "polymorphic_identity": "employee",  # the value for type
+        "polymorphic_on": type
+    }
+
+
+class Engineer(Employee, sam.ExtendedBase):
+    __tablename__ = "engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("employee.id"), primary_key=True)
+    engineer_name = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "engineer",  # the value for type
+    }
+
+
+class Manager(Employee, sam.ExtendedBase):
+    __tablename__ = "manager"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("employee.id"), primary_key=True)
+    manager_name = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "manager",  # the value for type
+    }
+
+
+class SoftwareEngineer(Engineer):
+    __tablename__ = "software_engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("engineer.id"), primary_key=True)
+    programming_language = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "software_engineer",  # the value for type
+    }
+
+
+class HardwareEngineer(Engineer):
+    __tablename__ = "hardware_engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("engineer.id"), primary_key=True)
+    device_platform = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "hardware_engineer",  # the value for type
+    }
+
+
+class PolymorphicPlan:
+    """
+    一次查询的加载方式.
+
+    :param strategy: ``"plain"``, ``"with_polymorphic"`` 或 ``"selectin_polymorphic"``.
+    :param classes: 需要加载的子类.
+    :param n_row: 估计的行数.
+    :param costs: 每种方式的估计代价 (微秒).
+    """
+
+    def __init__(
+        self,
+        strategy: str,
+        classes: T.List[T.Type[Base]],
+        n_row: float,
+        costs: T.Dict[str, float],
+    ):
+        self.strategy = strategy
+        self.classes = classes
+        self.n_row = n_row
+        self.costs = costs
+        # 结果中出现了计划之外的子类, 事后补齐的对象数
+        self.n_missing = 0
+
+    def __repr__(self):
+        classes = ", ".join(klass.__name__ for klass in self.classes)
+        return f"PolymorphicPlan({self.strategy} [{classes}], n_row={self.n_row:.0f})"
+
+
+class AdaptivePolymorphicLoader:
+    """
+    根据观察到的子类分布, 为每种查询选择 ``with_polymorphic`` 或 ``selectin_polymorphic``.
+    """
+
+    # 代价模型的常数, 单位是微秒
+    COST_ROW = 25  # 每个 base 对象
+    COST_JOIN = 2  # with_polymorphic 中每一行每 JOIN 一张表
+    COST_JOIN_MATCH = 8  # with_polymorphic 中子类的行, 每张表
+    COST_SELECTIN_ROW = 60  # selectin_polymorphic 中子类的行
+    COST_QUERY = 200  # 每次查询的往返
+    SELECTIN_BATCH_SIZE = 500
+    MAX_STATS = 1000  # 最多记录多少种查询的分布
+
+    def __init__(self, base: T.Type[Base]):
+        self.base = base
+        self.mapper: orm.Mapper = sa.inspect(base)
+        # 按查询的结构 (不含参数的值) 记录分布, 最近最少使用的先淘汰
+        self.stats: T.Dict[T.Any, T.Dict[str, float]] = collections.OrderedDict()
+        self.last_plan: T.Optional[PolymorphicPlan] = None
+
+    def _stats_key(self, criteria):
+        cache_key = sa.and_(sa.true(), *criteria)._generate_cache_key()
+        if cache_key is None:
+            return None
+        return cache_key.key
+
+    def _get_stats(self, key) -> T.Optional[T.Dict[str, float]]:
+        distribution = self.stats.get(key)
+        if distribution is not None:
+            self.stats.move_to_end(key)
+        return distribution
+
+    def _set_stats(self, key, distribution: T.Dict[str, float]):
+        self.stats[key] = distribution
+        self.stats.move_to_end(key)
+        while len(self.stats) > self.MAX_STATS:
+            self.stats.popitem(last=False)
+
+    def _estimate(self, ses: orm.Session, criteria) -> T.Dict[str, float]:
+        stmt = (
+            sa.select(self.mapper.polymorphic_on, sa.func.count())
+            .where(*criteria)
+            .group_by(self.mapper.polymorphic_on)
+        )
+        return {identity: n for identity, n in ses.execute(stmt)}
+
+    def _observe(self, key, objects: T.List[Base]):
+        counter = collections.Counter(
+            sa.inspect(obj).mapper.polymorphic_identity for obj in objects
+        )
+        old = self._get_stats(key)
+        if old is None:
+            self._set_stats(key, dict(counter))
+        else:
+            # 和上一次的观察取平均, 避免一次异常的结果让计划来回变化
+            self._set_stats(key, {
+                identity: (old.get(identity, 0) + counter.get(identity, 0)) / 2
+                for identity in set(old) | set(counter)
+            })
+
+    def _extra_tables(self, mapper: orm.Mapper) -> T.List[sa.Table]:
+        return [table for table in mapper.tables if table not in self.mapper.tables]
+
+    def _make_plan(self, distribution: T.Dict[str, float]) -> PolymorphicPlan:
+        n_row = sum(distribution.values())
+        mappers = [
+            (mapper, distribution[mapper.polymorphic_identity])
+            for mapper in self.mapper.self_and_descendants
+            if distribution.get(mapper.polymorphic_identity)
+        ]
+        sub_mappers = [(mapper, n) for mapper, n in mappers if mapper is not self.mapper]
+        classes = [mapper.class_ for mapper, _ in sub_mappers]
+        if not sub_mappers:
+            return PolymorphicPlan("plain", [], n_row, dict(plain=n_row * self.COST_ROW))
+
+        tables = {
+            table
+            for mapper, _ in sub_mappers
+            for table in self._extra_tables(mapper)
+        }
+        cost_base = n_row * self.COST_ROW + self.COST_QUERY
+        costs = dict(
+            with_polymorphic=(
+                cost_base
+                + n_row * len(tables) * self.COST_JOIN
+                + sum(
+                    n * len(self._extra_tables(mapper)) * self.COST_JOIN_MATCH
+                    for mapper, n in sub_mappers
+                )
+            ),
+            selectin_polymorphic=(
+                cost_base
+                + sum(
+                    n * self.COST_SELECTIN_ROW
+                    + math.ceil(n / self.SELECTIN_BATCH_SIZE) * self.COST_QUERY
+                    for _, n in sub_mappers
+                )
+            ),
+        )
+        strategy = min(costs, key=costs.get)
+        return PolymorphicPlan(strategy, classes, n_row, costs)
+
+    def plan(self, ses: orm.Session, *criteria) -> PolymorphicPlan:
+        """
+        返回 ``load(ses, *criteria)`` 将会使用的计划, 不执行查询.
+        """
+        key = self._stats_key(criteria)
+        distribution = self._get_stats(key) if key is not None else None
+        if distribution is None:
+            distribution = self._estimate(ses, criteria)
+            if key is not None:
+                self._set_stats(key, distribution)
+        return self._make_plan(distribution)
+
+    def select(self, plan: PolymorphicPlan, *criteria) -> sa.Select:
+        if plan.strategy == "with_polymorphic":
+            entity = orm.with_polymorphic(self.base, plan.classes)
+            return sa.select(entity).where(*criteria)
+        stmt = sa.select(self.base).where(*criteria)
+        if plan.strategy == "selectin_polymorphic":
+            stmt = stmt.options(orm.selectin_polymorphic(self.base, plan.classes))
+        return stmt
+
+    def _load_missing(self, ses: orm.Session, plan: PolymorphicPlan, objects: T.List[Base]) -> int:
+        """
+        分布是按查询的结构记录的, 参数不同时结果中可能出现计划之外的子类. 这些对象
+        按子类用 ``WHERE id IN (...)`` 一次性补齐子类的列, 而不是访问属性时逐个
+        lazy load.
+
+        :return: 补齐的对象数.
+        """
+        planned = set(plan.classes)
+        missing = collections.defaultdict(list)
+        for obj in objects:
+            mapper = sa.inspect(obj).mapper
+            if mapper is not self.mapper and mapper.class_ not in planned:
+                missing[mapper].append(sa.inspect(obj).identity[0])
+        pk = self.mapper.primary_key[0]
+        for mapper, ids in missing.items():
+            for i in range(0, len(ids), self.SELECTIN_BATCH_SIZE):
+                ses.execute(
+                    sa.select(mapper).where(pk.in_(ids[i:i + self.SELECTIN_BATCH_SIZE]))
+                ).all()
+        return sum(len(ids) for ids in missing.values())
+
+    def load(self, ses: orm.Session, *criteria) -> T.List[Base]:
+        plan = self.plan(ses, *criteria)
+        objects = ses.scalars(self.select(plan, *criteria)).all()
+        plan.n_missing = self._load_missing(ses, plan, objects)
+        key = self._stats_key(criteria)
+        if key is not None:
+            self._observe(key, objects)
+        self.last_plan = plan
+        return objects
+
+
+engine = sam.EngineCreator().create_sqlite()
+Base.metadata.create_all(engine)
+
+n_query = 0
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    global n_query
+    n_query += 1
+
+
+def touch(employees: T.List[Employee]) -> int:
+    """
+    访问所有子类的属性.
+    """
+    n = 0
+    for employee in employees:
+        if isinstance(employee, Manager):
+            n += len(employee.manager_name)
+        elif isinstance(employee, SoftwareEngineer):
+            n += len(employee.programming_language)
+        elif isinstance(employee, HardwareEngineer):
+            n += len(employee.device_platform)
+        elif isinstance(employee, Engineer):
+            n += len(employee.engineer_name)
+    return n
+
+
+with orm.Session(engine) as ses:
+    ses.add(Company(id=1, name="Google"))
+    ses.add_all([
+        Employee(id=1, company_id=1),
+        Engineer(id=2, company_id=1, engineer_name="Alice"),
+        Manager(id=3, company_id=1, manager_name="Bob"),
+        Employee(id=4, company_id=1),
+    ])
+    ses.commit()
+
+    loader = AdaptivePolymorphicLoader(Employee)
+
+    # 第一次: 一条 GROUP BY 查询估计分布, 一条查询加载
+    n_query = 0
+    employees = loader.load(ses, Employee.company_id == 1)
+    assert n_query == 2
+    assert loader.last_plan.strategy == "with_polymorphic"
+    assert set(loader.last_plan.classes) == {Engineer, Manager}
+    n_query = 0
+    assert touch(employees) == len("Alice") + len("Bob")
+    assert n_query == 0  # 子类的属性都已经加载了
+
+    # 第二次: 用上一次观察到的分布, 不再估计
+    ses.expunge_all()
+    n_query = 0
+    employees = loader.load(ses, Employee.company_id == 1)
+    assert n_query == 1
+    assert touch(employees) == len("Alice") + len("Bob")
+    assert n_query == 1
+
+    # 结构相同, 参数不同的查询共用同一份分布. company 2 中有计划之外的
+    # SoftwareEngineer, 加载之后按子类一次性补齐, 访问属性时不会再逐个查询
+    ses.add(Company(id=2, name="Apple"))
+    ses.add_all([
+        SoftwareEngineer(id=5, company_id=2, engineer_name="Cathy", programming_language="Python"),
+        SoftwareEngineer(id=6, company_id=2, engineer_name="David", programming_language="Go"),
+        Employee(id=7, company_id=2),
+    ])
+    ses.commit()
+    ses.expunge_all()
+    n_query = 0
+    employees = loader.load(ses, Employee.company_id == 2)
+    assert len(loader.stats) == 1
+    assert loader.last_plan.n_missing == 2
+    assert n_query == 2
+    assert touch(employees) == len("Python") + len("Go")
+    assert n_query == 2
+    # 观察到之后, 计划中就有 SoftwareEngineer 了
+    assert SoftwareEngineer in loader.plan(ses, Employee.company_id == 2).classes
+
+    # 全部是 Employee 时不加载子类
+    plan = loader.plan(ses, Employee.id.in_([1, 4]))
+    assert plan.strategy == "plain"
+    print(plan)
+
+with engine.begin() as conn:
+    for table in reversed(Base.metadata.sorted_tables):
+        conn.execute(table.delete())
+
+# --- Benchmark
+random.seed(1)
+identities = ["employee", "engineer", "manager", "software_engineer", "hardware_engineer"]
+companies = [
+    (1, 50000, [1, 1, 1, 1, 1]),
+    (2, 40000, [96, 1, 1, 1, 1]),
+    (3, 10000, [0, 0, 0, 1, 0]),
+]
+rows = collections.defaultdict(list)
+next_id = 1
+for company_id, n_employee, weights in companies:
+    for identity in random.choices(identities, weights=weights, k=n_employee):
+        rows["employee"].append(dict(
+            id=next_id, enroll_date="2021-01-01", type=identity, company_id=company_id,
+        ))
+        if identity in ("engineer", "software_engineer", "hardware_engineer"):
+            rows["engineer"].append(dict(id=next_id, engineer_name="Alice"))
+        if identity == "manager":
+            rows["manager"].append(dict(id=next_id, manager_name="Bob"))
+        if identity == "software_engineer":
+            rows["software_engineer"].append(dict(id=next_id, programming_language="Python"))
+        if identity == "hardware_engineer":
+            rows["hardware_engineer"].append(dict(id=next_id, device_platform="ARM"))
+        next_id += 1
+
+with engine.begin() as conn:
+    conn.execute(sa.insert(Company), [dict(id=company_id) for company_id, _, _ in companies])
+    for table in Base.metadata.sorted_tables:
+        if rows[table.name]:
+            conn.execute(sa.insert(table), rows[table.name])
+
+subclasses = [Engineer, Manager, SoftwareEngineer, HardwareEngineer]
+loader = AdaptivePolymorphicLoader(Employee)
+
+
+def run(func) -> T.Tuple[float, int, int]:
+    global n_query
+    elapsed = list()
+    for _ in range(3):
+        with orm.Session(engine) as ses:
+            n_query = 0
+            st = time.perf_counter()
+            n = touch(func(ses))
+            elapsed.append(time.perf_counter() - st)
+    return min(elapsed), n_query, n
+
+
+for company_id, n_employee, _ in companies:
+    criteria = Employee.company_id == company_id
+    print(f"company {company_id}, {n_employee} rows:")
+    results = dict()
+    for name, func in [
+        (
+            "lazy (1000 rows)",
+            lambda ses: ses.scalars(sa.select(Employee).where(criteria).limit(1000)).all(),
+        ),
+        (
+            "with_polymorphic",
+            lambda ses: ses.scalars(
+                sa.select(orm.with_polymorphic(Employee, "*")).where(criteria)
+            ).all(),
+        ),
+        (
+            "selectin_polymorphic",
+            lambda ses: ses.scalars(
+                sa.select(Employee).where(criteria)
+                .options(orm.selectin_polymorphic(Employee, subclasses))
+            ).all(),
+        ),
+        (
+            "adaptive",
+            lambda ses: loader.load(ses, criteria),
+        ),
+    ]:
+        elapsed, n_query, n = run(func)
+        results[name] = n
+        plan = ""
+        if name == "adaptive":
+            plan = f", {loader.last_plan.strategy} [{', '.join(klass.__name__ for klass in loader.last_plan.classes)}]"
+        print(f"    {name}: {elapsed:.3f} sec, {n_query} queries{plan}")
+    assert results["with_polymorphic"] == results["selectin_polymorphic"] == results["adaptive"]
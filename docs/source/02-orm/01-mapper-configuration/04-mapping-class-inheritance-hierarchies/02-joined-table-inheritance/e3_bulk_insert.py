@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+
+"""
+``e1`` 中插入一个 ``SoftwareEngineer`` 要写 ``employee``, ``engineer``,
+``software_engineer`` 三张表. ``ses.add_all(...); ses.commit()`` 时 unit of work 会一个
+对象一个对象的处理, 而且子表的行必须等父表的 INSERT 返回自增的 id 之后才能插入, 所以
+``employee`` 表的 INSERT 无法合并成 executemany.
+
+:func:`bulk_insert` 接受一批混合了各种子类的 (transient) 对象:
+
+1. 用 :class:`PrimaryKeyAllocator` 一次性分配一整块 primary key (hi/lo 算法), 写到对象上.
+    id 事先就知道了, 子表的行不再依赖父表 INSERT 的返回值.
+2. 按照每个类的 ``mapper.tables`` 把对象拆成各张表的行. discriminator 列 (``type``)
+    自动填上 ``polymorphic_identity``.
+3. 按表的依赖顺序, 每张表一次 executemany. 没有设置的属性不放进行中, 交给列的 default,
+    所以一张表可能按 "设置了哪些列" 分成几组.
+4. SQLite 上 executemany 直接用 DBAPI cursor 执行, 参数是 tuple. 经过 SQLAlchemy 的
+    ``conn.execute(table.insert(), [dict, ...])`` 时, 每一行都要做一次参数处理, 比 SQLite
+    本身的 executemany 还慢. 只有缺少的列有 Python 端的 default 时才交给 SQLAlchemy.
+    其他数据库一律交给 SQLAlchemy (insertmanyvalues), 因为有的 driver (例如 pg8000) 的
+    executemany 每一行都是一次网络往返.
+
+:class:`PrimaryKeyAllocator` 用一张 ``pk_block`` 表记录每张表下一个可用的 id. 分配时在
+调用者的事务中把 ``next_value`` 加上 block 大小, 多个进程同时写入时也不会拿到重复的 id.
+分配和插入在同一个事务中, 事务回滚时 ``pk_block`` 也一起回滚; allocator 监听这个连接的
+rollback (包括 SAVEPOINT 的 rollback), 丢掉缓存中还没用完的 id, 下次重新分配. 代价是
+``pk_block`` 的这一行会被锁到事务结束, 同一张表的并发写入会排队 (SQLite 的写事务本来就是
+串行的). 第一次分配时的 INSERT 忽略主键冲突 (``ON CONFLICT DO NOTHING``, 其他数据库在
+SAVEPOINT 中捕获 ``IntegrityError``), 再统一 UPDATE, 两个进程同时第一次分配也不会出错.
+注意所有写这张表的程序都要用同一个 allocator (或者同一个数据库 sequence), 不能再依赖
+自增. 没用完的 block 会留下空洞, 这是 hi/lo 算法的代价.
+
+注意: 对象插入后不会被加入 Session, 只是 ``id`` 被赋了值. 如果还需要把它们当作
+persistent 对象使用, 重新查询即可.
+
+100 万个混合子类的对象 (5 种类型各占 1/5) 的结果如下. 构造 ORM 对象本身就要几秒钟, 不计入
+下面的时间. ORM 的两种方法只测了 10 万个. ``bulk_insert`` 的时间一半是 SQLite 的
+executemany, 另一半是把对象拆成 tuple 的 Python 代码, 已经没有 ORM flush 的开销了::
+
+    orm flush, 100000 objects: 7.082 sec
+    orm bulk insert per class, 100000 objects: 1.399 sec
+    bulk_insert, 1000000 objects: 6.658 sec (rows 3.505 sec, executemany 2.943 sec)
+"""
+
+import typing as T
+import collections
+import operator
+import random
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+from sqlalchemy.dialects import postgresql, sqlite
+import sqlalchemy_mate as sam
+
+Base = orm.declarative_base()
+
+
+class Company(Base, sam.ExtendedBase):
+    __tablename__ = "company"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String(50))
+    employees = orm.relationship("Employee", back_populates="company")
+
+
+class Employee(Base, sam.ExtendedBase):
+    __tablename__ = "employee"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    enroll_date = sa.Column(sa.String(50), default="2000-01-01")
+
+    # a special column stores the subclass information
+    type = sa.Column(sa.String(50))
+
+    company_id = sa.Column(sa.ForeignKey("company.id"))
+    company = orm.relationship("Company", back_populates="employees")
+
+    __mapper_args__ = {
+        "polymorphic_identity": "employee",  # the value for type
+        "polymorphic_on": type
+    }
+
+
+class Engineer(Employee, sam.ExtendedBase):
+    __tablename__ = "engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("employee.id"), primary_key=True)
+    engineer_name = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "engineer",  # the value for type
+    }
+
+
+class Manager(Employee, sam.ExtendedBase):
+    __tablename__ = "manager"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("employee.id"), primary_key=True)
+    manager_name = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "manager",  # the value for type
+    }
+
+
+class SoftwareEngineer(Engineer):
+    __tablename__ = "software_engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("engineer.id"), primary_key=True)
+    programming_language = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "software_engineer",  # the value for type
+    }
+
+
+class HardwareEngineer(Engineer):
+    __tablename__ = "hardware_engineer"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("engineer.id"), primary_key=True)
+    device_platform = sa.Column(sa.String(30))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "hardware_engineer",  # the value for type
+    }
+
+
+pk_block = sa.Table(
+    "pk_block",
+    Base.metadata,
+    sa.Column("name", sa.String(64), primary_key=True),
+    sa.Column("next_value", sa.Integer, nullable=False),
+)
+
+
+class PrimaryKeyAllocator:
+    """
+    按 block 分配整数 primary key.
+
+    :param table: 需要分配 id 的表, 对于 joined table inheritance 是最顶层的表.
+    :param block_size: 每次从数据库拿多少个 id.
+    """
+
+    def __init__(self, table: sa.Table, block_size: int = 10000):
+        self.name = table.name
+        self.column = table.primary_key.columns[0]
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+
+    def _insert_block_row(self, conn: sa.Connection):
+        """
+        第一次分配时插入 ``pk_block`` 的行, 从表中当前最大的 id 之后开始. 两个进程可能同时
+        发现行不存在, 后插入的那个忽略冲突, 之后统一用 UPDATE 分配.
+        """
+        start = sa.select(sa.func.coalesce(sa.func.max(self.column), 0) + 1).scalar_subquery()
+        dialect_name = conn.dialect.name
+        if dialect_name in ("postgresql", "sqlite"):
+            insert = {
+                "postgresql": postgresql.insert,
+                "sqlite": sqlite.insert,
+            }[dialect_name]
+            conn.execute(
+                insert(pk_block)
+                .values(name=self.name, next_value=start)
+                .on_conflict_do_nothing(index_elements=[pk_block.c.name])
+            )
+        else:
+            try:
+                with conn.begin_nested():
+                    conn.execute(sa.insert(pk_block).values(name=self.name, next_value=start))
+            except sa.exc.IntegrityError:
+                pass
+
+    def _allocate_block(self, conn: sa.Connection, n: int) -> T.Tuple[int, int]:
+        where = pk_block.c.name == self.name
+        update = (
+            sa.update(pk_block)
+            .where(where)
+            .values(next_value=pk_block.c.next_value + n)
+        )
+        if not conn.execute(update).rowcount:
+            self._insert_block_row(conn)
+            conn.execute(update)
+        end = conn.execute(sa.select(pk_block.c.next_value).where(where)).scalar()
+        # 这个 block 要等 conn 的事务提交才算数, 回滚了就不能再用
+        event.listen(conn, "rollback", self._discard)
+        event.listen(conn, "rollback_savepoint", self._discard)
+        return end - n, end
+
+    def _discard(self, conn: sa.Connection, *args):
+        self._next = self._end = 0
+
+    def allocate(self, conn: sa.Connection, n: int) -> range:
+        """
+        :param conn: 用这个连接当前的事务更新 ``pk_block``, 通常就是插入数据的连接.
+        """
+        if self._end - self._next < n:
+            self._next, self._end = self._allocate_block(conn, max(n, self.block_size))
+        ids = range(self._next, self._next + n)
+        self._next += n
+        return ids
+
+
+class _ClassPlan:
+    """
+    每个类要写哪些表, 每张表的列对应哪个属性.
+    """
+
+    def __init__(self, klass: T.Type[Base], pk_column: sa.Column):
+        mapper: orm.Mapper = sa.inspect(klass)
+        self.pk_key = mapper.get_property_by_column(pk_column).key
+        self.polymorphic_on = mapper.polymorphic_on
+        self.polymorphic_identity = mapper.polymorphic_identity
+        self.tables = list()
+        for table in mapper.tables:
+            columns = [
+                (column.key, mapper.get_property_by_column(column).key)
+                for column in table.columns
+            ]
+            attr_keys = [attr_key for _, attr_key in columns]
+            self.tables.append((
+                table,
+                columns,
+                tuple(column_key for column_key, _ in columns),
+                set(attr_keys),
+                # 所有列都有值时, 用 itemgetter 一次取出整行
+                operator.itemgetter(*attr_keys) if len(attr_keys) > 1 else (
+                    lambda values, key=attr_keys[0]: (values[key],)
+                ),
+            ))
+
+
+_plans: T.Dict[T.Type[Base], _ClassPlan] = dict()
+
+
+def _get_plan(klass: T.Type[Base], pk_column: sa.Column) -> _ClassPlan:
+    if klass not in _plans:
+        _plans[klass] = _ClassPlan(klass, pk_column)
+    return _plans[klass]
+
+
+def _executemany(
+    conn: sa.Connection,
+    table: sa.Table,
+    keys: T.Tuple[str, ...],
+    rows: T.List[tuple],
+):
+    """
+    SQLite 上用 DBAPI cursor 直接 executemany, 跳过 SQLAlchemy 对每一行参数的处理.
+    没有提供的列如果有 Python 端的 default, 就只能交给 SQLAlchemy 处理.
+
+    其他数据库的 DBAPI executemany 不一定更快, 例如 pg8000 每一行都要一次网络往返, 所以交给
+    SQLAlchemy, 它会用 insertmanyvalues 把多行合并成一条 INSERT ... VALUES.
+    """
+    if conn.dialect.name != "sqlite" or any(
+        column.default is not None and column.key not in keys
+        for column in table.columns
+    ):
+        conn.execute(table.insert(), [dict(zip(keys, row)) for row in rows])
+        return
+
+    dialect = conn.dialect
+    compiled = table.insert().compile(dialect=dialect, column_keys=list(keys))
+    processors = [
+        table.c[key].type.dialect_impl(dialect).bind_processor(dialect)
+        for key in keys
+    ]
+    if any(processors):
+        rows = [
+            tuple(value if proc is None else proc(value) for proc, value in zip(processors, row))
+            for row in rows
+        ]
+    if compiled.positiontup is None:
+        params = [dict(zip(keys, row)) for row in rows]
+    elif list(compiled.positiontup) == list(keys):
+        params = rows
+    else:  # pragma: no cover
+        index = [keys.index(key) for key in compiled.positiontup]
+        params = [tuple(row[i] for i in index) for row in rows]
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.executemany(str(compiled), params)
+    finally:
+        cursor.close()
+
+
+def bulk_insert(
+    conn: sa.Connection,
+    objects: T.Iterable[Base],
+    allocator: PrimaryKeyAllocator,
+) -> T.Dict[str, float]:
+    """
+    把一批 joined table inheritance 的对象插入数据库, 每张表一次 executemany.
+
+    :return: 拆分成行和执行 executemany 分别用的时间, 用于分析性能.
+    """
+    st = time.perf_counter()
+    objects = list(objects)
+    plans = [_get_plan(type(obj), allocator.column) for obj in objects]
+    no_pk = [
+        (obj, plan)
+        for obj, plan in zip(objects, plans)
+        if obj.__dict__.get(plan.pk_key) is None
+    ]
+    for (obj, plan), pk in zip(no_pk, allocator.allocate(conn, len(no_pk))):
+        # 对象是 transient 的, 直接写入 __dict__, 省掉 attribute event 的开销
+        obj.__dict__[plan.pk_key] = pk
+
+    rows: T.Dict[T.Tuple[sa.Table, T.Tuple[str, ...]], T.List[tuple]] = collections.defaultdict(list)
+    for obj, plan in zip(objects, plans):
+        values = obj.__dict__
+        if plan.polymorphic_on is not None:
+            values[plan.polymorphic_on.key] = plan.polymorphic_identity
+        for table, columns, all_keys, attr_keys, getter in plan.tables:
+            if values.keys() >= attr_keys:
+                rows[table, all_keys].append(getter(values))
+            else:
+                keys = tuple(column_key for column_key, attr_key in columns if attr_key in values)
+                rows[table, keys].append(tuple(
+                    values[attr_key] for _, attr_key in columns if attr_key in values
+                ))
+    elapsed_rows = time.perf_counter() - st
+
+    st = time.perf_counter()
+    tables = sa.schema.sort_tables({table for table, _ in rows})
+    order = {table: i for i, table in enumerate(tables)}
+    for (table, keys), table_rows in sorted(rows.items(), key=lambda item: order[item[0][0]]):
+        _executemany(conn, table, keys, table_rows)
+    elapsed_executemany = time.perf_counter() - st
+    return dict(rows=elapsed_rows, executemany=elapsed_executemany)
+
+
+engine = sam.EngineCreator().create_sqlite()
+Base.metadata.create_all(engine)
+
+with engine.begin() as conn:
+    conn.execute(sa.insert(Company), [dict(id=1, name="Google")])
+
+allocator = PrimaryKeyAllocator(Employee.__table__, block_size=3)
+objects = [
+    SoftwareEngineer(company_id=1, engineer_name="Alice", programming_language="Python"),
+    Manager(company_id=1, enroll_date="2021-01-02", manager_name="Bob"),
+    Employee(company_id=1),
+    HardwareEngineer(id=100, company_id=1, engineer_name="David", device_platform="ARM"),
+    Engineer(company_id=1, enroll_date="2021-01-05", engineer_name="Eve"),
+]
+with engine.begin() as conn:
+    bulk_insert(conn, objects, allocator)
+assert [obj.id for obj in objects] == [1, 2, 3, 100, 4]
+
+with orm.Session(engine) as ses:
+    employees = ses.scalars(
+        sa.select(orm.with_polymorphic(Employee, "*")).order_by(Employee.id)
+    ).all()
+    assert [type(employee) for employee in employees] == [
+        SoftwareEngineer, Manager, Employee, Engineer, HardwareEngineer,
+    ]
+    assert employees[0].programming_language == "Python"
+    assert employees[0].engineer_name == "Alice"
+    assert employees[0].enroll_date == "2000-01-01"  # 没有设置的列用了 default
+    assert employees[1].enroll_date == "2021-01-02"
+    assert employees[4].device_platform == "ARM"
+
+# 第一次分配了 1 ~ 4, 再分配一个 block 5 ~ 7. 第二次 bulk_insert 不会访问 pk_block
+with engine.begin() as conn:
+    bulk_insert(conn, [Manager(company_id=1)], allocator)
+    bulk_insert(conn, [Manager(company_id=1)], allocator)
+    assert conn.execute(sa.select(Manager.__table__.c.id)).scalars().all() == [2, 5, 6]
+    assert conn.execute(sa.select(pk_block.c.next_value)).scalar() == 8
+
+# 分配新 block 的事务回滚了, 插入的行和 pk_block 的更新一起回滚, 缓存中的 8 ~ 10 也被丢掉
+try:
+    with engine.begin() as conn:
+        bulk_insert(conn, [Manager(company_id=1), Manager(company_id=1)], allocator)
+        assert conn.execute(sa.select(pk_block.c.next_value)).scalar() == 11
+        raise ValueError
+except ValueError:
+    pass
+with engine.begin() as conn:
+    assert conn.execute(sa.select(Manager.__table__.c.id)).scalars().all() == [2, 5, 6]
+    assert conn.execute(sa.select(pk_block.c.next_value)).scalar() == 8
+    bulk_insert(conn, [Manager(company_id=1)], allocator)
+    assert conn.execute(sa.select(Manager.__table__.c.id)).scalars().all() == [2, 5, 6, 8]
+
+with engine.begin() as conn:
+    for table in reversed(Base.metadata.sorted_tables):
+        if table.name != "company":
+            conn.execute(table.delete())
+
+# --- Benchmark
+N_OBJECT = 1000000
+N_OBJECT_ORM = 100000
+
+random.seed(1)
+
+
+def make_objects(n: int) -> T.List[Employee]:
+    factories = [
+        lambda: Employee(company_id=1, enroll_date="2021-01-01"),
+        lambda: Engineer(company_id=1, enroll_date="2021-01-01", engineer_name="Alice"),
+        lambda: Manager(company_id=1, enroll_date="2021-01-01", manager_name="Bob"),
+        lambda: SoftwareEngineer(
+            company_id=1, enroll_date="2021-01-01",
+            engineer_name="Cathy", programming_language="Python",
+        ),
+        lambda: HardwareEngineer(
+            company_id=1, enroll_date="2021-01-01",
+            engineer_name="David", device_platform="ARM",
+        ),
+    ]
+    return [random.choice(factories)() for _ in range(n)]
+
+
+def reset():
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            if table.name != "company":
+                conn.execute(table.delete())
+
+
+objects = make_objects(N_OBJECT_ORM)
+with orm.Session(engine) as ses:
+    st = time.perf_counter()
+    ses.add_all(objects)
+    ses.commit()
+    elapsed = time.perf_counter() - st
+print(f"orm flush, {N_OBJECT_ORM} objects: {elapsed:.3f} sec")
+reset()
+
+# SQLAlchemy 2.0 的 ORM bulk insert, 每个类一次, id 事先分配好
+objects = make_objects(N_OBJECT_ORM)
+allocator = PrimaryKeyAllocator(Employee.__table__, block_size=100000)
+with engine.begin() as conn:
+    ids = allocator.allocate(conn, len(objects))
+by_class = collections.defaultdict(list)
+for obj, pk in zip(objects, ids):
+    by_class[type(obj)].append(dict(
+        id=pk,
+        **{
+            key: value
+            for key, value in obj.__dict__.items()
+            if not key.startswith("_")
+        },
+    ))
+with orm.Session(engine) as ses:
+    st = time.perf_counter()
+    for klass, dicts in by_class.items():
+        ses.execute(sa.insert(klass), dicts)
+    ses.commit()
+    elapsed = time.perf_counter() - st
+print(f"orm bulk insert per class, {N_OBJECT_ORM} objects: {elapsed:.3f} sec")
+reset()
+
+objects = make_objects(N_OBJECT)
+allocator = PrimaryKeyAllocator(Employee.__table__, block_size=100000)
+st = time.perf_counter()
+with engine.begin() as conn:
+    timing = bulk_insert(conn, objects, allocator)
+elapsed = time.perf_counter() - st
+print(
+    f"bulk_insert, {N_OBJECT} objects: {elapsed:.3f} sec "
+    f"(rows {timing['rows']:.3f} sec, executemany {timing['executemany']:.3f} sec)"
+)
+
+with engine.connect() as conn:
+    n_employee = conn.execute(sa.select(sa.func.count()).select_from(Employee.__table__)).scalar()
+    n_software_engineer = conn.execute(
+        sa.select(sa.func.count()).select_from(SoftwareEngineer.__table__)
+    ).scalar()
+    assert n_employee == N_OBJECT
+    assert n_software_engineer == sum(type(obj) is SoftwareEngineer for obj in objects)
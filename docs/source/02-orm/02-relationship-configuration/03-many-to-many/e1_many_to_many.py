@@ -4,11 +4,12 @@ import sqlalchemy as sa
 import sqlalchemy.orm as orm
 import sqlalchemy_mate as sam
 from learn_sqlalchemy.db import engine_sqlite as engine
+from learn_sqlalchemy.base import SqliteWithoutRowidMixin
 
 Base = orm.declarative_base()
 
 
-class ExtendedBase(Base, sam.ExtendedBase):
+class ExtendedBase(Base, sam.ExtendedBase, SqliteWithoutRowidMixin):
     __abstract__ = True
 
 
@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+
+"""
+对于图分析类的应用, 每分钟要跑成千上万次遍历, 即使是 ``e2`` 中的 Recursive CTE 也
+太慢了. 这时候可以把整个关联表读到内存中, 用 NumPy 存成 CSR (Compressed Sparse Row)
+格式::
+
+    indptr:  int32[n_node + 1], 节点 i 的邻居是 indices[indptr[i]:indptr[i + 1]]
+    indices: int32[n_edge], 所有的邻居按起点排好序首尾相连
+
+正向 (我关注的人) 和反向 (关注我的人) 各存一份, 每条边只占 2 x 4 = 8 个字节. 查邻居
+就是一次数组切片, 微秒级. BFS 的每一层用 NumPy 向量化操作一次性展开整个 frontier.
+
+知识点:
+
+1. 用 ``fetchmany`` 分批流式的读关联表, 直接写入预先分配好的 int32 数组, 内存中
+    同时最多只有一批 Python tuple.
+2. 监听 Session 的 ``after_flush`` 事件, 收集通过 ORM 新增和删除的边 (见
+    ``edge_history.py``). 增量按事务分别记录: SAVEPOINT 提交时合并到外层事务,
+    回滚时只丢弃这个 SAVEPOINT 中的增量, 最外层事务提交时才合并到缓存中. 缓存中的
+    增量先放在一个小的 overlay 中, 超过阈值或者需要做向量化计算时再重建 CSR 数组.
+3. 注意绕过 ORM 的写入 (例如 Core 的 ``insert(table)``) 不会触发这些事件, 需要手动
+    调用 :meth:`CSRGraph.reload`.
+
+节点的 id 直接作为数组的下标, 所以要求 id 是比较紧凑的非负整数. 自增主键正好满足.
+
+在 10 万个节点, 100 万条边的随机图上的结果如下::
+
+    load 1000000 edges in 2.189 sec, 8.4 MB, 8.80 bytes per edge
+    neighbors: 1.060 us per lookup
+    bfs by sql: 3 hops, 5.549 ms per start
+    bfs by csr: 3 hops, 0.434 ms per start
+"""
+
+import typing as T
+import random
+import time
+
+import numpy as np
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+
+from edge_history import T_EDGE, EdgeHistory, merge_delta
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+class UserAndUserSubscription(ExtendedBase):
+    __tablename__ = "asso_user_and_subscription"
+
+    subscriber_user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("user.user_id"),
+        primary_key=True,
+    )
+    publisher_user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("user.user_id"),
+        primary_key=True,
+    )
+
+
+class User(ExtendedBase):
+    __tablename__ = "user"
+
+    user_id = sa.Column(sa.Integer, primary_key=True)
+
+    user_i_subscribed = orm.relationship(
+        "User",
+        secondary=UserAndUserSubscription.__table__,
+        primaryjoin=user_id == UserAndUserSubscription.subscriber_user_id,
+        secondaryjoin=user_id == UserAndUserSubscription.publisher_user_id,
+        back_populates="user_who_subscribe_me",
+    )
+    user_who_subscribe_me = orm.relationship(
+        "User",
+        secondary=UserAndUserSubscription.__table__,
+        primaryjoin=user_id == UserAndUserSubscription.publisher_user_id,
+        secondaryjoin=user_id == UserAndUserSubscription.subscriber_user_id,
+        back_populates="user_i_subscribed",
+    )
+
+
+EMPTY = np.empty(0, dtype=np.int32)
+
+T_DELTA = T.Tuple[T.Set[T_EDGE], T.Set[T_EDGE]]
+
+
+def _build(
+    src: np.ndarray,
+    dst: np.ndarray,
+    n_node: int,
+) -> T.Tuple[np.ndarray, np.ndarray]:
+    """
+    把边列表 (src[i], dst[i]) 转换成 CSR 格式的 (indptr, indices).
+    """
+    order = np.lexsort((dst, src))
+    indices = dst[order].astype(np.int32)
+    indptr = np.zeros(n_node + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n_node), out=indptr[1:])
+    return indptr, indices
+
+
+def _gather(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    nodes: np.ndarray,
+) -> np.ndarray:
+    """
+    一次性取出 nodes 中所有节点的邻居, 拼接成一个数组 (可能有重复).
+    """
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return EMPTY
+    # 第 j 个邻居在 indices 中的位置 = 它所属节点的 start + 它在该节点内的序号
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return indices[offsets + np.arange(total, dtype=np.int32)]
+
+
+class CSRGraph:
+    """
+    一个 Self Many to Many 关联表的内存 CSR 缓存.
+
+    :param src: 边的起点, 例如 ``UserAndUserSubscription.subscriber_user_id``.
+    :param dst: 边的终点, 例如 ``UserAndUserSubscription.publisher_user_id``.
+    :param max_delta: overlay 中的增量超过这么多条边就重建 CSR 数组.
+    """
+
+    def __init__(
+        self,
+        src: orm.InstrumentedAttribute,
+        dst: orm.InstrumentedAttribute,
+        max_delta: int = 10000,
+    ):
+        self.src = src
+        self.dst = dst
+        self.max_delta = max_delta
+
+        self.n_node = 0
+        self.out_indptr = np.zeros(1, dtype=np.int32)
+        self.out_indices = EMPTY
+        self.in_indptr = np.zeros(1, dtype=np.int32)
+        self.in_indices = EMPTY
+
+        # 已提交但还没有合并到 CSR 数组中的增量
+        self._added: T.Set[T_EDGE] = set()
+        self._removed: T.Set[T_EDGE] = set()
+        self._added_out: T.Dict[int, T.Set[int]] = dict()
+        self._added_in: T.Dict[int, T.Set[int]] = dict()
+        self._removed_out: T.Dict[int, T.Set[int]] = dict()
+        self._removed_in: T.Dict[int, T.Set[int]] = dict()
+
+    # --- Load
+    def reload(self, conn: sa.Connection, chunk_size: int = 100000):
+        """
+        从数据库流式的读取整个关联表, 重建缓存.
+        """
+        n_edge = conn.execute(
+            sa.select(sa.func.count()).select_from(self.src.class_)
+        ).scalar_one()
+        src = np.empty(n_edge, dtype=np.int32)
+        dst = np.empty(n_edge, dtype=np.int32)
+        # 这里直接用 DBAPI 的 cursor. 把 sqlalchemy 的 Row 对象转换成 NumPy 数组
+        # 比转换普通的 tuple 慢 20 倍以上, 对于几百万行的表这个差别就是几十秒.
+        stmt = sa.select(self.src, self.dst)
+        compiled = stmt.compile(dialect=conn.dialect)
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.execute(str(compiled))
+            i = 0
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                chunk = np.array(rows, dtype=np.int32).reshape(-1, 2)
+                src[i:i + len(chunk)] = chunk[:, 0]
+                dst[i:i + len(chunk)] = chunk[:, 1]
+                i += len(chunk)
+        finally:
+            cursor.close()
+        self._set_edges(src, dst)
+        self._clear_delta()
+
+    def _set_edges(self, src: np.ndarray, dst: np.ndarray):
+        n_node = 0
+        if len(src):
+            n_node = int(max(src.max(), dst.max())) + 1
+        self.n_node = n_node
+        self.out_indptr, self.out_indices = _build(src, dst, n_node)
+        self.in_indptr, self.in_indices = _build(dst, src, n_node)
+
+    def _edges(self) -> T.Tuple[np.ndarray, np.ndarray]:
+        src = np.repeat(
+            np.arange(self.n_node, dtype=np.int32),
+            np.diff(self.out_indptr),
+        )
+        return src, self.out_indices
+
+    @property
+    def n_edge(self) -> int:
+        return len(self.out_indices) + len(self._added) - len(self._removed)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.out_indptr.nbytes
+            + self.out_indices.nbytes
+            + self.in_indptr.nbytes
+            + self.in_indices.nbytes
+        )
+
+    # --- Delta
+    def _clear_delta(self):
+        self._added.clear()
+        self._removed.clear()
+        self._added_out.clear()
+        self._added_in.clear()
+        self._removed_out.clear()
+        self._removed_in.clear()
+
+    def apply_delta(
+        self,
+        added: T.Iterable[T_EDGE],
+        removed: T.Iterable[T_EDGE],
+    ):
+        """
+        合并一批已经提交的增量.
+        """
+        for edge in removed:
+            if edge in self._added:
+                self._added.discard(edge)
+                self._added_out[edge[0]].discard(edge[1])
+                self._added_in[edge[1]].discard(edge[0])
+            else:
+                self._removed.add(edge)
+                self._removed_out.setdefault(edge[0], set()).add(edge[1])
+                self._removed_in.setdefault(edge[1], set()).add(edge[0])
+        for edge in added:
+            if edge in self._removed:
+                self._removed.discard(edge)
+                self._removed_out[edge[0]].discard(edge[1])
+                self._removed_in[edge[1]].discard(edge[0])
+            else:
+                self._added.add(edge)
+                self._added_out.setdefault(edge[0], set()).add(edge[1])
+                self._added_in.setdefault(edge[1], set()).add(edge[0])
+        if len(self._added) + len(self._removed) > self.max_delta:
+            self.compact()
+
+    def compact(self):
+        """
+        把 overlay 中的增量合并到 CSR 数组中.
+        """
+        if not (self._added or self._removed):
+            return
+        src, dst = self._edges()
+        if self._removed:
+            n = max(self.n_node, 1)
+            keys = src.astype(np.int64) * n + dst
+            removed = np.array(list(self._removed), dtype=np.int64).reshape(-1, 2)
+            removed_keys = removed[:, 0] * n + removed[:, 1]
+            keep = ~np.isin(keys, removed_keys)
+            src, dst = src[keep], dst[keep]
+        if self._added:
+            added = np.array(list(self._added), dtype=np.int32).reshape(-1, 2)
+            src = np.concatenate([src, added[:, 0]])
+            dst = np.concatenate([dst, added[:, 1]])
+        self._set_edges(src, dst)
+        self._clear_delta()
+
+    def listen(self, target=orm.Session):
+        """
+        监听 Session 的事件, 自动把通过 ORM 提交的增量合并到缓存中.
+
+        :param target: ``orm.Session`` 类, 一个 ``sessionmaker`` 或者一个 Session 实例.
+        """
+        history = EdgeHistory(self.src, self.dst)
+
+        def deltas(ses: orm.Session) -> T.Dict[orm.SessionTransaction, T_DELTA]:
+            return ses.info.setdefault(id(self), dict())
+
+        def current(ses: orm.Session) -> orm.SessionTransaction:
+            return ses.get_nested_transaction() or ses.get_transaction()
+
+        @event.listens_for(target, "after_flush")
+        def after_flush(ses: orm.Session, flush_context):
+            added, removed = history.collect(ses)
+            delta = deltas(ses).setdefault(current(ses), (set(), set()))
+            merge_delta(delta, added, removed)
+
+        # SAVEPOINT 提交 (RELEASE) 的时候也会触发 after_commit, 这时只是把增量合并到
+        # 外层事务中. 只有最外层事务提交时才合并到缓存中.
+        @event.listens_for(target, "after_commit")
+        def after_commit(ses: orm.Session):
+            transaction = current(ses)
+            added, removed = deltas(ses).pop(transaction, (set(), set()))
+            if transaction.nested:
+                parent = transaction.parent
+                while not (parent.parent is None or parent.nested):
+                    parent = parent.parent
+                delta = deltas(ses).setdefault(parent, (set(), set()))
+                merge_delta(delta, added, removed)
+            else:
+                self.apply_delta(added, removed)
+
+        # 没有提交就结束的事务 (rollback, 回滚到 SAVEPOINT, 或者直接 close) 的增量
+        # 都丢弃. 最外层事务结束时清空所有的增量.
+        @event.listens_for(target, "after_transaction_end")
+        def after_transaction_end(ses: orm.Session, transaction: orm.SessionTransaction):
+            if transaction.parent is None:
+                ses.info.pop(id(self), None)
+            elif id(self) in ses.info:
+                ses.info[id(self)].pop(transaction, None)
+
+    # --- Query
+    def _neighbors(
+        self,
+        node: int,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        added: T.Dict[int, T.Set[int]],
+        removed: T.Dict[int, T.Set[int]],
+    ) -> np.ndarray:
+        if node < self.n_node:
+            result = indices[indptr[node]:indptr[node + 1]]
+        else:
+            result = EMPTY
+        if node in added or node in removed:
+            others = set(result.tolist())
+            others.difference_update(removed.get(node, ()))
+            others.update(added.get(node, ()))
+            result = np.array(sorted(others), dtype=np.int32)
+        return result
+
+    def neighbors(self, node: int) -> np.ndarray:
+        """
+        node 指向的所有节点, 例如我关注的所有人.
+        """
+        return self._neighbors(
+            node, self.out_indptr, self.out_indices,
+            self._added_out, self._removed_out,
+        )
+
+    def in_neighbors(self, node: int) -> np.ndarray:
+        """
+        指向 node 的所有节点, 例如关注我的所有人.
+        """
+        return self._neighbors(
+            node, self.in_indptr, self.in_indices,
+            self._added_in, self._removed_in,
+        )
+
+    def degree(self, node: int) -> int:
+        return len(self.neighbors(node))
+
+    def in_degree(self, node: int) -> int:
+        return len(self.in_neighbors(node))
+
+    def degrees(self) -> np.ndarray:
+        """
+        所有节点的出度, 下标就是节点 id.
+        """
+        self.compact()
+        return np.diff(self.out_indptr)
+
+    def in_degrees(self) -> np.ndarray:
+        """
+        所有节点的入度, 下标就是节点 id.
+        """
+        self.compact()
+        return np.diff(self.in_indptr)
+
+    def bfs(
+        self,
+        start: int,
+        max_depth: T.Optional[int] = None,
+        reverse: bool = False,
+    ) -> np.ndarray:
+        """
+        向量化的 BFS.
+
+        :param reverse: 为 True 时沿着反方向遍历 (关注我的人).
+
+        :return: 每个节点到 start 的最短跳数, 下标就是节点 id. 到不了的是 -1,
+            start 自己是 0.
+        """
+        self.compact()
+        if reverse:
+            indptr, indices = self.in_indptr, self.in_indices
+        else:
+            indptr, indices = self.out_indptr, self.out_indices
+        dist = np.full(max(self.n_node, start + 1), -1, dtype=np.int32)
+        dist[start] = 0
+        if start >= self.n_node:
+            return dist
+        frontier = np.array([start], dtype=np.int32)
+        depth = 0
+        while len(frontier) and (max_depth is None or depth < max_depth):
+            depth += 1
+            nodes = np.unique(_gather(indptr, indices, frontier))
+            frontier = nodes[dist[nodes] == -1]
+            dist[frontier] = depth
+        return dist
+
+
+def bfs_by_sql(ses: orm.Session, start: int, max_depth: int) -> T.Dict[int, int]:
+    """
+    对照组, 每一层用一次 IN 查询.
+    """
+    result = {start: 0}
+    frontier = [start]
+    for depth in range(1, max_depth + 1):
+        stmt = sa.select(UserAndUserSubscription.publisher_user_id).where(
+            UserAndUserSubscription.subscriber_user_id.in_(frontier)
+        )
+        frontier = list()
+        for node in ses.scalars(stmt):
+            if node not in result:
+                result[node] = depth
+                frontier.append(node)
+    return result
+
+
+Base.metadata.create_all(engine)
+
+graph = CSRGraph(
+    src=UserAndUserSubscription.subscriber_user_id,
+    dst=UserAndUserSubscription.publisher_user_id,
+)
+graph.listen(orm.Session)
+
+with orm.Session(engine) as ses:
+    ses.add_all([User(user_id=user_id) for user_id in range(1, 1 + 6)])
+    ses.add_all([
+        UserAndUserSubscription(subscriber_user_id=1, publisher_user_id=2),
+        UserAndUserSubscription(subscriber_user_id=1, publisher_user_id=3),
+        UserAndUserSubscription(subscriber_user_id=2, publisher_user_id=3),
+        UserAndUserSubscription(subscriber_user_id=3, publisher_user_id=4),
+    ])
+    ses.commit()
+
+with engine.connect() as conn:
+    graph.reload(conn)
+
+assert graph.neighbors(1).tolist() == [2, 3]
+assert graph.in_neighbors(3).tolist() == [1, 2]
+assert graph.degree(1) == 2
+assert graph.in_degree(3) == 2
+assert graph.neighbors(6).tolist() == []
+assert graph.bfs(1).tolist() == [-1, 0, 1, 1, 2]
+assert graph.bfs(4, reverse=True).tolist() == [-1, 2, 2, 1, 0]
+
+# 通过 ORM 的增量会自动合并到缓存中
+with orm.Session(engine) as ses:
+    # 直接操作关联表的 ORM 对象
+    ses.add(UserAndUserSubscription(subscriber_user_id=4, publisher_user_id=5))
+    edge = ses.get(UserAndUserSubscription, (1, 2))
+    ses.delete(edge)
+    # 通过 relationship 操作
+    user3 = ses.get(User, 3)
+    user6 = ses.get(User, 6)
+    user3.user_who_subscribe_me.append(user6)
+    ses.commit()
+
+assert graph.neighbors(1).tolist() == [3]
+assert graph.neighbors(4).tolist() == [5]
+assert graph.neighbors(6).tolist() == [3]
+assert graph.in_neighbors(3).tolist() == [1, 2, 6]
+assert graph.in_degree(2) == 0
+assert graph.n_edge == 5
+
+# rollback 的增量会被丢弃
+with orm.Session(engine) as ses:
+    ses.add(UserAndUserSubscription(subscriber_user_id=5, publisher_user_id=6))
+    ses.flush()
+    ses.rollback()
+
+assert graph.neighbors(5).tolist() == []
+
+# 没有提交就 close 的增量也会被丢弃
+with orm.Session(engine) as ses:
+    ses.add(UserAndUserSubscription(subscriber_user_id=5, publisher_user_id=6))
+    ses.flush()
+
+assert graph.neighbors(5).tolist() == []
+
+# 回滚 SAVEPOINT 只丢弃 SAVEPOINT 中的增量, 外层事务 flush 的增量在提交后仍然生效
+with orm.Session(engine) as ses:
+    ses.add(UserAndUserSubscription(subscriber_user_id=5, publisher_user_id=1))
+    ses.flush()
+    savepoint = ses.begin_nested()
+    ses.add(UserAndUserSubscription(subscriber_user_id=5, publisher_user_id=2))
+    ses.flush()
+    savepoint.rollback()
+    with ses.begin_nested():
+        ses.add(UserAndUserSubscription(subscriber_user_id=5, publisher_user_id=3))
+    # SAVEPOINT 已经提交, 但外层事务还没有提交
+    assert graph.neighbors(5).tolist() == []
+    ses.delete(ses.get(UserAndUserSubscription, (5, 1)))
+    ses.commit()
+
+assert graph.neighbors(5).tolist() == [3]
+
+with orm.Session(engine) as ses:
+    ses.delete(ses.get(UserAndUserSubscription, (5, 3)))
+    ses.commit()
+
+assert graph.neighbors(5).tolist() == []
+assert graph.bfs(6).tolist() == [-1, -1, -1, 1, 2, 3, 0]
+assert graph.degrees().tolist() == [0, 1, 1, 1, 1, 0, 1]
+
+with engine.connect() as conn:
+    graph.reload(conn)
+assert graph.bfs(6).tolist() == [-1, -1, -1, 1, 2, 3, 0]
+
+with orm.Session(engine) as ses:
+    ses.execute(sa.delete(UserAndUserSubscription))
+    ses.execute(sa.delete(User))
+    ses.commit()
+
+# --- Benchmark
+N_NODE = 100_000
+N_EDGE = 1_000_000
+N_LOOKUP = 100_000
+N_START = 20
+K = 3
+
+random.seed(1)
+
+with orm.Session(engine) as ses:
+    ses.execute(
+        sa.insert(User.__table__),
+        [dict(user_id=user_id) for user_id in range(1, 1 + N_NODE)],
+    )
+    edges = set()
+    while len(edges) < N_EDGE:
+        subscriber_user_id = random.randint(1, N_NODE)
+        publisher_user_id = random.randint(1, N_NODE)
+        if subscriber_user_id != publisher_user_id:
+            edges.add((subscriber_user_id, publisher_user_id))
+    ses.execute(
+        sa.insert(UserAndUserSubscription.__table__),
+        [
+            dict(subscriber_user_id=s, publisher_user_id=p)
+            for s, p in edges
+        ],
+    )
+    ses.commit()
+    del edges
+
+with engine.connect() as conn:
+    st = time.perf_counter()
+    graph.reload(conn)
+    elapsed = time.perf_counter() - st
+bytes_per_edge = graph.nbytes / graph.n_edge
+print(
+    f"load {graph.n_edge} edges in {elapsed:.3f} sec, "
+    f"{graph.nbytes / 1024 / 1024:.1f} MB, {bytes_per_edge:.2f} bytes per edge"
+)
+assert bytes_per_edge < 10
+
+nodes = [random.randint(1, N_NODE) for _ in range(N_LOOKUP)]
+st = time.perf_counter()
+for node in nodes:
+    graph.neighbors(node)
+elapsed = time.perf_counter() - st
+print(f"neighbors: {elapsed / N_LOOKUP * 1000000:.3f} us per lookup")
+
+starts = random.sample(range(1, 1 + N_NODE), N_START)
+with orm.Session(engine) as ses:
+    st = time.perf_counter()
+    expected = [bfs_by_sql(ses, start, K) for start in starts]
+    elapsed = time.perf_counter() - st
+    print(f"bfs by sql: {K} hops, {elapsed / N_START * 1000:.3f} ms per start")
+
+st = time.perf_counter()
+results = [graph.bfs(start, K) for start in starts]
+elapsed = time.perf_counter() - st
+print(f"bfs by csr: {K} hops, {elapsed / N_START * 1000:.3f} ms per start")
+
+for dist, result in zip(results, expected):
+    nodes = np.nonzero(dist >= 0)[0]
+    assert dict(zip(nodes.tolist(), dist[nodes].tolist())) == result
@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+
+"""
+有些查询, 例如 "A 是不是 B 的下游", "B 的所有祖先", 会被非常频繁的执行. 在 ``e2`` 中
+我们用 Recursive CTE 来回答这些问题, 但每次都要重新遍历一次图.
+
+Closure Table (传递闭包表) 是用空间换时间的做法. 对于图中的每一对 ``(祖先, 后代)``,
+只要祖先能走到后代, 就在闭包表中存一行. 于是:
+
+- "A 是不是 B 的下游" = 闭包表主键上的一次查找.
+- "B 的所有后代" = 闭包表主键上的一次范围扫描.
+- "A 的所有祖先" = ``(descendant, ancestor)`` 索引上的一次范围扫描.
+
+闭包表只适用于有向无环图 (DAG), 也就是组织架构, 目录, 分类这样的包含关系. 本例为
+分类的层级关系 ``CategoryAndSubCategory`` 实现了一个可选的闭包表 :class:`ClosureTable`:
+
+1. 闭包表中除了 ``(ancestor, descendant)`` 之外还记录了 ``n_path``, 即从祖先到后代有
+    多少条不同的路径. 新增边 ``a -> b`` 时, 对于 a 的每个祖先 x (包括 a) 和 b 的每个
+    后代 y (包括 b), ``n_path(x, y) += n_path(x, a) * n_path(b, y)``. 删除边时减掉同样
+    的数量, 减到 0 的行删除. 有了路径数, 删除边时不需要重新遍历图就知道哪些祖先关系
+    还成立.
+2. 上面的增量都是两条预先构造好的 ``UPDATE`` / ``INSERT ... SELECT`` / ``DELETE`` 语句,
+    在 Session 的 ``after_flush`` 事件中和边的写入在同一个事务里执行.
+3. :meth:`ClosureTable.rebuild` 一次性重建整个闭包表, 适合第一次上线, 或是有绕过 ORM
+    的批量写入之后. 它按路径长度逐层累加路径数, 而不是逐条枚举路径, 所以在菱形很多
+    的 DAG 上也不会指数膨胀.
+
+在层级关系中形成环的边是脏数据, 所以 :class:`ClosureTable` 会抛出 :class:`CycleError`
+让整个 flush 回滚, ``rebuild`` 遇到环也会抛出同样的异常. 不要把它用在互相关注这种
+本来就有环的图上 (例如 ``UserAndUserSubscription``), 那会拒绝正常的写入. 这类图请
+使用 ``e2`` 的 Recursive CTE 或者 ``e3`` 的内存缓存.
+
+另外绕过 ORM 的写入 (例如 Core 的 ``insert(table)``) 不会触发 ``after_flush``, 写完之后
+需要调用 :meth:`ClosureTable.rebuild`.
+
+在一个 1 万个节点, 每个节点有 1 ~ 2 个上级的随机层级上的结果如下. 写放大是每条边
+要写 "祖先数 x 后代数" 行闭包表, 换来的是读快了 40 倍::
+
+    rebuild: 11009 edges, 119498 closure rows, 1.345 sec
+    insert edge without closure: 0.272 ms per edge, 0.0 closure rows per edge
+    insert edge with closure: 0.657 ms per edge, 13.0 closure rows per edge
+    delete edge with closure: 2.202 ms per edge, 48.6 closure rows per edge
+    is_reachable by recursive CTE: 1534.7 us per check
+    is_reachable by closure table: 40.0 us per check
+"""
+
+import typing as T
+import random
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+
+from edge_history import T_EDGE, EdgeHistory
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+class CategoryAndSubCategory(ExtendedBase):
+    __tablename__ = "asso_category_and_sub_category"
+
+    parent_category_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("category.category_id"),
+        primary_key=True,
+    )
+    child_category_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("category.category_id"),
+        primary_key=True,
+    )
+
+
+class ClosureCategoryAndSubCategory(ExtendedBase):
+    """
+    ``CategoryAndSubCategory`` 的闭包表. 边的方向是 parent -> child, 所以
+    ancestor 是上级分类, descendant 是下级分类.
+    """
+
+    __tablename__ = "closure_category_and_sub_category"
+
+    ancestor_category_id = sa.Column(sa.Integer, primary_key=True)
+    descendant_category_id = sa.Column(sa.Integer, primary_key=True)
+    n_path = sa.Column(sa.Integer, nullable=False)
+
+    __table_args__ = (
+        sa.Index(
+            "ix_closure_category_and_sub_category_descendant",
+            "descendant_category_id",
+            "ancestor_category_id",
+        ),
+    )
+
+
+class Category(ExtendedBase):
+    __tablename__ = "category"
+
+    category_id = sa.Column(sa.Integer, primary_key=True)
+
+    sub_categories = orm.relationship(
+        "Category",
+        secondary=CategoryAndSubCategory.__table__,
+        primaryjoin=category_id == CategoryAndSubCategory.parent_category_id,
+        secondaryjoin=category_id == CategoryAndSubCategory.child_category_id,
+        back_populates="parent_categories",
+    )
+    parent_categories = orm.relationship(
+        "Category",
+        secondary=CategoryAndSubCategory.__table__,
+        primaryjoin=category_id == CategoryAndSubCategory.child_category_id,
+        secondaryjoin=category_id == CategoryAndSubCategory.parent_category_id,
+        back_populates="sub_categories",
+    )
+
+
+class CycleError(ValueError):
+    pass
+
+
+class ClosureTable:
+    """
+    为一个 Self Many to Many 的关联表维护一个闭包表.
+
+    :param src: 边的起点, 例如 ``CategoryAndSubCategory.parent_category_id``.
+    :param dst: 边的终点, 例如 ``CategoryAndSubCategory.child_category_id``.
+    :param closure: 闭包表的 ORM 类, 前三列依次是 ancestor, descendant, n_path.
+    """
+
+    def __init__(
+        self,
+        src: orm.InstrumentedAttribute,
+        dst: orm.InstrumentedAttribute,
+        closure: T.Type[ExtendedBase],
+    ):
+        self.src = src
+        self.dst = dst
+        self.table = closure.__table__
+        self.c_ancestor, self.c_descendant, self.c_n_path = list(self.table.c)[:3]
+
+        # 新增 / 删除边 a -> b 所影响的 (x, y, n_path(x, a) * n_path(b, y))
+        a = sa.bindparam("a", type_=sa.Integer)
+        b = sa.bindparam("b", type_=sa.Integer)
+        ancestors = sa.union_all(
+            sa.select(a.label("node"), sa.literal(1).label("n")),
+            sa.select(self.c_ancestor, self.c_n_path).where(self.c_descendant == a),
+        ).subquery("ancestors")
+        descendants = sa.union_all(
+            sa.select(b.label("node"), sa.literal(1).label("n")),
+            sa.select(self.c_descendant, self.c_n_path).where(self.c_ancestor == b),
+        ).subquery("descendants")
+        pairs = (
+            sa.select(
+                ancestors.c.node.label("ancestor"),
+                descendants.c.node.label("descendant"),
+                (ancestors.c.n * descendants.c.n).label("n_path"),
+            )
+            .select_from(ancestors.join(descendants, sa.true()))
+            .subquery("pairs")
+        )
+        in_pairs = sa.tuple_(self.c_ancestor, self.c_descendant).in_(
+            sa.select(pairs.c.ancestor, pairs.c.descendant)
+        )
+        delta = (
+            sa.select(pairs.c.n_path)
+            .where(
+                pairs.c.ancestor == self.c_ancestor,
+                pairs.c.descendant == self.c_descendant,
+            )
+            .scalar_subquery()
+        )
+        # 没有用 ON CONFLICT DO UPDATE, 一是各个数据库的语法不同, 二是 SQLAlchemy
+        # 不缓存 SQLite 的 ON CONFLICT 语句的编译结果, 每次都要重新编译.
+        # 改为先 UPDATE 已有的行, 再 INSERT 还不存在的行.
+        self._stmt_increase = (
+            sa.update(self.table)
+            .values({self.c_n_path: self.c_n_path + delta})
+            .where(in_pairs)
+        )
+        self._stmt_insert_new = sa.insert(self.table).from_select(
+            [self.c_ancestor, self.c_descendant, self.c_n_path],
+            sa.select(pairs).where(
+                ~sa.exists().where(
+                    self.c_ancestor == pairs.c.ancestor,
+                    self.c_descendant == pairs.c.descendant,
+                )
+            ),
+        )
+        # 删除边: 先减路径数, 再删掉减到 0 的行
+        self._stmt_decrease = (
+            sa.update(self.table)
+            .values({self.c_n_path: self.c_n_path - delta})
+            .where(in_pairs)
+        )
+        self._stmt_delete_zero = sa.delete(self.table).where(
+            in_pairs, self.c_n_path <= 0
+        )
+        # rebuild 用的临时表, 存放某一层的 (起点, 终点, 路径数)
+        frontier = sa.Table(
+            f"tmp_{self.table.name}_frontier",
+            sa.MetaData(),
+            sa.Column("level", sa.Integer, primary_key=True),
+            sa.Column("ancestor", sa.Integer, primary_key=True),
+            sa.Column("descendant", sa.Integer, primary_key=True),
+            sa.Column("n_path", sa.Integer, nullable=False),
+            prefixes=["TEMPORARY"],
+        )
+        self._frontier = frontier
+        level = sa.bindparam("level", type_=sa.Integer)
+        in_level = sa.and_(
+            frontier.c.level == level,
+            frontier.c.ancestor == self.c_ancestor,
+            frontier.c.descendant == self.c_descendant,
+        )
+        self._stmt_rebuild_increase = (
+            sa.update(self.table)
+            .values({
+                self.c_n_path: self.c_n_path
+                + sa.select(frontier.c.n_path).where(in_level).scalar_subquery()
+            })
+            .where(sa.exists().where(in_level))
+        )
+        self._stmt_rebuild_insert_new = sa.insert(self.table).from_select(
+            [self.c_ancestor, self.c_descendant, self.c_n_path],
+            sa.select(frontier.c.ancestor, frontier.c.descendant, frontier.c.n_path)
+            .where(
+                frontier.c.level == level,
+                ~sa.exists().where(
+                    self.c_ancestor == frontier.c.ancestor,
+                    self.c_descendant == frontier.c.descendant,
+                ),
+            ),
+        )
+        self._stmt_rebuild_next_level = sa.insert(frontier).from_select(
+            list(frontier.c),
+            sa.select(
+                level + 1,
+                frontier.c.ancestor,
+                self.dst,
+                sa.func.sum(frontier.c.n_path),
+            )
+            .join(self.src.class_, self.src == frontier.c.descendant)
+            .where(frontier.c.level == level)
+            .group_by(frontier.c.ancestor, self.dst),
+        )
+        self._stmt_is_reachable = sa.select(sa.literal(1)).where(
+            self.c_ancestor == sa.bindparam("ancestor"),
+            self.c_descendant == sa.bindparam("descendant"),
+        )
+
+    # --- Maintenance
+    def add_edge(self, conn: sa.Connection, a: int, b: int):
+        """
+        新增边 a -> b 之后调用.
+        """
+        if a == b or self.is_reachable(conn, b, a):
+            raise CycleError(f"edge {a} -> {b} creates a cycle")
+        params = dict(a=a, b=b)
+        conn.execute(self._stmt_increase, params)
+        conn.execute(self._stmt_insert_new, params)
+
+    def remove_edge(self, conn: sa.Connection, a: int, b: int):
+        """
+        删除边 a -> b 之后调用.
+        """
+        params = dict(a=a, b=b)
+        conn.execute(self._stmt_decrease, params)
+        conn.execute(self._stmt_delete_zero, params)
+
+    def rebuild(self, conn: sa.Connection):
+        """
+        一次性重建闭包表.
+
+        按路径长度一层一层的计算: 第 k 层是所有长度为 k 的路径按 (起点, 终点) 汇总的
+        路径数, 由第 k - 1 层和边表 join 之后求和得到, 然后累加到闭包表中. 每一层的
+        行数不超过闭包表的行数, 不会像逐条枚举路径那样在菱形很多的 DAG 上指数膨胀.
+        层数超过节点数说明图中有环, 抛出 :class:`CycleError`.
+        """
+        frontier = self._frontier
+        frontier.create(conn, checkfirst=True)
+        conn.execute(sa.delete(frontier))
+        conn.execute(sa.delete(self.table))
+        conn.execute(
+            sa.insert(frontier).from_select(
+                list(frontier.c),
+                sa.select(sa.literal(0), self.src, self.dst, sa.func.count())
+                .group_by(self.src, self.dst),
+            )
+        )
+        nodes = sa.union(sa.select(self.src), sa.select(self.dst)).subquery()
+        n_node = conn.execute(sa.select(sa.func.count()).select_from(nodes)).scalar()
+        has_frontier = sa.select(sa.exists().where(frontier.c.level == sa.bindparam("level")))
+        level = 0
+        while conn.execute(has_frontier, dict(level=level)).scalar():
+            if level >= n_node:
+                raise CycleError(f"{self.src.class_.__name__} contains a cycle")
+            params = dict(level=level)
+            conn.execute(self._stmt_rebuild_increase, params)
+            conn.execute(self._stmt_rebuild_insert_new, params)
+            conn.execute(self._stmt_rebuild_next_level, params)
+            conn.execute(sa.delete(frontier).where(frontier.c.level == level))
+            level += 1
+        frontier.drop(conn)
+
+    def listen(self, target=orm.Session):
+        """
+        监听 Session 的 ``after_flush`` 事件, 在同一个事务中维护闭包表.
+
+        :param target: ``orm.Session`` 类, 一个 ``sessionmaker`` 或者一个 Session 实例.
+        """
+        history = EdgeHistory(self.src, self.dst)
+
+        @event.listens_for(target, "after_flush")
+        def after_flush(ses: orm.Session, flush_context):
+            added, removed = history.collect(ses)
+            conn = ses.connection()
+            for a, b in sorted(removed):
+                self.remove_edge(conn, a, b)
+            for a, b in sorted(added):
+                self.add_edge(conn, a, b)
+
+    # --- Query
+    def is_reachable(self, conn: T.Union[sa.Connection, orm.Session], ancestor: int, descendant: int) -> bool:
+        """
+        能否从 ancestor 走到 descendant, 例如 descendant 是不是 ancestor 的下游.
+        """
+        params = dict(ancestor=ancestor, descendant=descendant)
+        return conn.execute(self._stmt_is_reachable, params).first() is not None
+
+    def ancestors(self, conn: T.Union[sa.Connection, orm.Session], node: int) -> T.List[int]:
+        stmt = sa.select(self.c_ancestor).where(self.c_descendant == node)
+        return conn.execute(stmt).scalars().all()
+
+    def descendants(self, conn: T.Union[sa.Connection, orm.Session], node: int) -> T.List[int]:
+        stmt = sa.select(self.c_descendant).where(self.c_ancestor == node)
+        return conn.execute(stmt).scalars().all()
+
+
+closure = ClosureTable(
+    src=CategoryAndSubCategory.parent_category_id,
+    dst=CategoryAndSubCategory.child_category_id,
+    closure=ClosureCategoryAndSubCategory,
+)
+# 只有用这个 sessionmaker 创建的 Session 才会维护闭包表
+SessionWithClosure = orm.sessionmaker(engine)
+closure.listen(SessionWithClosure)
+
+
+def dump(conn: T.Union[sa.Connection, orm.Session]) -> T.Dict[T_EDGE, int]:
+    stmt = sa.select(ClosureCategoryAndSubCategory.__table__)
+    return {(a, d): n for a, d, n in conn.execute(stmt)}
+
+
+Base.metadata.create_all(engine)
+
+#      1
+#     / \
+#    2   3
+#     \ / \
+#      4   5
+with SessionWithClosure() as ses:
+    ses.add_all([Category(category_id=category_id) for category_id in range(1, 1 + 5)])
+    ses.add_all([
+        CategoryAndSubCategory(parent_category_id=1, child_category_id=2),
+        CategoryAndSubCategory(parent_category_id=1, child_category_id=3),
+        CategoryAndSubCategory(parent_category_id=2, child_category_id=4),
+    ])
+    ses.commit()
+    # 通过 relationship 新增边
+    category3 = ses.get(Category, 3)
+    category3.sub_categories.extend([ses.get(Category, 4), ses.get(Category, 5)])
+    ses.commit()
+
+    assert dump(ses) == {
+        (1, 2): 1, (1, 3): 1, (1, 4): 2, (1, 5): 1,
+        (2, 4): 1,
+        (3, 4): 1, (3, 5): 1,
+    }
+    assert closure.is_reachable(ses, 1, 4) is True
+    assert closure.is_reachable(ses, 2, 5) is False
+    assert sorted(closure.ancestors(ses, 4)) == [1, 2, 3]
+    assert sorted(closure.descendants(ses, 1)) == [2, 3, 4, 5]
+
+    # 删除 2 -> 4 之后 1 仍然可以通过 3 走到 4
+    ses.delete(ses.get(CategoryAndSubCategory, (2, 4)))
+    ses.commit()
+    assert closure.is_reachable(ses, 1, 4) is True
+    assert closure.is_reachable(ses, 2, 4) is False
+    assert dump(ses)[(1, 4)] == 1
+
+    # 会形成环的边, 整个 flush 会回滚
+    ses.add(CategoryAndSubCategory(parent_category_id=5, child_category_id=1))
+    try:
+        ses.commit()
+        raise AssertionError
+    except CycleError:
+        ses.rollback()
+    assert ses.get(CategoryAndSubCategory, (5, 1)) is None
+
+with engine.begin() as conn:
+    expected = dump(conn)
+    closure.rebuild(conn)
+    assert dump(conn) == expected
+
+# 绕过 ORM 写入的环, rebuild 时会被发现
+try:
+    with engine.begin() as conn:
+        conn.execute(
+            sa.insert(CategoryAndSubCategory.__table__),
+            dict(parent_category_id=5, child_category_id=1),
+        )
+        closure.rebuild(conn)
+    raise AssertionError
+except CycleError:
+    pass
+
+# 30 层, 每层 2 个节点, 相邻两层之间两两相连. 第一层到最后一层有 2 ** 28 条路径,
+# 逐条枚举路径是不可能的, 逐层累加路径数只需要 29 轮
+with engine.begin() as conn:
+    conn.execute(sa.delete(CategoryAndSubCategory))
+    conn.execute(
+        sa.insert(Category.__table__),
+        [dict(category_id=category_id) for category_id in range(6, 60 + 1)],
+    )
+    conn.execute(
+        sa.insert(CategoryAndSubCategory.__table__),
+        [
+            dict(parent_category_id=parent, child_category_id=child)
+            for layer in range(29)
+            for parent in [2 * layer + 1, 2 * layer + 2]
+            for child in [2 * layer + 3, 2 * layer + 4]
+        ],
+    )
+    closure.rebuild(conn)
+    assert dump(conn)[(1, 59)] == 2 ** 28
+    assert len(closure.descendants(conn, 1)) == 58
+
+with engine.begin() as conn:
+    conn.execute(sa.delete(ClosureCategoryAndSubCategory))
+    conn.execute(sa.delete(CategoryAndSubCategory))
+    conn.execute(sa.delete(Category))
+
+# --- Benchmark
+# 一个随机的层级关系: 每个节点有一个随机的上级, 10% 的节点还有第二个上级.
+N_NODE = 10000
+N_NEW_NODE = 1000
+N_DELETE = 200
+N_READ = 10000
+
+random.seed(1)
+
+
+def random_parents(category_id: int) -> T.Set[int]:
+    n = 2 if random.random() < 0.1 else 1
+    return {random.randint(1, category_id - 1) for _ in range(n)}
+
+
+with engine.begin() as conn:
+    conn.execute(
+        sa.insert(Category.__table__),
+        [dict(category_id=category_id) for category_id in range(1, 1 + N_NODE + N_NEW_NODE)],
+    )
+    conn.execute(
+        sa.insert(CategoryAndSubCategory.__table__),
+        [
+            dict(parent_category_id=parent, child_category_id=category_id)
+            for category_id in range(2, 1 + N_NODE)
+            for parent in random_parents(category_id)
+        ],
+    )
+    st = time.perf_counter()
+    closure.rebuild(conn)
+    elapsed = time.perf_counter() - st
+    n_edge = conn.execute(sa.select(sa.func.count()).select_from(CategoryAndSubCategory)).scalar()
+    n_closure = conn.execute(sa.select(sa.func.count()).select_from(ClosureCategoryAndSubCategory)).scalar()
+    print(f"rebuild: {n_edge} edges, {n_closure} closure rows, {elapsed:.3f} sec")
+
+# 写放大: 逐个 flush 新的边, 对比维护 / 不维护闭包表的耗时和写入的闭包表行数
+new_edges = [
+    (parent, category_id)
+    for category_id in range(1 + N_NODE, 1 + N_NODE + N_NEW_NODE)
+    for parent in random_parents(category_id)
+]
+for name, session_factory in [
+    ("without closure", orm.sessionmaker(engine)),
+    ("with closure", SessionWithClosure),
+]:
+    with session_factory() as ses:
+        n_closure_before = ses.scalar(sa.select(sa.func.count()).select_from(ClosureCategoryAndSubCategory))
+        st = time.perf_counter()
+        for parent, category_id in new_edges:
+            ses.add(CategoryAndSubCategory(parent_category_id=parent, child_category_id=category_id))
+            ses.flush()
+        elapsed = time.perf_counter() - st
+        n_closure_after = ses.scalar(sa.select(sa.func.count()).select_from(ClosureCategoryAndSubCategory))
+        print(
+            f"insert edge {name}: {elapsed / len(new_edges) * 1000:.3f} ms per edge, "
+            f"{(n_closure_after - n_closure_before) / len(new_edges):.1f} closure rows per edge"
+        )
+        if name == "without closure":
+            ses.rollback()
+        else:
+            ses.commit()
+
+with SessionWithClosure() as ses:
+    edges = ses.execute(sa.select(CategoryAndSubCategory.__table__)).all()
+    n_closure_before = ses.scalar(sa.select(sa.func.count()).select_from(ClosureCategoryAndSubCategory))
+    st = time.perf_counter()
+    for a, b in random.sample(edges, N_DELETE):
+        ses.delete(ses.get(CategoryAndSubCategory, (a, b)))
+        ses.flush()
+    elapsed = time.perf_counter() - st
+    n_closure_after = ses.scalar(sa.select(sa.func.count()).select_from(ClosureCategoryAndSubCategory))
+    ses.commit()
+    print(
+        f"delete edge with closure: {elapsed / N_DELETE * 1000:.3f} ms per edge, "
+        f"{(n_closure_before - n_closure_after) / N_DELETE:.1f} closure rows per edge"
+    )
+
+# 增量维护的结果必须和重建的结果完全一致
+with engine.begin() as conn:
+    expected = dump(conn)
+    closure.rebuild(conn)
+    assert dump(conn) == expected
+
+# 读: 闭包表上的一次主键查找 vs Recursive CTE
+reach = (
+    sa.select(CategoryAndSubCategory.child_category_id.label("node"))
+    .where(CategoryAndSubCategory.parent_category_id == sa.bindparam("ancestor"))
+    .cte("reach", recursive=True)
+)
+reach = reach.union(
+    sa.select(CategoryAndSubCategory.child_category_id)
+    .join(reach, CategoryAndSubCategory.parent_category_id == reach.c.node)
+)
+stmt_reach = sa.select(sa.literal(1)).where(reach.c.node == sa.bindparam("descendant")).limit(1)
+
+pairs = [
+    (random.randint(1, 100), random.randint(1, N_NODE + N_NEW_NODE))
+    for _ in range(N_READ)
+]
+with engine.connect() as conn:
+    st = time.perf_counter()
+    expected = [
+        conn.execute(stmt_reach, dict(ancestor=a, descendant=d)).first() is not None
+        for a, d in pairs
+    ]
+    elapsed = time.perf_counter() - st
+    print(f"is_reachable by recursive CTE: {elapsed / N_READ * 1000000:.1f} us per check")
+
+    st = time.perf_counter()
+    results = [closure.is_reachable(conn, a, d) for a, d in pairs]
+    elapsed = time.perf_counter() - st
+    print(f"is_reachable by closure table: {elapsed / N_READ * 1000000:.1f} us per check")
+    assert results == expected
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""
+关联表用 SQLite 的 WITHOUT ROWID 存储.
+
+SQLite 的普通表是一个以 rowid 为 key 的 B-tree. 关联表的主键是 ``(question_id, tag_id)``,
+SQLite 会再为主键建一个 ``sqlite_autoindex`` 索引, 于是同样的两列数据被存了两次, 而 rowid
+本身从来不会被用到. ``WITHOUT ROWID`` 的表直接以主键为 key 组织 B-tree, 只存一份数据.
+另外 WITHOUT ROWID 表上的二级索引保存的是主键而不是 rowid, 所以反向的 ``(tag_id)`` 索引
+本身就包含 ``question_id``, 是覆盖索引, 不需要回表.
+
+SQLAlchemy 的 SQLite 方言原生支持 ``sqlite_with_rowid=False`` 这个表参数, 其他方言会忽略它.
+:mod:`learn_sqlalchemy.base` 中的 ``SqliteWithoutRowidMixin`` 给 declarative base 加一个
+类属性 ``__sqlite_without_rowid__``, 在 ``after_mapper_constructed`` 事件中把它翻译成
+``sqlite_with_rowid`` 方言参数:
+
+- ``None`` (默认): 关联表 (复合主键, 每个主键列都是外键, 没有其他列) 自动使用 WITHOUT ROWID.
+- ``True`` / ``False``: 强制打开 / 关闭.
+
+Core 中定义的 ``sa.Table`` 用 ``sqlite_without_rowid(metadata)`` 处理. 例子中的
+``asso_channel_and_video`` (``04-relationship-youtube-example.py``), ``movie_and_genre``
+(``05-relationship-imdb-example.py``), ``asso_question_and_tag`` (``e1_many_to_many.py``)
+都已经用上了.
+
+注意:
+
+- WITHOUT ROWID 适合行比较小 (小于 page 大小的 1/20) 的表, 关联表正好满足. 有大的文本,
+    二进制列的表不要用.
+- WITHOUT ROWID 表没有 AUTOINCREMENT, 也必须有主键. 单列 Integer 主键的表本身就是 rowid
+    的别名, 用 WITHOUT ROWID 没有好处. 有其他列的复合主键表, 例如 youtube 例子中的
+    ``comment (video_id, nth_comment, ...)``, 行可能很大, 所以默认只处理纯关联表, 其他的
+    表需要时用 ``__sqlite_without_rowid__ = True`` 打开.
+
+50 万行关联表 (10 万个问题, 每个问题 5 个 tag) 的结果如下::
+
+    --- rowid
+    file size: 21.86 MB, association table: 19.51 MB
+    tags of question: 0.121 sec
+    questions of tag: 0.160 sec
+    --- without rowid
+    file size: 12.95 MB, association table: 10.60 MB
+    tags of question: 0.066 sec
+    questions of tag: 0.043 sec
+
+"questions of tag" 在 rowid 表上要先查 ``(tag_id)`` 索引拿到 rowid, 再回表取 question_id;
+WITHOUT ROWID 表的索引里已经有 question_id, 所以快了 3 倍多.
+"""
+
+import typing as T
+import os
+import time
+import random
+import tempfile
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy_mate as sam
+from sqlalchemy.dialects import postgresql
+from learn_sqlalchemy.base import SqliteWithoutRowidMixin
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase, SqliteWithoutRowidMixin):
+    __abstract__ = True
+
+
+class QuestionAndItsTag(ExtendedBase):
+    __tablename__ = "asso_question_and_tag"
+
+    question_id = sa.Column("question_id", sa.ForeignKey("questions.question_id"), primary_key=True)
+    # 反向查找用的索引, 在 WITHOUT ROWID 表上它自动包含 question_id
+    tag_id = sa.Column("tag_id", sa.ForeignKey("tags.tag_id"), primary_key=True, index=True)
+
+
+class Question(ExtendedBase):
+    __tablename__ = "questions"
+
+    question_id = sa.Column(sa.Integer, primary_key=True)
+    title = sa.Column(sa.String)
+
+    tags = orm.relationship(
+        "Tag",
+        secondary=QuestionAndItsTag.__table__,
+        back_populates="questions",
+    )
+
+
+class Tag(ExtendedBase):
+    __tablename__ = "tags"
+
+    tag_id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String, unique=True)
+
+    questions = orm.relationship(
+        "Question",
+        secondary=QuestionAndItsTag.__table__,
+        back_populates="tags",
+    )
+
+
+class QuestionRevision(ExtendedBase):
+    """
+    复合主键, 但是有大的文本列, 不是关联表.
+    """
+
+    __tablename__ = "question_revisions"
+
+    question_id = sa.Column(sa.ForeignKey("questions.question_id"), primary_key=True)
+    nth_revision = sa.Column(sa.Integer, primary_key=True)
+    body = sa.Column(sa.Text)
+
+
+class QuestionAndItsTagRank(ExtendedBase):
+    """
+    不是纯关联表, 但行很小, 手动打开.
+    """
+
+    __tablename__ = "asso_question_and_tag_rank"
+    __sqlite_without_rowid__ = True
+
+    question_id = sa.Column(sa.ForeignKey("questions.question_id"), primary_key=True)
+    tag_id = sa.Column(sa.ForeignKey("tags.tag_id"), primary_key=True)
+    rank = sa.Column(sa.Integer)
+
+
+asso_table: sa.Table = QuestionAndItsTag.__table__
+
+# 只有关联表使用 WITHOUT ROWID, 其他方言的 DDL 不受影响
+sqlite_ddl = str(sa.schema.CreateTable(asso_table).compile(dialect=sa.dialects.sqlite.dialect()))
+psql_ddl = str(sa.schema.CreateTable(asso_table).compile(dialect=postgresql.dialect()))
+assert "WITHOUT ROWID" in sqlite_ddl
+assert "WITHOUT ROWID" not in psql_ddl
+assert Question.__table__.dialect_options["sqlite"]["with_rowid"] is True
+assert Tag.__table__.dialect_options["sqlite"]["with_rowid"] is True
+assert QuestionRevision.__table__.dialect_options["sqlite"]["with_rowid"] is True
+assert QuestionAndItsTagRank.__table__.dialect_options["sqlite"]["with_rowid"] is False
+print(sqlite_ddl.strip())
+
+# 普通的 rowid 表作为对照, 除了 with_rowid 以外完全相同
+metadata_rowid = sa.MetaData()
+for table in Base.metadata.sorted_tables:
+    table.to_metadata(metadata_rowid).dialect_options["sqlite"]["with_rowid"] = True
+
+# --- Benchmark
+N_QUESTION = 100_000
+N_TAG = 1000
+N_TAG_PER_QUESTION = 5
+N_LOOKUP = 2000
+
+random.seed(1)
+question_rows = [
+    dict(question_id=i, title=f"question {i}") for i in range(1, 1 + N_QUESTION)
+]
+tag_rows = [dict(tag_id=i, name=f"tag {i}") for i in range(1, 1 + N_TAG)]
+asso_rows = [
+    dict(question_id=question_id, tag_id=tag_id)
+    for question_id in range(1, 1 + N_QUESTION)
+    for tag_id in random.sample(range(1, 1 + N_TAG), N_TAG_PER_QUESTION)
+]
+question_ids = random.sample(range(1, 1 + N_QUESTION), N_LOOKUP)
+tag_ids = random.sample(range(1, 1 + N_TAG), N_LOOKUP // 20)
+
+stmt_tags_of_question = (
+    sa.select(Tag.name)
+    .join(QuestionAndItsTag, QuestionAndItsTag.tag_id == Tag.tag_id)
+    .where(QuestionAndItsTag.question_id == sa.bindparam("id"))
+)
+stmt_questions_of_tag = (
+    sa.select(sa.func.count(Question.question_id))
+    .join(QuestionAndItsTag, QuestionAndItsTag.question_id == Question.question_id)
+    .where(QuestionAndItsTag.tag_id == sa.bindparam("id"))
+)
+
+
+def table_size(conn: sa.Connection, table: sa.Table) -> int:
+    """
+    表和它的所有索引占用的字节数, 用 ``dbstat`` 虚拟表统计.
+    """
+    names = [table.name] + [
+        row.name
+        for row in conn.execute(
+            sa.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name"),
+            dict(name=table.name),
+        )
+    ]
+    return conn.execute(
+        sa.text("SELECT SUM(pgsize) FROM dbstat WHERE name IN :names").bindparams(
+            sa.bindparam("names", expanding=True)
+        ),
+        dict(names=names),
+    ).scalar()
+
+
+def lookup(conn: sa.Connection, stmt: sa.Select, ids: T.List[int]) -> T.Tuple[float, list]:
+    st = time.perf_counter()
+    rows = list()
+    for id in ids:
+        rows.extend(conn.execute(stmt, dict(id=id)).all())
+    return time.perf_counter() - st, rows
+
+
+def run_benchmark(name: str, metadata: sa.MetaData, path: str) -> dict:
+    engine = sa.create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    tables = metadata.tables
+    with engine.begin() as conn:
+        conn.execute(sa.insert(tables["questions"]), question_rows)
+        conn.execute(sa.insert(tables["tags"]), tag_rows)
+        conn.execute(sa.insert(tables["asso_question_and_tag"]), asso_rows)
+    with engine.connect() as conn:
+        conn.execute(sa.text("VACUUM"))
+        file_size = os.path.getsize(path)
+        asso_size = table_size(conn, tables["asso_question_and_tag"])
+        # 两张表的 ORM 语句是一样的, 编译出来的 SQL 只依赖表名
+        elapsed_1, rows_1 = lookup(conn, stmt_tags_of_question, question_ids)
+        elapsed_2, rows_2 = lookup(conn, stmt_questions_of_tag, tag_ids)
+    engine.dispose()
+    print(f"--- {name}")
+    print(f"file size: {file_size / 1000000:.2f} MB, association table: {asso_size / 1000000:.2f} MB")
+    print(f"tags of question: {elapsed_1:.3f} sec")
+    print(f"questions of tag: {elapsed_2:.3f} sec")
+    return dict(file_size=file_size, asso_size=asso_size, rows_1=rows_1, rows_2=rows_2)
+
+
+with tempfile.TemporaryDirectory() as dir_tmp:
+    before = run_benchmark("rowid", metadata_rowid, os.path.join(dir_tmp, "rowid.sqlite"))
+    after = run_benchmark("without rowid", Base.metadata, os.path.join(dir_tmp, "without_rowid.sqlite"))
+
+# 查询结果一样, 文件变小
+assert len(before["rows_1"]) == N_LOOKUP * N_TAG_PER_QUESTION
+assert sorted(before["rows_1"]) == sorted(after["rows_1"])
+assert before["rows_2"] == after["rows_2"]
+assert after["asso_size"] < before["asso_size"]
+assert after["file_size"] < before["file_size"]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""
+``e3`` 和 ``e4`` 共用的工具: 在 Session 的 ``after_flush`` 事件中收集这次 flush 通过
+ORM 新增和删除的边.
+
+边有两种写法, 都要收集:
+
+1. 直接 ``ses.add`` / ``ses.delete`` 关联表的 ORM 对象.
+2. 通过以关联表为 ``secondary`` 的 relationship 操作, 例如
+    ``user.user_i_subscribed.append(other)``. 这种写法不会产生关联表的 ORM 对象,
+    只能从 relationship 的 history 中读出来.
+"""
+
+import typing as T
+
+import sqlalchemy.orm as orm
+
+T_EDGE = T.Tuple[int, int]
+
+
+def merge_delta(
+    delta: T.Tuple[T.Set[T_EDGE], T.Set[T_EDGE]],
+    added: T.Iterable[T_EDGE],
+    removed: T.Iterable[T_EDGE],
+):
+    """
+    把后发生的一批增量合并到 delta 中. 先加后删, 或者先删后加的边会互相抵消.
+    """
+    delta_added, delta_removed = delta
+    for edge in removed:
+        if edge in delta_added:
+            delta_added.discard(edge)
+        else:
+            delta_removed.add(edge)
+    for edge in added:
+        if edge in delta_removed:
+            delta_removed.discard(edge)
+        else:
+            delta_added.add(edge)
+
+
+class EdgeHistory:
+    """
+    :param src: 边的起点, 例如 ``UserAndUserSubscription.subscriber_user_id``.
+    :param dst: 边的终点, 例如 ``UserAndUserSubscription.publisher_user_id``.
+    """
+
+    def __init__(
+        self,
+        src: orm.InstrumentedAttribute,
+        dst: orm.InstrumentedAttribute,
+    ):
+        self.klass = src.class_
+        self.src_key = src.key
+        self.dst_key = dst.key
+        table = self.klass.__table__
+        # 以关联表为 secondary 的 relationship, 例如 User.user_i_subscribed.
+        # 如果 primaryjoin 连接的是 src 列, 那么 owner 是边的起点, 否则是终点.
+        self.relationships = [
+            (
+                mapper.class_,
+                rel.key,
+                rel.synchronize_pairs[0][1] is table.c[src.key],
+            )
+            for mapper in orm.class_mapper(self.klass).registry.mappers
+            for rel in mapper.relationships
+            if rel.secondary is table
+        ]
+
+    def _edge(self, obj) -> T_EDGE:
+        return getattr(obj, self.src_key), getattr(obj, self.dst_key)
+
+    def collect(self, ses: orm.Session) -> T.Tuple[T.Set[T_EDGE], T.Set[T_EDGE]]:
+        """
+        在 ``after_flush`` 中调用, 返回这次 flush 新增和删除的边.
+        """
+        added: T.Set[T_EDGE] = set()
+        removed: T.Set[T_EDGE] = set()
+        for obj in ses.new:
+            if isinstance(obj, self.klass):
+                added.add(self._edge(obj))
+        for obj in ses.deleted:
+            if isinstance(obj, self.klass):
+                removed.add(self._edge(obj))
+        for obj in list(ses.new) + list(ses.dirty):
+            for rel_class, key, is_forward in self.relationships:
+                if not isinstance(obj, rel_class):
+                    continue
+                history = orm.attributes.get_history(obj, key)
+                pk = orm.object_mapper(obj).primary_key_from_instance(obj)[0]
+                for edges, others in [
+                    (added, history.added),
+                    (removed, history.deleted),
+                ]:
+                    for other in others:
+                        other_pk = orm.object_mapper(other).primary_key_from_instance(other)[0]
+                        edges.add((pk, other_pk) if is_forward else (other_pk, pk))
+        return added, removed
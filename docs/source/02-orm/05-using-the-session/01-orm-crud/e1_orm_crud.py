@@ -5,6 +5,8 @@
 - (R) Read / Select
 - (U) Update
 - (D) Delete
+
+热门查询的结果缓存请参考 ``e2_query_result_cache.py``.
 """
 
 import sqlalchemy as sa
@@ -0,0 +1,668 @@
+# -*- coding: utf-8 -*-
+
+"""
+查询结果缓存.
+
+``e1_orm_crud.py`` 中的 ``sa.select(User).where(User.id <= 2)`` 这种热门查询, 在 Web 应用中
+每个请求 (每个 Session) 都要重新执行一次, 结果却很少变化. :class:`QueryCache` 在
+``do_orm_execute`` 事件中缓存查询的结果, 只对带有 ``cache_results=True`` 这个
+execution option 的 SELECT 生效::
+
+    cache = QueryCache().install(engine)
+    stmt = sa.select(User).where(User.id <= 2).execution_options(cache_results=True)
+    users = ses.scalars(stmt).all()
+
+- key: 语句的 cache key (和 SQLAlchemy 的编译缓存用的是同一个) 加上绑定参数的值, 再加上
+    engine 的 URL, 取 SHA1.
+- value: ``FrozenResult`` (结果中的所有行, 包括 ORM 对象) 的 pickle. 命中时用
+    ``merge_frozen_result(load=False)`` 把对象合并到当前的 Session 中, 不访问数据库.
+- 后端: :class:`MemoryBackend` 是进程内的 LRU; :class:`SQLiteBackend` 保存在 SQLite 文件中,
+    同一台机器上的多个进程共享, 重启之后仍然有效.
+
+失效: 每张表有一个版本号. 写入缓存时记录语句用到的所有表 (包括子查询, column_property
+和默认 eager load 的 relationship 用到的表) 在 **执行之前** 的版本号, 读取时版本号不一致就当作
+没有命中. 表的版本号在两个时间点加一:
+
+1. 执行 INSERT / UPDATE / DELETE 之后 (flush, ``ses.execute(sa.update(User))`` 和 Core
+    的写入都是). ``text()`` 和 DDL 这种不知道修改了哪张表的语句让所有的表都失效.
+2. 提交时 (engine 的 ``commit`` 事件, 在 DBAPI 的 commit 之前) 再加一, 同时把这些表标记为
+    "正在提交"; 提交完成之后 (Session 的 ``after_commit``, 同一个连接开始下一个事务, 或者连接
+    归还连接池时) 再加一并取消标记. 标记期间读到的结果不写入缓存.
+
+第 1 步让旧的结果立刻失效; 写入之后, 提交之前的这段时间内, 其他 Session 读到的仍然是提交之前的
+数据, 它们写入缓存的结果会在第 2 步失效. 修改过某张表的 Session 在提交之前, 用到这张表的查询
+直接访问数据库, 不读也不写缓存, 所以它能看到自己没有提交的修改; 有没有 flush 的修改的 Session
+也一样. 因此在一个进程内不会读到已经提交的修改之前的旧结果.
+
+版本号保存在 ``versions`` 中, 它只需要 ``get(tables) -> tuple`` 和 ``bump(tables)`` 两个方法.
+默认的 :class:`MemoryVersionStore` 只在当前进程内有效; 多个进程共享同一个
+:class:`SQLiteVersionStore` 时, 一个进程的提交也会让其他进程的缓存失效. 跨机器时可以用同样的两个
+方法实现 Redis (``MGET`` / ``INCR``) 或者数据库中的一张表.
+
+2 万个用户, 1000 个请求, 每个请求一个新的 Session, 执行 4 个查询: ``id <= 2``, 按 ``1 / 排名``
+的热度查一个用户, 积分最高的 10 个用户 (全表扫描), 积分大于 900 的用户数. 2% 的请求修改
+一个用户的积分并提交. SQLite 文件数据库::
+
+    no cache: 3.824 sec, 956.1 us per query, 4038 SQL statements
+    MemoryBackend: 1.613 sec, 403.2 us per query, 873 SQL statements
+    hits: 3165, misses: 540, stale: 295, bypass: 0
+    SQLiteBackend + SQLiteVersionStore: 2.014 sec, 503.6 us per query, 873 SQL statements
+    hits: 3165, misses: 540, stale: 295, bypass: 0
+
+三次运行的结果完全一样.
+
+- 加速来自全表扫描的两个查询. ``id <= 2`` 这种走主键的查询本身只要几十微秒, 缓存命中时计算
+    cache key, 反序列化和 merge 的开销和它差不多, 并不会更快, 只是减少了数据库的负载.
+- 每次写入都让整张表的所有缓存失效 (stale), 这里 2% 的写入就让命中率降到了 79%, 所以只适合
+    读多写少的表. 回滚的修改也会让缓存失效.
+- SQLite 后端每次读取多了两次磁盘上的查询 (版本号和结果), 换来的是多个进程之间共享.
+- 带有 loader option (``selectinload`` 等), ``with_for_update``, ``populate_existing``
+    的查询不使用缓存. 缓存的对象在命中时覆盖当前 Session 中同一个对象已经加载的属性
+    (没有 flush 的修改除外, 见上文).
+"""
+
+import typing as T
+import json
+import time
+import pickle
+import random
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict, Counter
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+from sqlalchemy.sql.util import find_tables
+import sqlalchemy_mate as sam
+
+_ANY = "*"  # text() 和 DDL 这种不知道修改了哪张表的语句, 所有的缓存都依赖它
+_WRITTEN = "query_cache_written"
+_COMMITTING = "query_cache_committing"
+
+_EAGER = ("joined", "selectin", "subquery", "immediate")
+
+
+class MemoryBackend:
+    """
+    进程内的 LRU.
+
+    :param maxsize: 最多缓存多少个结果, 超过时删除最久没有被访问的.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data: T.OrderedDict[str, T.Tuple[tuple, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> T.Optional[T.Tuple[tuple, bytes]]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data.move_to_end(key)
+            return item
+
+    def put(self, key: str, versions: tuple, value: bytes):
+        with self._lock:
+            self._data[key] = (versions, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    """
+    保存在 SQLite 文件中的缓存. 超过 ``maxsize`` 时删除最早写入的.
+    """
+
+    def __init__(self, path: str, maxsize: int = 100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS result_cache "
+            "(key TEXT PRIMARY KEY, versions TEXT NOT NULL, value BLOB NOT NULL)"
+        )
+
+    def get(self, key: str) -> T.Optional[T.Tuple[tuple, bytes]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT versions, value FROM result_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return tuple(json.loads(row[0])), row[1]
+
+    def put(self, key: str, versions: tuple, value: bytes):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, versions, value) VALUES (?, ?, ?)",
+                (key, json.dumps(versions), value),
+            )
+            # REPLACE 是先删除再插入, 新的一行的 rowid 最大, 按 rowid 删除最早写入的
+            self._conn.execute(
+                "DELETE FROM result_cache WHERE rowid <= ?",
+                (cursor.lastrowid - self.maxsize,),
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM result_cache").fetchone()[0]
+
+
+class MemoryVersionStore:
+    """
+    每张表的版本号, 只在当前进程内有效.
+    """
+
+    def __init__(self):
+        self._versions: T.Dict[str, int] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, tables: T.Sequence[str]) -> T.Tuple[int, ...]:
+        versions = self._versions
+        return tuple(versions.get(table, 0) for table in tables)
+
+    def bump(self, tables: T.Iterable[str]):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+
+class SQLiteVersionStore:
+    """
+    保存在 SQLite 文件中的每张表的版本号, 同一台机器上的多个进程共享.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS table_version "
+            "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+
+    def get(self, tables: T.Sequence[str]) -> T.Tuple[int, ...]:
+        with self._lock:
+            versions = dict(self._conn.execute(
+                "SELECT name, version FROM table_version WHERE name IN ({})".format(
+                    ", ".join("?" * len(tables))
+                ),
+                tuple(tables),
+            ).fetchall())
+        return tuple(versions.get(table, 0) for table in tables)
+
+    def bump(self, tables: T.Iterable[str]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO table_version (name, version) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                [(table,) for table in tables],
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+def _written_tables(statement: str, context) -> T.Set[str]:
+    """
+    一条语句修改了哪些表. SELECT 返回空集合, 不知道的返回 ``{_ANY}``.
+    """
+    compiled = context.compiled if context is not None else None
+    if compiled is not None:
+        if context.isinsert or context.isupdate or context.isdelete:
+            table = compiled.statement.table
+            if isinstance(table, sa.TableClause):
+                return {table.fullname}
+            return {_ANY}
+        if getattr(compiled.statement, "is_select", False):
+            return set()
+    # text() 和 exec_driver_sql 只能看 SQL 的开头
+    if statement.lstrip()[:6].upper() == "SELECT":
+        return set()
+    return {_ANY}
+
+
+def _mapper_tables(mapper: orm.Mapper, seen: T.Set[orm.Mapper]) -> T.Set[str]:
+    """
+    加载 ``mapper`` 的对象时会读到的表: mapper 自己的表, column_property 中的子查询,
+    以及默认 eager load 的 relationship.
+    """
+    seen.add(mapper)
+    tables = {table.fullname for table in mapper.tables}
+    for prop in mapper.column_attrs:
+        for column in prop.columns:
+            tables.update(
+                table.fullname
+                for table in find_tables(column, check_columns=True, include_aliases=True)
+                if isinstance(table, sa.TableClause)
+            )
+    for rel in mapper.relationships:
+        if rel.lazy not in _EAGER:
+            continue
+        if rel.secondary is not None:
+            tables.add(rel.secondary.fullname)
+        if rel.mapper not in seen:
+            tables.update(_mapper_tables(rel.mapper, seen))
+    return tables
+
+
+class QueryCache:
+    """
+    :param backend: :class:`MemoryBackend` (默认) 或者 :class:`SQLiteBackend`.
+    :param versions: :class:`MemoryVersionStore` (默认) 或者 :class:`SQLiteVersionStore`.
+    """
+
+    def __init__(self, backend=None, versions=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.versions = versions if versions is not None else MemoryVersionStore()
+        self.engine: T.Optional[sa.Engine] = None
+        # to_offline_string 用来缓存编译好的 SQL 字符串
+        self._statement_cache: T.Dict[tuple, str] = dict()
+        self._tables_cache: T.Dict[tuple, T.Tuple[str, ...]] = dict()
+        self._connections = f"query_cache_connections_{id(self)}"
+        # 正在提交的表, 提交完成之前读到的结果不写入缓存
+        self._committing: T.Counter[str] = Counter()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bypass = 0
+
+    def install(self, engine: sa.Engine) -> "QueryCache":
+        """
+        在 ``engine`` 和所有的 Session 上注册事件. 一个 QueryCache 只能用于一个 engine.
+        """
+        self.engine = engine
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "commit", self._commit)
+        event.listen(engine, "rollback", self._rollback)
+        event.listen(engine, "begin", self._begin)
+        event.listen(engine.pool, "checkin", self._checkin)
+        event.listen(orm.Session, "after_begin", self._after_begin)
+        event.listen(orm.Session, "after_commit", self._after_commit)
+        event.listen(orm.Session, "after_transaction_end", self._after_transaction_end)
+        event.listen(orm.Session, "do_orm_execute", self._do_orm_execute)
+        return self
+
+    # --- 失效
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        tables = _written_tables(statement, context)
+        if tables:
+            conn.info.setdefault(_WRITTEN, set()).update(tables)
+            self.versions.bump(tables)
+
+    def _commit(self, conn):
+        # commit 事件在 DBAPI 的 commit 之前触发. 先标记为正在提交, 再让旧的结果失效
+        tables = conn.info.pop(_WRITTEN, None)
+        if tables:
+            with self._lock:
+                self._committing.update(tables)
+            conn.info.setdefault(_COMMITTING, set()).update(tables)
+            self.versions.bump(tables)
+
+    def _committed(self, info: dict):
+        # 提交已经完成. 提交的过程中读到的可能是旧的数据, 再加一次版本号让它们失效
+        tables = info.pop(_COMMITTING, None)
+        if tables:
+            self.versions.bump(tables)
+            with self._lock:
+                for table in tables:
+                    self._committing[table] -= 1
+                    if self._committing[table] <= 0:
+                        del self._committing[table]
+
+    def _rollback(self, conn):
+        conn.info.pop(_WRITTEN, None)
+
+    def _begin(self, conn):
+        # 同一个连接开始了新的事务, 上一次的提交一定已经完成
+        self._committed(conn.info)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        # 没有提交的修改会被连接池回滚
+        connection_record.info.pop(_WRITTEN, None)
+        self._committed(connection_record.info)
+
+    def _after_begin(self, session: orm.Session, transaction, connection: sa.Connection):
+        if connection.engine is self.engine:
+            session.info.setdefault(self._connections, list()).append(connection)
+
+    def _after_commit(self, session: orm.Session):
+        for connection in session.info.get(self._connections, ()):
+            self._committed(connection.info)
+
+    def _after_transaction_end(self, session: orm.Session, transaction):
+        if transaction.parent is None:
+            session.info.pop(self._connections, None)
+
+    # --- 读写缓存
+    def _tables(self, orm_execute_state: orm.ORMExecuteState, key: tuple) -> T.Tuple[str, ...]:
+        tables = self._tables_cache.get(key)
+        if tables is None:
+            names = {
+                table.fullname
+                for table in find_tables(
+                    orm_execute_state.statement, check_columns=True, include_aliases=True,
+                )
+                if isinstance(table, sa.TableClause)
+            }
+            seen = set()
+            for mapper in orm_execute_state.all_mappers:
+                if mapper not in seen:
+                    names.update(_mapper_tables(mapper, seen))
+            # 找不到任何表的语句无法判断什么时候失效, 用空的 tuple 表示不缓存
+            tables = tuple(sorted(names)) + (_ANY,) if names else tuple()
+            self._tables_cache[key] = tables
+        return tables
+
+    def _do_orm_execute(self, orm_execute_state: orm.ORMExecuteState):
+        if (
+            not orm_execute_state.is_select
+            or orm_execute_state.is_relationship_load
+            or orm_execute_state.is_column_load
+        ):
+            return None
+        options = orm_execute_state.execution_options
+        if not options.get("cache_results"):
+            return None
+        session = orm_execute_state.session
+        statement = orm_execute_state.statement
+        if session.get_bind(**orm_execute_state.bind_arguments) is not self.engine:
+            return None
+        cache_key = statement._generate_cache_key()
+        if (
+            cache_key is None
+            or statement._with_options
+            or statement._for_update_arg is not None
+            or options.get("populate_existing")
+        ):
+            self.bypass += 1
+            return None
+        tables = self._tables(orm_execute_state, cache_key.key)
+        written = set()
+        for connection in session.info.get(self._connections, ()):
+            written.update(connection.info.get(_WRITTEN, ()))
+        if not tables or not written.isdisjoint(tables):
+            # 当前事务修改过的表, 提交之前不读也不写缓存
+            self.bypass += 1
+            return None
+        if session.new or session.dirty or session.deleted:
+            # 命中时 merge 会覆盖没有 flush 的修改 (no_autoflush 时)
+            changed = {
+                table.fullname
+                for obj in (*session.new, *session.dirty, *session.deleted)
+                for table in sa.inspect(obj).mapper.tables
+            }
+            if not changed.isdisjoint(tables):
+                self.bypass += 1
+                return None
+
+        offline = cache_key.to_offline_string(
+            self._statement_cache, statement, orm_execute_state.parameters or {},
+        )
+        key = hashlib.sha1(f"{self.engine.url}|{offline}".encode("utf-8")).hexdigest()
+        # 版本号必须在执行之前读取, 执行期间提交的修改会让这次写入的缓存失效
+        versions = self.versions.get(tables)
+        item = self.backend.get(key)
+        if item is not None and item[0] == versions:
+            self.hits += 1
+            frozen = pickle.loads(item[1])
+            return orm.loading.merge_frozen_result(session, statement, frozen, load=False)()
+        if item is None:
+            self.misses += 1
+        else:
+            self.stale += 1
+        frozen = orm_execute_state.invoke_statement().freeze()
+        if not self._committing or all(table not in self._committing for table in tables):
+            self.backend.put(key, versions, pickle.dumps(frozen))
+        return frozen()
+
+
+Base = orm.declarative_base()
+
+
+class User(Base, sam.ExtendedBase):
+    __tablename__ = "user"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    value = sa.Column(sa.Integer)
+
+
+tmp_dir = tempfile.TemporaryDirectory()
+dir_tmp = Path(tmp_dir.name)
+path_db = dir_tmp / "app.sqlite"
+
+
+def new_engine() -> sa.Engine:
+    """
+    每个 engine 相当于一个进程.
+    """
+    return sa.create_engine(f"sqlite:///{path_db}")
+
+
+def q_top2():
+    return sa.select(User).where(User.id <= 2).execution_options(cache_results=True)
+
+
+def q_user(user_id: int):
+    return sa.select(User).where(User.id == user_id).execution_options(cache_results=True)
+
+
+def q_leaderboard():
+    return (
+        sa.select(User)
+        .order_by(User.value.desc(), User.id)
+        .limit(10)
+        .execution_options(cache_results=True)
+    )
+
+
+def q_count():
+    return (
+        sa.select(sa.func.count())
+        .select_from(User)
+        .where(User.value > 900)
+        .execution_options(cache_results=True)
+    )
+
+
+N_USER = 20000
+N_REQUEST = 1000
+N_QUERY_PER_REQUEST = 4
+WRITE_RATIO = 0.02
+
+random.seed(1)
+engine = new_engine()
+Base.metadata.create_all(engine)
+with engine.begin() as conn:
+    conn.execute(sa.insert(User), [
+        dict(id=i, name=f"user {i}", value=random.randint(1, 1000)) for i in range(1, 1 + N_USER)
+    ])
+
+# --- 正确性
+cache = QueryCache().install(engine)
+
+with orm.Session(engine) as ses:
+    assert [u.name for u in ses.scalars(q_top2())] == ["user 1", "user 2"]
+with orm.Session(engine) as ses:
+    assert [u.name for u in ses.scalars(q_top2())] == ["user 1", "user 2"]
+    assert cache.hits == 1
+    # 命中时的对象是当前 Session 中普通的 persistent 对象
+    user = ses.scalars(q_top2()).first()
+    assert user in ses and not ses.dirty
+    user.name = "Alice"
+    ses.commit()
+    assert ses.get(User, 1).name == "Alice"
+
+with orm.Session(engine) as ses:
+    assert [u.name for u in ses.scalars(q_top2())] == ["Alice", "user 2"]
+
+# flush 之后, 提交之前: 自己看到自己的修改, 其他 Session 看到提交之前的值
+with orm.Session(engine) as ses_writer:
+    ses_writer.get(User, 2).name = "Bob"
+    ses_writer.flush()
+    bypass = cache.bypass
+    assert [u.name for u in ses_writer.scalars(q_top2())] == ["Alice", "Bob"]
+    assert cache.bypass == bypass + 1
+    with orm.Session(engine) as ses_reader:
+        assert [u.name for u in ses_reader.scalars(q_top2())] == ["Alice", "user 2"]
+    ses_writer.commit()
+with orm.Session(engine) as ses:
+    assert [u.name for u in ses.scalars(q_top2())] == ["Alice", "Bob"]
+
+# ORM 的 UPDATE 语句, Core 的写入和 text() 都会让缓存失效
+with orm.Session(engine) as ses:
+    ses.execute(sa.update(User).where(User.id == 1).values(name="Alice 1"))
+    ses.commit()
+with orm.Session(engine) as ses:
+    assert ses.scalars(q_top2()).first().name == "Alice 1"
+with engine.begin() as conn:
+    conn.execute(sa.update(User).where(User.id == 1).values(name="Alice 2"))
+with orm.Session(engine) as ses:
+    assert ses.scalars(q_top2()).first().name == "Alice 2"
+with engine.begin() as conn:
+    conn.execute(sa.text("UPDATE user SET name = 'Alice 3' WHERE id = 1"))
+with orm.Session(engine) as ses:
+    assert ses.scalars(q_top2()).first().name == "Alice 3"
+
+# Core 连接提交之后, 即使连接还没有关闭, 其他 Session 也能看到提交的修改
+with engine.connect() as conn:
+    conn.execute(sa.update(User).where(User.id == 2).values(name="Bob 1"))
+    with orm.Session(engine) as ses:
+        assert [u.name for u in ses.scalars(q_top2())] == ["Alice 3", "Bob"]
+    conn.commit()
+    with orm.Session(engine) as ses:
+        assert [u.name for u in ses.scalars(q_top2())] == ["Alice 3", "Bob 1"]
+    with orm.Session(engine) as ses:
+        assert [u.name for u in ses.scalars(q_top2())] == ["Alice 3", "Bob 1"]
+
+# 没有 flush 的修改不会被缓存的结果覆盖
+with orm.Session(engine) as ses:
+    user = ses.get(User, 2)
+    with ses.no_autoflush:
+        user.name = "dirty"
+        assert [u.name for u in ses.scalars(q_top2())] == ["Alice 3", "dirty"]
+
+# 标量的结果也可以缓存. 回滚的修改在执行时已经让缓存失效, 回滚之后重新读一次
+with orm.Session(engine) as ses:
+    n = ses.scalar(q_count())
+    ses.execute(sa.update(User).values(value=1000))
+    assert ses.scalar(q_count()) == N_USER
+    ses.rollback()
+with orm.Session(engine) as ses:
+    stale, hits = cache.stale, cache.hits
+    assert ses.scalar(q_count()) == n
+    assert ses.scalar(q_count()) == n
+    assert (cache.stale, cache.hits) == (stale + 1, hits + 1)
+
+# 多个进程共享同一个 SQLiteVersionStore, 一个进程的提交让其他进程的缓存失效
+path_versions = str(dir_tmp / "versions.sqlite")
+engine_a, engine_b = new_engine(), new_engine()
+cache_a = QueryCache(versions=SQLiteVersionStore(path_versions)).install(engine_a)
+cache_b = QueryCache(versions=SQLiteVersionStore(path_versions)).install(engine_b)
+with orm.Session(engine_a) as ses:
+    assert ses.scalars(q_user(3)).one().name == "user 3"
+with orm.Session(engine_b) as ses:
+    ses.get(User, 3).name = "Cathy"
+    ses.commit()
+with orm.Session(engine_a) as ses:
+    assert ses.scalars(q_user(3)).one().name == "Cathy"
+    assert cache_a.stale == 1
+
+# --- Benchmark
+# 第 n 个用户的访问概率和 1 / n 成正比
+user_ids = list(range(1, 1 + N_USER))
+weights = [1 / rank for rank in range(1, 1 + N_USER)]
+requests = [
+    (
+        random.choices(user_ids, weights)[0],
+        random.randint(1, N_USER) if random.random() < WRITE_RATIO else None,
+    )
+    for _ in range(N_REQUEST)
+]
+with engine.connect() as conn:
+    original_values = dict(conn.execute(sa.select(User.id, User.value)).all())
+
+
+def run_workload(name: str, engine: sa.Engine, cache: T.Optional[QueryCache] = None) -> list:
+    n_statement = [0]
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        n_statement[0] += 1
+
+    result = list()
+    st = time.perf_counter()
+    for i, (user_id, write_id) in enumerate(requests):
+        with orm.Session(engine) as ses:
+            for user in ses.scalars(q_top2()):
+                result.append((user.id, user.name, user.value))
+            user = ses.scalars(q_user(user_id)).one()
+            result.append((user.id, user.name, user.value))
+            result.append([(u.id, u.value) for u in ses.scalars(q_leaderboard())])
+            result.append(ses.scalar(q_count()))
+            if write_id is not None:
+                ses.get(User, write_id).value = 901 + i % 100
+                ses.commit()
+    elapsed = time.perf_counter() - st
+    n_query = N_REQUEST * N_QUERY_PER_REQUEST
+    print(
+        f"{name}: {elapsed:.3f} sec, "
+        f"{elapsed / n_query * 1000000:.1f} us per query, "
+        f"{n_statement[0]} SQL statements"
+    )
+    if cache is not None:
+        print(
+            f"hits: {cache.hits}, misses: {cache.misses}, "
+            f"stale: {cache.stale}, bypass: {cache.bypass}"
+        )
+    event.remove(engine, "before_cursor_execute", count_statement)
+
+    # 把修改过的积分改回去
+    with engine.begin() as conn:
+        conn.execute(
+            sa.update(User).where(User.id == sa.bindparam("b_id")).values(value=sa.bindparam("b_value")),
+            [
+                dict(b_id=write_id, b_value=original_values[write_id])
+                for _, write_id in requests
+                if write_id is not None
+            ],
+        )
+    return result
+
+
+expected = run_workload("no cache", new_engine())
+
+engine_memory = new_engine()
+cache_memory = QueryCache(MemoryBackend(maxsize=5000)).install(engine_memory)
+assert run_workload("MemoryBackend", engine_memory, cache_memory) == expected
+
+backend_sqlite = SQLiteBackend(str(dir_tmp / "cache.sqlite"))
+versions_sqlite = SQLiteVersionStore(path_versions)
+engine_sqlite = new_engine()
+cache_sqlite = QueryCache(backend_sqlite, versions_sqlite).install(engine_sqlite)
+assert run_workload("SQLiteBackend + SQLiteVersionStore", engine_sqlite, cache_sqlite) == expected
+
+for e in [engine, engine_a, engine_b, engine_memory, engine_sqlite]:
+    e.dispose()
+for c in [cache_a, cache_b, cache_sqlite]:
+    c.versions.close()
+backend_sqlite.close()
+tmp_dir.cleanup()
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+"""
+按主键批量更新, 每一行的值都不同.
+
+``e9_sync_strategy.py`` 中的 UPDATE 是一个 WHERE 条件加上一组值. 而 "把这 10 万个用户的
+积分分别改成 ..." 这种需求, 每一行的值都不一样, 有两种做法:
+
+1. executemany: ``UPDATE user SET score=? WHERE user.id = ?`` 加上 10 万组参数.
+2. staging table: 先把 ``(id, score)`` 批量写入一张临时表, 再执行一条
+    ``UPDATE user SET score=tmp.score FROM tmp WHERE user.id = tmp.id``.
+    PostgreSQL 上 executemany 的每一组参数都是一次网络往返 (或者一个很长的 pipeline),
+    而 INSERT 可以用多行 VALUES, 所以这是 PostgreSQL 上的默认做法. SQLite 3.33 以后也支持
+    ``UPDATE ... FROM``.
+
+:func:`bulk_update_by_pk` 执行之前先 ``flush``, 让未提交的修改先写入数据库, 然后用下面的
+一种方式同步 Session 中已经加载的对象:
+
+- ``"values"`` (默认): 已知每一行的新值, 直接用 ``set_committed_value`` 写入 identity map
+    中存在的对象. 和 ``"evaluate"`` 的效果一样, 但不需要对 WHERE 求值, 也适用于 staging
+    table 的方式. 只查找 identity map, 不会访问数据库.
+- ``"expire"``: 让这些对象的这几个属性过期, 下次访问时再从数据库读取.
+- ``False``: 不同步.
+
+版本号 (``version_id_col``) 和 unit of work 一样会加一, 列上的 ``onupdate`` 也会生效. 这些列
+的新值只有数据库知道, 所以 ``"values"`` 同步时它们会被 expire. joined table inheritance 的
+子类的属性可能在父表或者子表中, 按列所在的表分组, 每张表一条 UPDATE.
+
+SQLAlchemy 2.0 自带的 "ORM bulk UPDATE by primary key" (``ses.execute(sa.update(User), rows)``)
+做的是第 1 种, 只支持 ``synchronize_session`` 为 ``False`` 和 ``"evaluate"``.
+
+10 万个用户都已经加载到 Session 中. 先是同一个 WHERE 条件的 UPDATE 的三种同步方式, 然后是
+每一行的值都不同的 UPDATE. 计时包括更新之后读一遍所有对象的 ``score``::
+
+    --- UPDATE user SET score=score + 1 WHERE id <= 100000
+    synchronize_session=False: 0.051 sec, stale
+    synchronize_session='fetch': 1.149 sec
+    synchronize_session='evaluate': 1.465 sec
+    --- 100000 rows with different values
+    unit of work: 2.304 sec
+    ORM bulk UPDATE by primary key: 1.492 sec
+    executemany, sync=False: 0.490 sec, stale
+    executemany, sync='expire': 20.627 sec
+    executemany, sync='values': 0.746 sec
+    staging, sync='values': 0.706 sec
+
+- ``False`` 最快, 但是 Session 中的对象是旧的值 (stale).
+- 对象很多时 ``"evaluate"`` 要在 Python 中对每一个对象求值, 反而比 ``"fetch"`` 慢.
+- ``"expire"`` 本身很便宜, 但之后每访问一个对象就是一次 SELECT, 10 万个对象就是 10 万次.
+    只有更新之后不会再读这些对象时才适合.
+- ``"values"`` 只比 ``False`` 多了写入 identity map 的时间, 是保持正确的最便宜的方式.
+"""
+
+import typing as T
+import time
+import itertools
+import random
+import sqlite3
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy_mate as sam
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+class User(ExtendedBase):
+    __tablename__ = "user"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+    score = sa.Column(sa.Integer)
+    level = sa.Column(sa.Integer)
+
+
+_clock = itertools.count(1)
+
+
+class Account(ExtendedBase):
+    """
+    joined table inheritance 的父类, 带有版本号和 onupdate 的列.
+    """
+    __tablename__ = "account"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    type = sa.Column(sa.String)
+    balance = sa.Column(sa.Integer)
+    version = sa.Column(sa.Integer, nullable=False)
+    # 每次 UPDATE 时自动设置, 用递增的整数代替时间, 便于检查
+    updated_at = sa.Column(sa.Integer, default=0, onupdate=lambda: next(_clock))
+
+    __mapper_args__ = {
+        "polymorphic_identity": "account",
+        "polymorphic_on": type,
+        "version_id_col": version,
+    }
+
+
+class PremiumAccount(Account):
+    __tablename__ = "premium_account"
+
+    id = sa.Column(sa.Integer, sa.ForeignKey("account.id"), primary_key=True)
+    credit = sa.Column(sa.Integer)
+
+    __mapper_args__ = {
+        "polymorphic_identity": "premium_account",
+    }
+
+
+def _default_method(dialect: sa.Dialect) -> str:
+    if dialect.name == "postgresql":
+        return "staging"
+    return "executemany"
+
+
+def _update_executemany(
+    conn: sa.Connection,
+    table: sa.Table,
+    pk_columns: T.List[sa.Column],
+    value_columns: T.List[sa.Column],
+    params: T.List[dict],
+    extra_values: T.Dict[sa.Column, sa.ColumnElement],
+) -> int:
+    stmt = (
+        sa.update(table)
+        .where(*[column == sa.bindparam(f"b_{column.name}") for column in pk_columns])
+        .values({column: sa.bindparam(f"b_{column.name}") for column in value_columns})
+        .values(extra_values)
+    )
+    return conn.execute(stmt, params).rowcount
+
+
+def _update_staging(
+    conn: sa.Connection,
+    table: sa.Table,
+    pk_columns: T.List[sa.Column],
+    value_columns: T.List[sa.Column],
+    params: T.List[dict],
+    extra_values: T.Dict[sa.Column, sa.ColumnElement],
+) -> int:
+    # 临时表只对当前连接可见, 连接关闭时自动删除. 同一个连接上重复使用, 每次用完清空
+    staging = sa.Table(
+        "_".join(["tmp", table.name] + [column.name for column in value_columns]),
+        sa.MetaData(),
+        *[
+            sa.Column(f"b_{column.name}", column.type, primary_key=column.primary_key)
+            for column in pk_columns + value_columns
+        ],
+        prefixes=["TEMPORARY"],
+    )
+    staging.create(conn, checkfirst=True)
+    conn.execute(sa.delete(staging))
+    conn.execute(sa.insert(staging), params)
+    stmt = (
+        sa.update(table)
+        .where(*[column == staging.c[f"b_{column.name}"] for column in pk_columns])
+        .values({column: staging.c[f"b_{column.name}"] for column in value_columns})
+        .values(extra_values)
+    )
+    n_row = conn.execute(stmt).rowcount
+    conn.execute(sa.delete(staging))
+    return n_row
+
+
+def _property_key(mapper: orm.Mapper, column: sa.Column) -> T.Optional[str]:
+    try:
+        return mapper.get_property_by_column(column).key
+    except orm.exc.UnmappedColumnError:
+        return None
+
+
+def bulk_update_by_pk(
+    ses: orm.Session,
+    model: T.Type[Base],
+    rows: T.List[dict],
+    method: T.Optional[str] = None,
+    synchronize_session: T.Union[str, bool] = "values",
+) -> int:
+    """
+    按主键批量更新. ``rows`` 中的每一个 dict 包含所有的主键属性和要更新的属性, 所有的
+    dict 的 key 必须相同. 返回被更新的行数.
+
+    - joined table inheritance 的子类可以同时更新父表和子表的列, 每张表一条 UPDATE.
+    - 有 ``version_id_col`` 时和 unit of work 一样把版本号加一. 只支持默认的整数版本号,
+        以及 ``version_id_generator=False`` (由数据库维护).
+    - 列上的 ``onupdate`` / ``server_onupdate`` 照常生效.
+
+    :param method: ``"executemany"`` 或者 ``"staging"``, None 表示 PostgreSQL 上用
+        staging table, 其他数据库用 executemany.
+    :param synchronize_session: ``"values"``, ``"expire"`` 或者 ``False``. ``"values"`` 时
+        版本号和 ``onupdate`` 的列不知道新值, 会被 expire.
+    """
+    if not rows:
+        return 0
+    mapper: orm.Mapper = sa.inspect(model)
+    pk_keys = [mapper.get_property_by_column(column).key for column in mapper.primary_key]
+    value_keys = [key for key in rows[0] if key not in pk_keys]
+
+    # 按列所在的表分组. 子类的属性可能是父表的列, 不能都当作 mapper.local_table 的列
+    value_columns: T.Dict[sa.Table, T.List[T.Tuple[str, sa.Column]]] = dict()
+    for key in value_keys:
+        for column in mapper.get_property(key).columns:
+            if not isinstance(column, sa.Column):
+                raise ValueError(f"{key!r} is not a plain column")
+            value_columns.setdefault(column.table, list()).append((key, column))
+    extra_values: T.Dict[sa.Table, T.Dict[sa.Column, sa.ColumnElement]] = dict()
+    version_column = mapper.version_id_col
+    if version_column is not None:
+        if mapper.version_id_generator is not False:
+            if not isinstance(version_column.type, sa.Integer):
+                raise ValueError("only integer version counters are supported")
+            extra_values[version_column.table] = {
+                version_column: sa.func.coalesce(version_column, 0) + 1,
+            }
+            value_columns.setdefault(version_column.table, list())
+
+    ses.flush()
+    conn = ses.connection()
+    method = method or _default_method(conn.dialect)
+    if method == "staging":
+        update = _update_staging
+    elif method == "executemany":
+        update = _update_executemany
+    else:
+        raise ValueError(f"unknown method {method!r}")
+    if synchronize_session not in (False, "values", "expire"):
+        raise ValueError(f"unknown synchronize_session {synchronize_session!r}")
+
+    # 从父表到子表依次更新, 返回最上层的表更新的行数
+    n_row = 0
+    expire_keys = list()
+    tables = [table for table in mapper.tables if table in value_columns]
+    for table in tables:
+        pk_columns = list(table.primary_key.columns)
+        table_pk_keys = [mapper.get_property_by_column(column).key for column in pk_columns]
+        params = [
+            {
+                **{f"b_{column.name}": row[key] for key, column in zip(table_pk_keys, pk_columns)},
+                **{f"b_{column.name}": row[key] for key, column in value_columns[table]},
+            }
+            for row in rows
+        ]
+        n = update(
+            conn, table, pk_columns, [column for _, column in value_columns[table]],
+            params, extra_values.get(table, dict()),
+        )
+        if table is tables[0]:
+            n_row = n
+        # 数据库中的值变了, 但是不知道新值的列
+        for column in table.columns:
+            if (
+                column is version_column
+                or column.onupdate is not None
+                or column.server_onupdate is not None
+            ):
+                key = _property_key(mapper, column)
+                if key is not None and key not in value_keys and key not in expire_keys:
+                    expire_keys.append(key)
+
+    if synchronize_session is False:
+        return n_row
+    identity_map = ses.identity_map
+    for row in rows:
+        key = mapper.identity_key_from_primary_key([row[k] for k in pk_keys])
+        obj = identity_map.get(key)
+        if obj is None:
+            continue
+        if synchronize_session == "values":
+            for k in value_keys:
+                orm.attributes.set_committed_value(obj, k, row[k])
+            if expire_keys:
+                ses.expire(obj, expire_keys)
+        else:
+            ses.expire(obj, value_keys + expire_keys)
+    return n_row
+
+
+engine = sam.EngineCreator().create_sqlite()
+Base.metadata.create_all(engine)
+
+N_USER = 100_000
+
+random.seed(1)
+with orm.Session(engine) as ses:
+    ses.execute(sa.insert(User), [
+        dict(id=i, name=f"user {i}", score=0, level=1) for i in range(1, 1 + N_USER)
+    ])
+    ses.commit()
+
+# 正确性: 未 flush 的修改先写入, 然后被 UPDATE 覆盖; 已加载的对象得到新值, 没加载的不受影响
+with orm.Session(engine) as ses:
+    user1, user2 = ses.get(User, 1), ses.get(User, 2)
+    user2.name = "Bob"
+    n = bulk_update_by_pk(ses, User, [dict(id=1, score=10), dict(id=2, score=20), dict(id=3, score=30)])
+    assert n == 3
+    assert (user1.score, user2.score, user2.name) == (10, 20, "Bob")
+    assert not ses.dirty
+    assert ses.get(User, 3).score == 30
+    # 只有主键, 没有要更新的列
+    assert bulk_update_by_pk(ses, User, [dict(id=1)]) == 0
+    ses.rollback()
+
+if sqlite3.sqlite_version_info >= (3, 33, 0):
+    with orm.Session(engine) as ses:
+        user1 = ses.get(User, 1)
+        n = bulk_update_by_pk(ses, User, [dict(id=1, score=10, level=2)], method="staging")
+        assert n == 1 and (user1.score, user1.level) == (10, 2)
+        ses.rollback()
+
+# 子类同时更新父表 (balance) 和子表 (credit) 的列. 版本号加一, onupdate 的列被重新计算,
+# 这两个属性在 Session 中被 expire, 再次访问时读到数据库中的新值
+methods = ["executemany"]
+if sqlite3.sqlite_version_info >= (3, 33, 0):
+    methods.append("staging")
+for method in methods:
+    with orm.Session(engine) as ses:
+        ses.add_all([
+            PremiumAccount(id=1, balance=100, credit=10),
+            PremiumAccount(id=2, balance=200, credit=20),
+        ])
+        ses.commit()
+        account = ses.get(PremiumAccount, 1)
+        assert (account.version, account.updated_at) == (1, 0)
+        n = bulk_update_by_pk(
+            ses, PremiumAccount,
+            [dict(id=1, balance=110, credit=11), dict(id=2, balance=220, credit=22)],
+            method=method,
+        )
+        assert n == 2
+        assert (account.balance, account.credit) == (110, 11)
+        assert account.version == 2 and account.updated_at > 0
+        # 版本号和数据库一致, unit of work 的乐观锁检查不会失败
+        account.balance = 120
+        ses.commit()
+        assert ses.execute(sa.select(Account.balance, Account.version).where(Account.id == 1)).one() == (120, 3)
+        assert ses.execute(sa.select(PremiumAccount.credit).where(PremiumAccount.id == 2)).scalar() == 22
+
+    with engine.begin() as conn:
+        conn.execute(sa.delete(PremiumAccount.__table__))
+        conn.execute(sa.delete(Account.__table__))
+
+# --- Benchmark
+rows = [
+    dict(id=i, score=random.randint(1, 1000)) for i in range(1, 1 + N_USER)
+]
+
+
+def check(ses: orm.Session, users: T.List[User]) -> str:
+    """
+    比较已加载的对象和数据库中的值.
+    """
+    db = dict(ses.execute(sa.select(User.id, User.score)).all())
+    return "" if all(user.score == db[user.id] for user in users) else ", stale"
+
+
+def run(name: str, func: T.Callable[[orm.Session, T.List[User]], T.Any]):
+    with orm.Session(engine) as ses:
+        users = ses.scalars(sa.select(User)).all()
+        st = time.perf_counter()
+        func(ses, users)
+        # 更新之后读一遍所有对象的值, 过期的属性会在这里从数据库重新加载
+        sum(user.score for user in users)
+        elapsed = time.perf_counter() - st
+        status = check(ses, users)
+        print(f"{name}: {elapsed:.3f} sec{status}")
+        ses.rollback()
+    return status
+
+
+print(f"--- UPDATE user SET score=score + 1 WHERE id <= {N_USER}")
+for mode in [False, "fetch", "evaluate"]:
+    stmt = (
+        sa.update(User)
+        .where(User.id <= N_USER)
+        .values(score=User.score + 1)
+        .execution_options(synchronize_session=mode)
+    )
+    status = run(f"synchronize_session={mode!r}", lambda ses, users: ses.execute(stmt))
+    assert bool(status) == (mode is False)
+
+print(f"--- {N_USER} rows with different values")
+
+
+def unit_of_work(ses: orm.Session, users: T.List[User]):
+    for user, row in zip(users, rows):
+        user.score = row["score"]
+    ses.flush()
+
+
+run("unit of work", unit_of_work)
+run(
+    "ORM bulk UPDATE by primary key",
+    lambda ses, users: ses.execute(
+        sa.update(User), rows, execution_options=dict(synchronize_session="evaluate")
+    ),
+)
+for mode in [False, "expire", "values"]:
+    status = run(
+        f"executemany, sync={mode!r}",
+        lambda ses, users: bulk_update_by_pk(ses, User, rows, "executemany", mode),
+    )
+    assert bool(status) == (mode is False)
+if sqlite3.sqlite_version_info >= (3, 33, 0):
+    status = run(
+        "staging, sync='values'",
+        lambda ses, users: bulk_update_by_pk(ses, User, rows, "staging", "values"),
+    )
+    assert not status
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+"""
+应用场景:
+
+在 ``e1`` 中, ``post.tags_proxy.append("Python")`` 每次都会创建一个新的 ``Tag``. 导入大量
+Post 的时候, 要么会产生重复的 Tag, 要么就得在 creator 中先按 name 查一次数据库, 有多少
+个 tag 就要查多少次.
+
+本例的 :class:`GetOrCreateCache` 把 "按 name 找到或者创建 Tag" 这件事推迟到 flush 的时候
+批量完成:
+
+1. ``creator`` 只创建一个没有主键的 Tag 作为占位符, 不访问数据库.
+2. 在 Session 的 ``before_flush`` 事件中, 收集所有的占位符, 先查进程级别的
+    ``name -> tag_id`` 缓存. 缓存中没有的 name 用一条 ``INSERT ... ON CONFLICT DO NOTHING``
+    批量写入, 再用一条 ``SELECT`` 取回它们的 ``tag_id``.
+3. 用 ``Session.merge(load=False)`` 得到每个 name 对应的 Tag 对象 (不会发出 SELECT),
+    存在 Session 级别的缓存中, 然后把集合中的占位符替换掉, 并把占位符从 Session 中移除.
+4. 事务中新写入的 name 按事务分别记录, 最外层事务 commit 之后才加入进程级别的缓存.
+    SAVEPOINT 提交时合并到外层事务, 回滚时只丢弃这个 SAVEPOINT 中写入的 name.
+
+结论:
+
+导入大量 Post 时, 每一批 Post 最多只需要 2 次跟 tag 有关的查询, 而且大部分 name
+很快就会进入进程级别的缓存, 之后就完全不需要查询了. 注意进程级别的缓存假设 tag 不会被
+删除或者改名, 如果会, 需要调用 :meth:`GetOrCreateCache.clear`.
+
+在内存 SQLite 上, 1000 个 tag, 2 万个 Post, 每个 Post 3 个 tag, 每 1000 个 Post 提交一次.
+剩下的时间主要花在创建和替换占位符对象的 ORM 开销上::
+
+    get or create by select: 33.54 sec, 5048.0 queries per batch
+    get or create by cache: 7.63 sec, 0.2 queries per batch
+"""
+
+import typing as T
+import collections
+import random
+import time
+import weakref
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+from sqlalchemy.orm import declarative_base, Session, relationship
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+from sqlalchemy.ext.associationproxy import association_proxy
+
+Base = declarative_base()
+
+t_post_and_tag = sa.Table(
+    "post_and_tag", Base.metadata,
+    sa.Column("post_id", sa.Integer, sa.ForeignKey("post.post_id"), primary_key=True),
+    sa.Column("tag_id", sa.Integer, sa.ForeignKey("tag.tag_id"), primary_key=True)
+)
+
+
+class Tag(Base, sam.ExtendedBase):
+    __tablename__ = "tag"
+
+    tag_id = sa.Column(sa.Integer, primary_key=True)
+    # upsert 需要 name 上的唯一约束
+    name = sa.Column(sa.String(length=64), unique=True, nullable=False)
+
+
+class GetOrCreateCache:
+    """
+    为 ``association_proxy`` 提供一个按 ``key`` 去重的 creator.
+
+    :param klass: 目标 ORM 类, 例如 ``Tag``.
+    :param key: 用来去重的属性名, 必须有唯一约束, 例如 ``"name"``.
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, klass: T.Type[Base], key: str):
+        self.klass = klass
+        self.key = key
+        self.table: sa.Table = klass.__table__
+        self.pk: sa.Column = orm.class_mapper(klass).primary_key[0]
+        # 进程级别的缓存, key -> primary key
+        self.key_to_id: T.Dict[T.Any, T.Any] = dict()
+        # creator 创建的占位符. 用户自己创建的没有主键的对象不受影响
+        self._placeholders: T.MutableSet[Base] = weakref.WeakSet()
+        self._info_key_objects = f"{self.table.name}.{key}.objects"
+        self._info_key_pending = f"{self.table.name}.{key}.pending"
+
+    def creator(self, value) -> Base:
+        """
+        作为 ``association_proxy`` 的 ``creator``, 只创建占位符.
+        """
+        obj = self.klass(**{self.key: value})
+        self._placeholders.add(obj)
+        return obj
+
+    def clear(self):
+        self.key_to_id.clear()
+
+    @staticmethod
+    def _current(ses: Session) -> orm.SessionTransaction:
+        return ses.get_nested_transaction() or ses.get_transaction()
+
+    def _is_placeholder(self, obj) -> bool:
+        return obj in self._placeholders and getattr(obj, self.pk.key) is None
+
+    def _select(self, conn: sa.Connection, values: T.List[T.Any]) -> T.Dict[T.Any, T.Any]:
+        column = self.table.c[self.key]
+        key_to_id = dict()
+        for i in range(0, len(values), self.CHUNK_SIZE):
+            stmt = sa.select(column, self.pk).where(
+                column.in_(values[i:i + self.CHUNK_SIZE])
+            )
+            key_to_id.update(conn.execute(stmt).all())
+        return key_to_id
+
+    def _upsert(self, ses: Session, values: T.List[T.Any]) -> T.Dict[T.Any, T.Any]:
+        """
+        批量写入还不存在的 value, 并返回 value -> primary key.
+        """
+        conn = ses.connection()
+        column = self.table.c[self.key]
+        dialect = conn.dialect.name
+        existing = dict()
+        if dialect == "postgresql":
+            stmt = postgresql.insert(self.table).on_conflict_do_nothing(index_elements=[column])
+        elif dialect == "sqlite":
+            stmt = sqlite.insert(self.table).on_conflict_do_nothing(index_elements=[column])
+        elif dialect in ("mysql", "mariadb"):
+            stmt = mysql.insert(self.table).prefix_with("IGNORE")
+        else:
+            # 其他数据库没有 "冲突时忽略" 的语法, 先查出已经存在的, 只插入剩下的.
+            # 并发导入同一个新 value 时, 后提交的一方会违反唯一约束, 需要重试.
+            stmt = sa.insert(self.table)
+            existing = self._select(conn, values)
+            values = [value for value in values if value not in existing]
+        if values:
+            conn.execute(stmt, [{self.key: value} for value in values])
+        existing.update(self._select(conn, values))
+        return existing
+
+    def listen(self, target=orm.Session):
+        """
+        :param target: ``orm.Session`` 类, 一个 ``sessionmaker`` 或者一个 Session 实例.
+        """
+        # 所有指向 klass 的集合, 例如 Post.tags
+        relationships = [
+            (mapper.class_, rel.key)
+            for mapper in orm.class_mapper(self.klass).registry.mappers
+            for rel in mapper.relationships
+            if rel.mapper.class_ is self.klass and rel.uselist
+        ]
+
+        @event.listens_for(target, "before_flush")
+        def before_flush(ses: Session, flush_context, instances):
+            placeholders = [obj for obj in ses.new if self._is_placeholder(obj)]
+            if not placeholders:
+                return
+
+            # Session 级别的缓存, value -> 对象
+            objects: T.Dict[T.Any, Base] = ses.info.setdefault(self._info_key_objects, dict())
+            # 当前事务 (或 SAVEPOINT) 中新查到的 value -> primary key. 查找时要包括
+            # 外层事务中的, 所以用 ChainMap 把它们串起来
+            by_transaction = ses.info.setdefault(self._info_key_pending, dict())
+            current = by_transaction.setdefault(self._current(ses), dict())
+            pending = collections.ChainMap(*by_transaction.values())
+            # 用 dict 去重, 保持第一次出现的顺序
+            values = [
+                value
+                for value in dict.fromkeys(getattr(obj, self.key) for obj in placeholders)
+                if value not in objects or objects[value] not in ses
+            ]
+            unknown = [
+                value
+                for value in values
+                if value not in self.key_to_id and value not in pending
+            ]
+            if unknown:
+                current.update(self._upsert(ses, unknown))
+            for value in values:
+                pk = self.key_to_id.get(value, pending.get(value))
+                obj = self.klass(**{self.pk.key: pk, self.key: value})
+                orm.make_transient_to_detached(obj)
+                objects[value] = ses.merge(obj, load=False)
+
+            # commit 之后对象会过期, flush 写关联表时需要主键, 为了不逐个 refresh,
+            # 直接用已知的主键还原
+            for value in dict.fromkeys(getattr(obj, self.key) for obj in placeholders):
+                obj = objects[value]
+                if self.pk.key in sa.inspect(obj).expired_attributes:
+                    pk = self.key_to_id.get(value, pending.get(value))
+                    orm.attributes.set_committed_value(obj, self.pk.key, pk)
+
+            # 把集合中的占位符替换成真正的对象, 顺便去重
+            placeholder_ids = {id(obj) for obj in placeholders}
+            for obj in list(ses.new) + list(ses.dirty):
+                for rel_class, rel_key in relationships:
+                    if not isinstance(obj, rel_class):
+                        continue
+                    collection = orm.attributes.instance_dict(obj).get(rel_key)
+                    if not collection:
+                        continue
+                    if not any(id(item) in placeholder_ids for item in collection):
+                        continue
+                    new_collection = list()
+                    seen = set()
+                    for item in collection:
+                        if id(item) in placeholder_ids:
+                            item = objects[getattr(item, self.key)]
+                        if id(item) not in seen:
+                            seen.add(id(item))
+                            new_collection.append(item)
+                    setattr(obj, rel_key, new_collection)
+            for obj in placeholders:
+                if obj in ses:
+                    ses.expunge(obj)
+
+        # SAVEPOINT 提交 (RELEASE) 的时候也会触发 after_commit, 这时只是把新查到的
+        # value 合并到外层事务中. 只有最外层事务提交时才进入进程级别的缓存.
+        @event.listens_for(target, "after_commit")
+        def after_commit(ses: Session):
+            by_transaction = ses.info.get(self._info_key_pending, dict())
+            transaction = self._current(ses)
+            key_to_id = by_transaction.pop(transaction, dict())
+            if transaction.nested:
+                parent = transaction.parent
+                while not (parent.parent is None or parent.nested):
+                    parent = parent.parent
+                by_transaction.setdefault(parent, dict()).update(key_to_id)
+            else:
+                self.key_to_id.update(key_to_id)
+
+        # 没有提交就结束的事务 (rollback, 回滚到 SAVEPOINT, 或者直接 close) 中写入的
+        # value 已经不存在了, 丢弃它们, 并把对应的对象从 Session 级别的缓存中移除.
+        @event.listens_for(target, "after_transaction_end")
+        def after_transaction_end(ses: Session, transaction: orm.SessionTransaction):
+            by_transaction = ses.info.get(self._info_key_pending, dict())
+            key_to_id = by_transaction.pop(transaction, dict())
+            objects = ses.info.get(self._info_key_objects, dict())
+            for value in key_to_id:
+                obj = objects.pop(value, None)
+                if obj is not None and obj in ses:
+                    ses.expunge(obj)
+
+
+tag_cache = GetOrCreateCache(Tag, "name")
+
+
+class Post(Base, sam.ExtendedBase):
+    __tablename__ = "post"
+
+    post_id = sa.Column(sa.Integer, primary_key=True)
+    title = sa.Column(sa.String(length=128))
+
+    tags = relationship("Tag", secondary=lambda: t_post_and_tag)
+
+    # proxy the "name" attribute from the "tags" relationship
+    tags_proxy = association_proxy(
+        target_collection="tags", attr="name",
+        creator=tag_cache.creator,
+    )
+
+
+# 只有用这个 sessionmaker 创建的 Session 才会去重
+SessionWithTagCache = orm.sessionmaker(engine)
+tag_cache.listen(SessionWithTagCache)
+
+Base.metadata.create_all(engine)
+
+with SessionWithTagCache() as ses:
+    post = Post(post_id=1, title="Hello World")
+    post.tags_proxy.append("Python")
+    post.tags_proxy.append("Sqlalchemy")
+    ses.add(post)
+    ses.commit()
+
+    # 已经存在的 tag 不会重复创建, 同一个 Post 中重复的 tag 会被去掉
+    post = Post(post_id=2, title="Hello Python")
+    post.tags_proxy.extend(["Python", "Python", "Database"])
+    ses.add(post)
+    ses.commit()
+    assert post.tags_proxy == ["Python", "Database"]
+    tag_python = [tag for tag in ses.get(Post, 1).tags if tag.name == "Python"][0]
+    assert tag_python in ses.get(Post, 2).tags
+
+    # 给已有的 Post 新增 tag
+    ses.get(Post, 1).tags_proxy.append("Database")
+    ses.commit()
+
+    print(sam.pt.from_everything(Tag, engine))
+    print(sam.pt.from_everything(t_post_and_tag, engine))
+    assert ses.scalar(sa.select(sa.func.count()).select_from(Tag)) == 3
+    assert ses.scalar(sa.select(sa.func.count()).select_from(t_post_and_tag)) == 5
+    assert tag_cache.key_to_id == {"Python": 1, "Sqlalchemy": 2, "Database": 3}
+
+    # rollback 时新写入的 tag 不会进入进程级别的缓存
+    post = Post(post_id=3, title="Rollback")
+    post.tags_proxy.append("Rollback")
+    ses.add(post)
+    ses.flush()
+    ses.rollback()
+    assert "Rollback" not in tag_cache.key_to_id
+
+    # 回滚 SAVEPOINT 只丢弃 SAVEPOINT 中写入的 tag, 外层事务中的在提交后进入缓存
+    post = Post(post_id=3, title="Savepoint")
+    post.tags_proxy.append("Outer")
+    ses.add(post)
+    ses.flush()
+    savepoint = ses.begin_nested()
+    post = Post(post_id=4, title="Savepoint")
+    post.tags_proxy.append("Inner")
+    ses.add(post)
+    ses.flush()
+    savepoint.rollback()
+    with ses.begin_nested():
+        post = Post(post_id=5, title="Savepoint")
+        post.tags_proxy.append("Released")
+        ses.add(post)
+    assert "Released" not in tag_cache.key_to_id
+    ses.commit()
+    assert "Outer" in tag_cache.key_to_id
+    assert "Inner" not in tag_cache.key_to_id
+    assert "Released" in tag_cache.key_to_id
+    assert ses.get(Post, 4) is None
+    assert ses.scalars(sa.select(Tag.name).where(Tag.name == "Inner")).all() == []
+
+    # 用户自己创建的 Tag 不是占位符, 按普通的 ORM 对象写入
+    tag = Tag(name="Manual")
+    ses.add(tag)
+    ses.commit()
+    assert tag.tag_id is not None
+    assert "Manual" not in tag_cache.key_to_id
+
+with engine.begin() as conn:
+    conn.execute(t_post_and_tag.delete())
+    conn.execute(Post.__table__.delete())
+    conn.execute(Tag.__table__.delete())
+tag_cache.clear()
+
+# --- Benchmark
+N_TAG = 1000
+N_POST = 20000
+N_TAG_PER_POST = 3
+BATCH_SIZE = 1000
+
+random.seed(1)
+tag_names = [f"tag-{i}" for i in range(N_TAG)]
+posts = [
+    (post_id, random.sample(tag_names, N_TAG_PER_POST))
+    for post_id in range(1, 1 + N_POST)
+]
+
+n_query = 0
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    global n_query
+    n_query += 1
+
+
+def get_or_create_by_select(ses: Session, name: str) -> Tag:
+    """
+    常见的做法: 每个 name 都先查一次.
+    """
+    tag = ses.scalars(sa.select(Tag).where(Tag.name == name)).one_or_none()
+    if tag is None:
+        tag = Tag(name=name)
+        ses.add(tag)
+    return tag
+
+
+def import_by_select():
+    with Session(engine) as ses:
+        for i in range(0, N_POST, BATCH_SIZE):
+            for post_id, names in posts[i:i + BATCH_SIZE]:
+                ses.add(Post(
+                    post_id=post_id,
+                    tags=[get_or_create_by_select(ses, name) for name in names],
+                ))
+            ses.commit()
+
+
+def import_by_cache():
+    with SessionWithTagCache() as ses:
+        for i in range(0, N_POST, BATCH_SIZE):
+            for post_id, names in posts[i:i + BATCH_SIZE]:
+                post = Post(post_id=post_id)
+                post.tags_proxy.extend(names)
+                ses.add(post)
+            ses.commit()
+
+
+for name, func in [
+    ("get or create by select", import_by_select),
+    ("get or create by cache", import_by_cache),
+]:
+    n_query = 0
+    st = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - st
+    # 每一批固定有 BEGIN 之后的 insert post 和 insert post_and_tag 两条语句
+    n_batch = N_POST // BATCH_SIZE
+    print(f"{name}: {elapsed:.2f} sec, {(n_query - 2 * n_batch) / n_batch:.1f} queries per batch")
+
+    with engine.begin() as conn:
+        n_tag = conn.execute(sa.select(sa.func.count()).select_from(Tag)).scalar()
+        n_asso = conn.execute(sa.select(sa.func.count()).select_from(t_post_and_tag)).scalar()
+        assert n_tag == N_TAG
+        assert n_asso == N_POST * N_TAG_PER_POST
+        conn.execute(t_post_and_tag.delete())
+        conn.execute(Post.__table__.delete())
+        conn.execute(Tag.__table__.delete())
+    tag_cache.clear()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""
+``Base.prepare(autoload_with=engine)`` 每次启动都要反射整个数据库. 每张表都要分别查询
+columns, primary key, foreign keys, indexes, unique constraints 等等, 几百张表就是几千次
+catalog 查询, 需要好几秒. 而 schema 在两次部署之间通常根本没有变化.
+
+:class:`ReflectionCache` 把反射得到的 ``MetaData`` pickle 到本地文件, 文件名中带有 schema
+的指纹 (fingerprint). 算指纹只需要很少的查询:
+
+- SQLite: ``sqlite_master`` 中所有表和索引的 DDL.
+- PostgreSQL: 在数据库端用 ``md5(string_agg(...))`` 对 ``information_schema.columns``,
+    ``pg_constraint``, ``pg_indexes`` 算一个 checksum.
+- 其他数据库: 读标准的 ``information_schema.columns`` 和
+    ``information_schema.table_constraints``, 在 Python 端算 checksum. 这需要两次查询,
+    而且 ``information_schema`` 中没有索引, 只改索引不会改变指纹.
+
+指纹没变就直接读 pickle, 然后把 ``MetaData`` 交给 ``automap_base(metadata=...)``, 调用
+``Base.prepare()`` 时不用再访问数据库.
+
+注意:
+
+- pickle 文件只能来自可信的来源, 不要从不可信的位置加载.
+- SQLAlchemy 版本不同时 pickle 的格式可能不兼容, 所以文件名中也带上了 SQLAlchemy 的版本.
+- 写入新的缓存文件之后, 同一个数据库和 schema 的旧文件 (旧的指纹, 旧的 SQLAlchemy 版本)
+    会被删掉, 缓存目录不会越积越多. 文件名中带有数据库 URL (不含密码) 的 hash, 多个数据库
+    共用一个缓存目录时不会删掉彼此的文件.
+
+在 300 张表的 SQLite 数据库上的结果如下. 缓存省掉的是反射, 几千次 catalog 查询变成了一次.
+剩下的 ``prepare`` 是 automap 在内存中生成类和 relationship 的时间, 跟缓存无关, 如果只需要
+``Table`` 而不需要 ORM 类, 直接用 :meth:`ReflectionCache.reflect` 返回的 ``MetaData`` 即可::
+
+    cold start: cache hit = False, reflect 653.7 ms, 2705 queries, prepare 292.6 ms
+    warm start: cache hit = True, reflect 122.3 ms, 1 queries, prepare 400.8 ms
+"""
+
+import typing as T
+import os
+import hashlib
+import pickle
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import sqlalchemy as sa
+import sqlalchemy.event as event
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.automap import automap_base
+import sqlalchemy_mate as sam
+
+
+def schema_fingerprint(conn: sa.Connection, schema: T.Optional[str] = None) -> str:
+    """
+    用一次查询得到当前 schema 的指纹. schema 中任何表, 列, 约束, 索引的变化都会改变指纹.
+    """
+    if conn.dialect.name == "sqlite":
+        sqlite_master = "sqlite_master" if schema is None else f"{schema}.sqlite_master"
+        rows = conn.execute(sa.text(
+            f"SELECT type, name, tbl_name, sql FROM {sqlite_master} "
+            "WHERE name NOT LIKE 'sqlite_%' "
+            "ORDER BY type, name"
+        )).all()
+        return hashlib.md5(repr(rows).encode("utf-8")).hexdigest()
+    elif conn.dialect.name == "postgresql":
+        return conn.execute(
+            sa.text(
+                """
+                SELECT md5(
+                    coalesce((
+                        SELECT string_agg(
+                            concat_ws(',', table_name, column_name, data_type,
+                                      is_nullable, column_default, character_maximum_length,
+                                      numeric_precision, numeric_scale),
+                            ';' ORDER BY table_name, ordinal_position
+                        )
+                        FROM information_schema.columns
+                        WHERE table_schema = :schema
+                    ), '')
+                    || coalesce((
+                        SELECT string_agg(
+                            concat_ws(',', conrelid::regclass::text, conname,
+                                      pg_get_constraintdef(c.oid)),
+                            ';' ORDER BY conrelid::regclass::text, conname
+                        )
+                        FROM pg_constraint c
+                        JOIN pg_namespace n ON n.oid = c.connamespace
+                        WHERE n.nspname = :schema
+                    ), '')
+                    || coalesce((
+                        SELECT string_agg(indexdef, ';' ORDER BY tablename, indexname)
+                        FROM pg_indexes
+                        WHERE schemaname = :schema
+                    ), '')
+                )
+                """
+            ),
+            dict(schema=schema or "public"),
+        ).scalar()
+    else:
+        schema = schema or conn.dialect.default_schema_name
+        columns = conn.execute(
+            sa.text(
+                "SELECT table_name, column_name, data_type, is_nullable, column_default, "
+                "character_maximum_length, numeric_precision, numeric_scale "
+                "FROM information_schema.columns "
+                "WHERE table_schema = :schema "
+                "ORDER BY table_name, ordinal_position"
+            ),
+            dict(schema=schema),
+        ).all()
+        constraints = conn.execute(
+            sa.text(
+                "SELECT table_name, constraint_name, constraint_type "
+                "FROM information_schema.table_constraints "
+                "WHERE table_schema = :schema "
+                "ORDER BY table_name, constraint_name"
+            ),
+            dict(schema=schema),
+        ).all()
+        data = repr([tuple(row) for row in columns + constraints])
+        return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+class ReflectionCache:
+    """
+    以 schema 指纹为 key 的 ``MetaData`` 反射缓存.
+
+    :param dir_cache: pickle 文件所在的目录.
+    """
+
+    def __init__(self, dir_cache: Path):
+        self.dir_cache = Path(dir_cache)
+
+    def _prefix(self, conn: sa.Connection, schema: T.Optional[str]) -> str:
+        url = conn.engine.url.render_as_string(hide_password=True)
+        database = hashlib.md5(url.encode("utf-8")).hexdigest()[:12]
+        return f"{conn.dialect.name}-{database}-{schema or 'default'}-sa"
+
+    def _path(self, conn: sa.Connection, schema: T.Optional[str], fingerprint: str) -> Path:
+        return self.dir_cache / (
+            f"{self._prefix(conn, schema)}{sa.__version__}-{fingerprint}.pickle"
+        )
+
+    def _write(self, path: Path, data: bytes):
+        """
+        先写到同一个目录下的临时文件再 rename. 临时文件名是唯一的, 多个进程同时写
+        不会互相覆盖, 也不会读到写了一半的文件.
+        """
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        fd, path_tmp = tempfile.mkstemp(dir=self.dir_cache, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(path_tmp, path)
+        except BaseException:
+            os.unlink(path_tmp)
+            raise
+
+    def _prune(self, conn: sa.Connection, schema: T.Optional[str], keep: Path):
+        """
+        删掉同一个数据库和 schema 的其他缓存文件.
+        """
+        for path in self.dir_cache.glob(f"{self._prefix(conn, schema)}*.pickle"):
+            if path != keep:
+                path.unlink(missing_ok=True)
+
+    def _reflect(self, conn: sa.Connection, schema: T.Optional[str]) -> sa.MetaData:
+        metadata = sa.MetaData(schema=schema)
+        metadata.reflect(conn)
+        return metadata
+
+    def reflect(
+        self,
+        engine: sa.Engine,
+        schema: T.Optional[str] = None,
+    ) -> T.Tuple[sa.MetaData, bool]:
+        """
+        :return: (MetaData, 是否命中缓存)
+        """
+        with engine.connect() as conn:
+            fingerprint = schema_fingerprint(conn, schema)
+            path = self._path(conn, schema, fingerprint)
+            try:
+                return pickle.loads(path.read_bytes()), True
+            # 不存在, 或者刚被另一个进程当作旧文件删掉了
+            except FileNotFoundError:
+                pass
+
+            metadata = self._reflect(conn, schema)
+            # 如果反射的过程中 schema 变了, 就不写缓存
+            if schema_fingerprint(conn, schema) == fingerprint:
+                # 外键链特别长时 pickle 会超过递归深度, 这时放弃缓存
+                try:
+                    data = pickle.dumps(metadata)
+                except RecursionError:  # pragma: no cover
+                    return metadata, False
+                self._write(path, data)
+                self._prune(conn, schema, keep=path)
+            return metadata, False
+
+    def automap_base(self, engine: sa.Engine, schema: T.Optional[str] = None):
+        """
+        返回已经 prepare 好的 automap Base.
+        """
+        metadata, _ = self.reflect(engine, schema)
+        Base = automap_base(metadata=metadata)
+        Base.prepare()
+        return Base
+
+
+def initialize_database(engine, n_table: int):
+    """
+    创建 n_table 张互相有外键关联的表, 每张表有几个列, 一个索引.
+    """
+    random.seed(1)
+    metadata = sa.MetaData()
+    for i in range(n_table):
+        columns = [
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("name", sa.String(64), nullable=False),
+            sa.Column("value", sa.Float),
+            sa.Column("create_at", sa.DateTime),
+        ]
+        if i > 0:
+            parent = random.randint(0, i - 1)
+            columns.append(sa.Column("parent_id", sa.Integer, sa.ForeignKey(f"t{parent}.id")))
+        sa.Table(f"t{i}", metadata, *columns, sa.Index(f"ix_t{i}_name", "name"))
+    metadata.create_all(engine)
+
+
+N_TABLE = 300
+
+with tempfile.TemporaryDirectory() as dir_tmp:
+    dir_tmp = Path(dir_tmp)
+    engine = sam.EngineCreator().create_sqlite(path=str(dir_tmp / "db.sqlite"))
+    initialize_database(engine, N_TABLE)
+    cache = ReflectionCache(dir_tmp / "reflection-cache")
+
+    n_query = 0
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        global n_query
+        n_query += 1
+
+    for name in ["cold start", "warm start"]:
+        n_query = 0
+        st = time.perf_counter()
+        metadata, hit = cache.reflect(engine)
+        elapsed_reflect = time.perf_counter() - st
+        st = time.perf_counter()
+        Base = automap_base(metadata=metadata)
+        Base.prepare()
+        elapsed_prepare = time.perf_counter() - st
+        print(
+            f"{name}: cache hit = {hit}, reflect {elapsed_reflect * 1000:.1f} ms, "
+            f"{n_query} queries, prepare {elapsed_prepare * 1000:.1f} ms"
+        )
+
+    # 缓存中的 MetaData 和直接反射的完全一致
+    metadata, hit = cache.reflect(engine)
+    assert hit is True
+    expected = sa.MetaData()
+    expected.reflect(engine)
+    assert sorted(metadata.tables) == sorted(expected.tables)
+    for table_name, table in expected.tables.items():
+        assert repr(metadata.tables[table_name]) == repr(table)
+
+    # t1 的外键一定指向 t0
+    T1 = Base.classes.t1
+    with Session(engine) as ses:
+        ses.add(Base.classes.t0(id=1, name="parent"))
+        ses.add(T1(id=1, name="child", parent_id=1))
+        ses.commit()
+        assert ses.get(T1, 1).t0.name == "parent"
+
+    # schema 变化后指纹会变, 重新反射
+    with engine.begin() as conn:
+        conn.execute(sa.text("ALTER TABLE t0 ADD COLUMN note VARCHAR(64)"))
+    metadata, hit = cache.reflect(engine)
+    assert hit is False
+    assert "note" in metadata.tables["t0"].c
+    metadata, hit = cache.reflect(engine)
+    assert hit is True
+    # 旧指纹的缓存文件已经被删掉了, 也没有残留的临时文件
+    assert len(list(cache.dir_cache.iterdir())) == 1
+
+    # 另一个数据库共用缓存目录, 不会删掉第一个数据库的缓存
+    engine2 = sam.EngineCreator().create_sqlite(path=str(dir_tmp / "db2.sqlite"))
+    initialize_database(engine2, 3)
+    metadata, hit = cache.reflect(engine2)
+    assert hit is False and sorted(metadata.tables) == ["t0", "t1", "t2"]
+    assert len(list(cache.dir_cache.iterdir())) == 2
+    metadata, hit = cache.reflect(engine)
+    assert hit is True and len(metadata.tables) == N_TABLE
+
+    engine.dispose()
+    engine2.dispose()
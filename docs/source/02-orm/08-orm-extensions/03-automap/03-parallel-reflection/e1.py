@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""
+当 ``02-reflection-cache`` 中的缓存没有命中时, 仍然需要完整的反射一次. ``MetaData.reflect``
+只用一个连接, 依次获取所有表的 columns, primary key, foreign keys, indexes 等信息.
+
+:func:`reflect_parallel` 把反射分成两步:
+
+1. 把表名分成若干组, 用线程池为每组开一个连接, 调用 ``Inspector._get_reflection_info``
+    获取这组表的全部反射信息. 这个方法也是 ``MetaData.reflect`` 内部使用的, 返回的是纯
+    Python 的 dict / list, 不涉及 ``Table`` 对象, 可以在不同线程中并行获取.
+2. 在主线程中把各组的结果合并, 按外键的依赖顺序 (被引用的表在前) 创建 ``Table``. 因为
+    所有信息都已经在 ``_reflect_info`` 中了, 这一步不会再访问数据库.
+
+结果和串行的 ``MetaData.reflect`` 完全一样. 想要和反射缓存一起用, 只需要把
+``ReflectionCache._reflect`` 替换成 :func:`reflect_parallel`.
+
+注意:
+
+- ``_get_reflection_info`` 和 ``_reflect_info`` 参数是 SQLAlchemy 2.0 的内部 API, 升级
+    SQLAlchemy 时需要检查.
+- 并行能提速多少, 取决于时间花在哪里. 数据库的网络往返和查询本身是可以并行的, 而
+    SQLAlchemy 解析结果的 Python 代码受 GIL 限制. PostgreSQL 的 dialect 本身已经用
+    ``get_multi_*`` 把每一类信息合并成一次查询, 并行主要是把几条大查询分摊到多个连接上.
+    SQLite 的每张表都要执行若干条 ``PRAGMA``, 但内存中执行得非常快, 主要是 Python 开销.
+
+500 张表的结果如下. 本地 SQLite 上几乎没有区别, 因为时间都花在受 GIL 限制的 Python 代码上.
+给每次查询加上 0.5 ms 的模拟网络延迟后 (更接近远程数据库), 4 个线程快了 2.5 倍. 脚本最后
+会在 ``learn_sqlalchemy.db.engine_psql`` 可以连接时, 在一个新建的 schema 中跑同样的
+PostgreSQL benchmark, 结束后删除这个 schema. PostgreSQL 的 benchmark 还没有实际跑过,
+下面只有 SQLite 的结果::
+
+    sqlite serial reflect 500 tables: 0.858 sec
+    sqlite parallel reflect 500 tables, 2 workers: 0.727 sec
+    sqlite parallel reflect 500 tables, 4 workers: 0.829 sec
+    sqlite parallel reflect 500 tables, 8 workers: 0.910 sec
+    sqlite + 0.5 ms latency serial reflect 500 tables: 4.140 sec
+    sqlite + 0.5 ms latency parallel reflect 500 tables, 2 workers: 2.285 sec
+    sqlite + 0.5 ms latency parallel reflect 500 tables, 4 workers: 1.609 sec
+    sqlite + 0.5 ms latency parallel reflect 500 tables, 8 workers: 1.699 sec
+"""
+
+import typing as T
+import time
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy as sa
+import sqlalchemy.exc as exc
+import sqlalchemy.event as event
+import sqlalchemy_mate as sam
+from sqlalchemy.engine.reflection import ObjectKind, ObjectScope
+
+
+def _get_reflection_info(
+    engine: sa.Engine,
+    schema: T.Optional[str],
+    names: T.List[str],
+    available: T.List[str],
+):
+    with engine.connect() as conn:
+        insp = sa.inspect(conn)
+        return insp._get_reflection_info(
+            schema=schema,
+            filter_names=names,
+            available=available,
+            kind=ObjectKind.TABLE,
+            scope=ObjectScope.ANY,
+        )
+
+
+def _dependency_order(schema: T.Optional[str], names: T.List[str], reflect_info) -> T.List[str]:
+    """
+    按外键的依赖关系排序, 被引用的表在前. 有环的部分保持原来的顺序放在最后.
+    """
+    deps = {
+        name: {
+            fk["referred_table"]
+            for fk in reflect_info.foreign_keys.get((schema, name), [])
+            if fk["referred_table"] != name and fk.get("referred_schema") == schema
+        }
+        for name in names
+    }
+    ordered = list()
+    done = set()
+    pending = list(names)
+    while pending:
+        ready = [name for name in pending if deps[name] <= done]
+        if not ready:
+            ordered.extend(pending)
+            break
+        ordered.extend(ready)
+        done.update(ready)
+        pending = [name for name in pending if name not in done]
+    return ordered
+
+
+def reflect_parallel(
+    engine: sa.Engine,
+    schema: T.Optional[str] = None,
+    max_workers: int = 8,
+) -> sa.MetaData:
+    """
+    和 ``MetaData(schema=schema).reflect(engine)`` 等价, 但用线程池并行的获取反射信息.
+
+    :param max_workers: 线程数, 也就是同时使用的连接数, 不要超过连接池的大小.
+    """
+    metadata = sa.MetaData(schema=schema)
+    with engine.connect() as conn:
+        available = sa.inspect(conn).get_table_names(schema)
+    if not available:
+        return metadata
+
+    n_chunk = min(max_workers, len(available))
+    chunks = [available[i::n_chunk] for i in range(n_chunk)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        infos = list(pool.map(
+            lambda names: _get_reflection_info(engine, schema, names, available),
+            chunks,
+        ))
+    reflect_info = infos[0]
+    for info in infos[1:]:
+        reflect_info.update(info)
+
+    with engine.connect() as conn:
+        insp = sa.inspect(conn)
+        reflect_opts = dict(
+            autoload_with=insp,
+            resolve_fks=True,
+            _extend_on=set(),
+            _reflect_info=reflect_info,
+        )
+        if schema is not None:
+            reflect_opts["schema"] = schema
+        for name in _dependency_order(schema, available, reflect_info):
+            try:
+                sa.Table(name, metadata, **reflect_opts)
+            except exc.UnreflectableTableError as e:  # pragma: no cover
+                sa.util.warn(f"Skipping table {name}: {e}")
+    return metadata
+
+
+def initialize_database(
+    engine: sa.Engine,
+    n_table: int,
+    schema: T.Optional[str] = None,
+) -> sa.MetaData:
+    """
+    创建 n_table 张互相有外键关联的表, 每张表有几个列, 一个索引, 一个唯一约束.
+    数据库必须是空的 (或者 schema 是新建的), 这里不会删除任何已有的表.
+    """
+    metadata = sa.MetaData(schema=schema)
+    for i in range(n_table):
+        columns = [
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("name", sa.String(64), nullable=False),
+            sa.Column("code", sa.String(16), unique=True),
+            sa.Column("value", sa.Float),
+            sa.Column("create_at", sa.DateTime),
+        ]
+        if i > 0:
+            columns.append(sa.Column("parent_id", sa.Integer, sa.ForeignKey(f"t{i // 2}.id")))
+        sa.Table(f"t{i}", metadata, *columns, sa.Index(f"ix_t{i}_name", "name"))
+    metadata.create_all(engine)
+    return metadata
+
+
+def describe(metadata: sa.MetaData) -> T.Dict[str, T.Any]:
+    """
+    把 MetaData 中所有会被反射的信息转成可以比较的结构.
+    """
+    return {
+        name: (
+            repr(table),
+            sorted(
+                (fk.parent.name, fk.target_fullname)
+                for fk in table.foreign_keys
+            ),
+            sorted(
+                (index.name, tuple(col.name for col in index.columns), index.unique)
+                for index in table.indexes
+            ),
+            sorted(
+                tuple(col.name for col in cons.columns)
+                for cons in table.constraints
+                if isinstance(cons, sa.UniqueConstraint)
+            ),
+        )
+        for name, table in metadata.tables.items()
+    }
+
+
+def benchmark(name: str, engine: sa.Engine, n_table: int, schema: T.Optional[str] = None):
+    initialize_database(engine, n_table, schema=schema)
+
+    st = time.perf_counter()
+    expected = sa.MetaData(schema=schema)
+    expected.reflect(engine)
+    elapsed = time.perf_counter() - st
+    print(f"{name} serial reflect {n_table} tables: {elapsed:.3f} sec")
+
+    for max_workers in [2, 4, 8]:
+        st = time.perf_counter()
+        metadata = reflect_parallel(engine, schema=schema, max_workers=max_workers)
+        elapsed = time.perf_counter() - st
+        print(f"{name} parallel reflect {n_table} tables, {max_workers} workers: {elapsed:.3f} sec")
+        assert describe(metadata) == describe(expected)
+        assert [t.name for t in metadata.sorted_tables] == [t.name for t in expected.sorted_tables]
+
+
+N_TABLE = 500
+
+with tempfile.TemporaryDirectory() as dir_tmp:
+    engine = sam.EngineCreator().create_sqlite(path=str(Path(dir_tmp) / "db.sqlite"))
+    benchmark("sqlite", engine, N_TABLE)
+
+    # 模拟远程数据库每次查询 0.5 ms 的网络往返. time.sleep 会释放 GIL,
+    # 就像等待网络 IO 一样
+    @event.listens_for(engine, "before_cursor_execute")
+    def simulate_latency(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(0.0005)
+
+    benchmark("sqlite + 0.5 ms latency", engine, N_TABLE)
+    engine.dispose()
+
+# PostgreSQL 是开发用的数据库, 不能动里面已有的表. 所有表都建在一个新建的 schema 中,
+# 结束后只删除这个 schema. 如果这个 schema 已经存在, CREATE SCHEMA 会报错, 不会覆盖
+PSQL_SCHEMA = "bench_parallel_reflection"
+
+try:
+    from learn_sqlalchemy.db import engine_psql
+
+    with engine_psql.connect():
+        pass
+except Exception as e:  # pragma: no cover
+    print(f"skip postgres benchmark: {e.__class__.__name__}")
+else:
+    with engine_psql.begin() as conn:
+        conn.execute(sa.schema.CreateSchema(PSQL_SCHEMA))
+    try:
+        benchmark("postgres", engine_psql, N_TABLE, schema=PSQL_SCHEMA)
+    finally:
+        with engine_psql.begin() as conn:
+            conn.execute(sa.schema.DropSchema(PSQL_SCHEMA, cascade=True))
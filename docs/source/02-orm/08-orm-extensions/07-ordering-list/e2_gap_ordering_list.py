@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+**问题**
+
+在 ``e1`` 中, ``row1.chairs.insert(0, Chair(id=40))`` 会把这一排所有椅子的 position 都
+重新编号一遍, 每一把椅子都是一次 UPDATE. 列表有 1 万个元素的时候, 在开头插入一个元素就要
+写 1 万行.
+
+**解决方案**
+
+:class:`GapOrderingList` 不再要求 position 等于列表的 index, 只要求 position 的大小顺序
+和列表的顺序一致, 并且在相邻元素之间留出间隔 (gap):
+
+- append: 最后一个元素的 position + gap.
+- insert 到开头: 第一个元素的 position - gap (position 可以是负数).
+- insert 到中间: 左右两个元素 position 的中点. 只写新插入的这一行.
+- 删除元素: 什么都不用做, 留下的空隙以后还能用.
+- 替换元素: 新元素直接继承被替换元素的 position.
+
+只有当两个相邻元素之间没有空隙了, 才需要重新编号. 重新编号时先 flush, 然后用一条
+``UPDATE ... FROM (SELECT row_number() OVER ...)`` 语句在数据库中把整个列表重新按 gap
+编号, 再用 ``set_committed_value`` 同步内存中的值, 这样 ORM 不会再逐行 UPDATE 一遍.
+
+position 用整数而不是浮点数, 因为浮点数每次取中点会损失 1 bit 精度, 大约 50 次之后
+就无法再分, 而且出问题时很难察觉. 整数的 gap 用完了会显式的重新编号.
+
+在内存 SQLite 上对 1 万个元素的列表做 100 次操作, 每次操作写入的行数如下::
+
+    ordering_list insert at head: 10051.5 rows, 2.0 statements per op
+    gap_ordering_list insert at head: 1.0 rows, 1.0 statements per op
+    ordering_list insert at middle: 5001.0 rows, 2.0 statements per op
+    gap_ordering_list insert at middle: 1.0 rows, 1.0 statements per op
+    gap_ordering_list insert at same place: 910.1 rows, 1.1 statements per op
+"""
+
+import typing as T
+import random
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+from sqlalchemy.orm import declarative_base, relationship, Session
+from sqlalchemy.orm.collections import collection, collection_adapter
+from sqlalchemy.ext.orderinglist import ordering_list, OrderingList
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+
+Base = declarative_base()
+
+GAP = 1024
+
+
+class GapOrderingList(OrderingList):
+    """
+    position 之间留有空隙的 ``OrderingList``. 除了需要重新编号的时候, 任何一次修改最多
+    只写一行.
+    """
+
+    def __init__(self, ordering_attr: str, gap: int = GAP):
+        super().__init__(ordering_attr)
+        self.gap = gap
+
+    def _position_between(self, index: int) -> T.Optional[int]:
+        """
+        插入到 index 之前时新元素的 position, 没有空隙了则返回 None.
+        """
+        prev = self._get_order_value(self[index - 1]) if index > 0 else None
+        next = self._get_order_value(self[index]) if index < len(self) else None
+        if prev is None and next is None:
+            return self.gap
+        if prev is None:
+            return next - self.gap
+        if next is None:
+            return prev + self.gap
+        if next - prev > 1:
+            return (prev + next) // 2
+        return None
+
+    @collection.appender
+    @collection.internally_instrumented
+    def _sa_append(self, entity, _sa_initiator=None):
+        """
+        ORM 向集合中添加元素的入口. 从数据库加载集合时 ``_sa_initiator`` 是 False,
+        保留数据库中的 position, 其他情况和用户调用 append 一样重新分配 position.
+        """
+        if _sa_initiator is False:
+            list.append(self, entity)
+        else:
+            self.append(entity, _sa_initiator=_sa_initiator)
+
+    def append(self, entity):
+        # 元素可能是从列表的其他位置或者其他列表移过来的, 旧的 position 不能用
+        self._set_order_value(entity, self._position_between(len(self)))
+        list.append(self, entity)
+
+    def insert(self, index, entity):
+        index = max(0, min(len(self), index if index >= 0 else len(self) + index))
+        position = self._position_between(index)
+        if position is None:
+            self.reorder()
+            position = self._position_between(index)
+        self._set_order_value(entity, position)
+        list.insert(self, index, entity)
+
+    def remove(self, entity):
+        list.remove(self, entity)
+
+    def pop(self, index=-1):
+        return list.pop(self, index)
+
+    def __setitem__(self, index, entity):
+        if isinstance(index, slice):
+            OrderingList.__setitem__(self, index, entity)
+        else:
+            self._set_order_value(entity, self._get_order_value(self[index]))
+            list.__setitem__(self, index, entity)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+
+    def reorder(self) -> None:
+        """
+        把整个列表重新按 gap 编号.
+
+        如果集合的 owner 已经持久化了, 就用一条 UPDATE 语句在数据库中编号, 否则
+        (所有的元素都还没写入数据库) 直接修改内存中的值.
+        """
+        adapter = collection_adapter(self)
+        owner_state = adapter.owner_state if adapter else None
+        ses = owner_state.session if owner_state else None
+        if ses is None or owner_state.key is None:
+            for index, entity in enumerate(self):
+                self._set_order_value(entity, (index + 1) * self.gap)
+            return
+
+        # 先 flush 让数据库中的 position 和内存中的一致, 然后按 position 的顺序编号
+        ses.flush()
+        rel = owner_state.mapper.relationships[adapter.attr.key]
+        table: sa.Table = rel.target
+        column = table.c[self.ordering_attr]
+        pk = list(rel.mapper.primary_key)
+        owned_by = sa.and_(*[
+            remote == owner_state.mapper._get_committed_state_attr_by_column(
+                owner_state, owner_state.dict, local,
+            )
+            for local, remote in rel.local_remote_pairs
+        ])
+        ranked = (
+            sa.select(
+                *pk,
+                sa.func.row_number().over(order_by=column).label("rank"),
+            )
+            .where(owned_by)
+            .subquery("ranked")
+        )
+        stmt = (
+            sa.update(table)
+            .values({column: ranked.c.rank * self.gap})
+            .where(*[col == ranked.c[col.key] for col in pk])
+        )
+        ses.execute(stmt, execution_options=dict(synchronize_session=False))
+        for index, entity in enumerate(self):
+            orm.attributes.set_committed_value(
+                entity, self.ordering_attr, (index + 1) * self.gap,
+            )
+
+    _reorder = reorder
+
+
+def gap_ordering_list(attr: str, gap: int = GAP) -> T.Callable[[], GapOrderingList]:
+    """
+    和 ``ordering_list`` 一样, 作为 ``relationship`` 的 ``collection_class``.
+    """
+    return lambda: GapOrderingList(attr, gap=gap)
+
+
+class Row(Base, sam.ExtendedBase):
+    __tablename__ = "row"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+
+    # 注意 order_by 必须是 position
+    chairs = relationship(
+        "Chair",
+        order_by="Chair.position",
+        collection_class=gap_ordering_list("position"),
+    )
+
+
+class Chair(Base, sam.ExtendedBase):
+    __tablename__ = "chair"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    row_id = sa.Column(sa.Integer, sa.ForeignKey("row.id"))
+    position = sa.Column(sa.Integer)
+
+    __table_args__ = (
+        sa.Index("ix_chair_row_id_position", "row_id", "position"),
+    )
+
+
+class DenseRow(Base, sam.ExtendedBase):
+    """
+    对比用, 使用原生的 ``ordering_list``.
+    """
+    __tablename__ = "dense_row"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+
+    chairs = relationship(
+        "DenseChair",
+        order_by="DenseChair.position",
+        collection_class=ordering_list("position"),
+    )
+
+
+class DenseChair(Base, sam.ExtendedBase):
+    __tablename__ = "dense_chair"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    row_id = sa.Column(sa.Integer, sa.ForeignKey("dense_row.id"))
+    position = sa.Column(sa.Integer)
+
+
+Base.metadata.create_all(engine)
+
+row1 = Row(id=1)
+row1.chairs.append(Chair(id=30))
+row1.chairs.append(Chair(id=10))
+row1.chairs.insert(1, Chair(id=20))
+assert [chair.id for chair in row1.chairs] == [30, 20, 10]
+assert [chair.position for chair in row1.chairs] == [1024, 1536, 2048]
+
+with Session(engine) as ses:
+    ses.add(row1)
+    ses.commit()
+
+    row1.chairs.insert(0, Chair(id=40))
+    ses.commit()
+    assert [chair.position for chair in row1.chairs] == [0, 1024, 1536, 2048]
+    print(sam.pt.from_everything(Chair, ses))
+
+    # 一直往同一个位置插入, 空隙用完之后会重新编号
+    for chair_id in range(100, 120):
+        row1.chairs.insert(1, Chair(id=chair_id))
+    ses.commit()
+    expected = [chair.id for chair in row1.chairs]
+    assert expected[:2] == [40, 119]
+    assert expected[-4:] == [100, 30, 20, 10]
+
+    ses.expire_all()
+    assert [chair.id for chair in ses.get(Row, 1).chairs] == expected
+    positions = [chair.position for chair in ses.get(Row, 1).chairs]
+    assert positions == sorted(set(positions))
+
+    # 删除和替换不会影响其他元素
+    row1.chairs.pop(1)
+    row1.chairs[1] = Chair(id=200)
+    ses.commit()
+    ses.expire_all()
+    assert [chair.id for chair in ses.get(Row, 1).chairs][:3] == [40, 200, 117]
+
+    # 把第一个元素移到末尾, 它原来的 position 不能保留
+    row1 = ses.get(Row, 1)
+    chair = row1.chairs.pop(0)
+    row1.chairs.append(chair)
+    ses.commit()
+    ses.expire_all()
+    assert [chair.id for chair in ses.get(Row, 1).chairs][-2:] == [10, 40]
+
+# --- Benchmark
+N_ITEM = 10000
+N_OP = 100
+
+n_statement = 0
+n_row = 0
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def count_write(conn, cursor, statement, parameters, context, executemany):
+    global n_statement, n_row
+    if statement.startswith(("INSERT", "UPDATE")):
+        n_statement += 1
+        n_row += cursor.rowcount
+
+
+def benchmark(
+    row_class: T.Type[Base],
+    chair_class: T.Type[Base],
+    name: str,
+    get_index: T.Callable[[int], int],
+):
+    global n_statement, n_row
+    # 不让 commit 把 1 万个元素都过期, 否则每次操作都要重新加载整个列表
+    with Session(engine, expire_on_commit=False) as ses:
+        ses.execute(sa.delete(chair_class))
+        ses.execute(sa.delete(row_class))
+        row = row_class(id=1)
+        row.chairs.extend([chair_class(id=i) for i in range(1, 1 + N_ITEM)])
+        ses.add(row)
+        ses.commit()
+        row = ses.get(row_class, 1)
+        _ = row.chairs
+
+        n_statement = 0
+        n_row = 0
+        st = time.perf_counter()
+        for i in range(N_OP):
+            row.chairs.insert(get_index(len(row.chairs)), chair_class(id=N_ITEM + 1 + i))
+            ses.commit()
+        elapsed = time.perf_counter() - st
+        print(
+            f"{name}: {n_row / N_OP:.1f} rows, {n_statement / N_OP:.1f} statements per op, "
+            f"{elapsed / N_OP * 1000:.3f} ms per op"
+        )
+
+
+random.seed(1)
+for where, get_index in [
+    ("insert at head", lambda n: 0),
+    ("insert at middle", lambda n: random.randint(1, n - 1)),
+]:
+    benchmark(DenseRow, DenseChair, f"ordering_list {where}", get_index)
+    benchmark(Row, Chair, f"gap_ordering_list {where}", get_index)
+
+# 最坏的情况: 一直往同一个位置插入, 每 log2(GAP) = 10 次就要重新编号一次
+benchmark(Row, Chair, "gap_ordering_list insert at same place", lambda n: 1)
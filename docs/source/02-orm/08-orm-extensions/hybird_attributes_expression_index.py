@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""
+``hybird_attributes.py`` 中按 ``Interval.length`` 或者 ``Interval.radius`` 过滤时, 数据库
+只能全表扫描, 因为没有任何索引覆盖 ``"end" - start`` 这个计算出来的值.
+
+SQLite (3.9+) 和 PostgreSQL 都支持对表达式建索引 (expression index / functional index).
+只要查询中的表达式和建索引时的表达式完全一样, 就能用上索引. 本例提供了一个
+:func:`expression_index` 装饰器, 给 hybrid 加上之后:
+
+1. 在 mapper 构造完成时 (``after_mapper_constructed`` 事件), 用 hybrid 的 SQL 表达式
+    自动生成一个 ``sa.Index``, ``create_all`` 时会一起创建.
+2. hybrid 表达式中的常量 (例如 radius 的 ``/ 2``) 默认是绑定参数 ``?``, 而索引的 DDL 中
+    只能是字面值 ``2``. SQLite 的查询优化器认为 ``abs("end" - start) / ?`` 和
+    ``abs("end" - start) / 2`` 不是同一个表达式, 就不会用索引. 所以装饰器会把表达式中的
+    常量改成 ``literal_execute``, 执行时直接渲染成字面值, 和索引保持一致
+    (``learn_sqlalchemy.sql.inline_literals``).
+
+:func:`explain` 在查询用的 engine 上注册 ``before_cursor_execute`` 事件, 在真正发送的 SQL
+(包括参数) 前面加上 ``EXPLAIN QUERY PLAN`` (SQLite) 或者 ``EXPLAIN`` (PostgreSQL), 以此
+验证查询确实用上了索引. 事件只注册在这一个 engine 上, 不影响进程中的其他 engine.
+PostgreSQL 的计划中会出现 ``Index Scan using ix_interval_radius``, 同样可以用
+:func:`uses_index` 判断. 注意 PostgreSQL 要求索引中的函数是 ``IMMUTABLE`` 的.
+
+在 20 万行的 SQLite 表上的结果如下, 最后一个是常量为绑定参数时的查询, 计划是
+``SCAN interval``::
+
+    length with index: 200 rows, 0.375 ms per query
+    radius with index: 400 rows, 0.660 ms per query
+    radius without index: 400 rows, 29.637 ms per query
+"""
+
+import typing as T
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method, HybridExtensionType
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+from learn_sqlalchemy.sql import inline_literals
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+def expression_index(name: T.Optional[str] = None, unique: bool = False):
+    """
+    给 hybrid_property 加上一个表达式索引.
+
+    :param name: 索引名, 默认是 ``ix_{表名}_{hybrid 名}``.
+    """
+
+    def decorator(hybrid: hybrid_property) -> hybrid_property:
+        expr_func = hybrid.expr or hybrid.fget
+        hybrid = hybrid.expression(lambda cls: inline_literals(expr_func(cls)))
+        hybrid.info["expression_index"] = dict(name=name, unique=unique)
+        return hybrid
+
+    return decorator
+
+
+@event.listens_for(Base, "after_mapper_constructed", propagate=True)
+def create_expression_index(mapper: orm.Mapper, class_: T.Type[Base]):
+    for key, descriptor in mapper.all_orm_descriptors.items():
+        if descriptor.extension_type is not HybridExtensionType.HYBRID_PROPERTY:
+            continue
+        options = descriptor.info.get("expression_index")
+        if options is None:
+            continue
+        table: sa.Table = mapper.local_table
+        sa.Index(
+            options["name"] or f"ix_{table.name}_{key}",
+            getattr(class_, key).expression,
+            unique=options["unique"],
+        )
+
+
+class Interval(ExtendedBase):
+    __tablename__ = "interval"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    start = sa.Column(sa.Integer, nullable=False)
+    end = sa.Column(sa.Integer, nullable=False)
+
+    @expression_index()
+    @hybrid_property
+    def length(self):
+        return self.end - self.start
+
+    @hybrid_method
+    def contains(self, point):
+        return (self.start <= point) & (point <= self.end)
+
+    @hybrid_property
+    def radius(self):
+        return abs(self.length) / 2
+
+    @expression_index()
+    @radius.expression
+    def radius(cls):
+        return sa.func.abs(cls.length) / 2
+
+
+def _explain(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and context.execution_options.get("explain"):
+        if conn.dialect.name == "sqlite":
+            statement = "EXPLAIN QUERY PLAN " + statement
+        else:
+            statement = "EXPLAIN " + statement
+    return statement, parameters
+
+
+def explain(conn: sa.Connection, stmt: sa.Select) -> T.List[str]:
+    """
+    返回查询计划的每一行. 执行的是和正常查询时完全一样的 SQL 和参数.
+
+    第一次调用时才在这个 engine 上注册 ``before_cursor_execute`` 事件, 不影响其他 engine.
+    """
+    if not event.contains(conn.engine, "before_cursor_execute", _explain):
+        event.listen(conn.engine, "before_cursor_execute", _explain, retval=True)
+    # 注意不要用 conn.execution_options(explain=True), 它会修改 conn 本身
+    result = conn.execute(stmt, execution_options=dict(explain=True))
+    rows = result.cursor.fetchall()
+    result.close()
+    return [row[-1] for row in rows]
+
+
+def uses_index(conn: sa.Connection, stmt: sa.Select, index_name: str) -> bool:
+    return any(index_name in line for line in explain(conn, stmt))
+
+
+Base.metadata.create_all(engine)
+
+assert sorted(index.name for index in Interval.__table__.indexes) == [
+    "ix_interval_length",
+    "ix_interval_radius",
+]
+# 原本的 python 实现不受影响
+assert Interval(start=5, end=1).radius == 2
+
+N_INTERVAL = 200000
+
+with engine.begin() as conn:
+    conn.execute(
+        sa.insert(Interval.__table__),
+        [
+            dict(id=i, start=i, end=i + i % 1000)
+            for i in range(1, 1 + N_INTERVAL)
+        ],
+    )
+    conn.execute(sa.text("ANALYZE"))
+
+stmt_length = sa.select(Interval.id).where(Interval.length == 999)
+stmt_radius = sa.select(Interval.id).where(Interval.radius >= 499)
+# 对照: 同样的表达式, 但常量是绑定参数
+stmt_radius_bind = sa.select(Interval.id).where(
+    sa.func.abs(Interval.end - Interval.start) / 2 >= 499
+)
+
+with engine.connect() as conn:
+    for stmt, index_name in [
+        (stmt_length, "ix_interval_length"),
+        (stmt_radius, "ix_interval_radius"),
+        (stmt_radius_bind, "ix_interval_radius"),
+    ]:
+        print(stmt.compile(engine))
+        print(explain(conn, stmt))
+
+    assert uses_index(conn, stmt_length, "ix_interval_length")
+    assert uses_index(conn, stmt_radius, "ix_interval_radius")
+    assert not uses_index(conn, stmt_radius_bind, "ix_interval_radius")
+    # EXPLAIN 的事件只在这个 engine 上
+    assert event.contains(engine, "before_cursor_execute", _explain)
+    assert not event.contains(sa.Engine, "before_cursor_execute", _explain)
+
+    for name, stmt in [
+        ("length with index", stmt_length),
+        ("radius with index", stmt_radius),
+        ("radius without index", stmt_radius_bind),
+    ]:
+        st = time.perf_counter()
+        for _ in range(100):
+            ids = conn.execute(stmt).scalars().all()
+        elapsed = time.perf_counter() - st
+        print(f"{name}: {len(ids)} rows, {elapsed * 10:.3f} ms per query")
+    assert len(conn.execute(stmt_radius).all()) == len(conn.execute(stmt_radius_bind).all())
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+``hybird_attributes.py`` 中的 ``Interval.length``, ``contains``, ``radius`` 在 Python 中是
+一个对象一个对象的计算的. 对几百万个 Interval 做统计分析时, 真正的计算只占很小一部分,
+时间都花在了构造 ORM 对象和访问属性上.
+
+本例不构造任何 ORM 对象, 而是把需要的列直接读成 NumPy 数组, 然后在整个数组上计算 hybrid:
+
+1. :func:`load_arrays` 用底层 DBAPI cursor 的 ``fetchmany`` 分批读取, 直接写入预先分配
+    好的数组. (SQLAlchemy 的 ``Row`` 转成 NumPy 数组比 tuple 慢很多.) 每一列按类型选择
+    dtype, 可以为 NULL 的列用 masked array 表示 NULL.
+2. :class:`ColumnArrays` 只读要计算的 hybrid 引用到的列, 可以作为 hybrid 的 ``self``
+    传入. ``Interval.length`` 的 Python 实现 ``self.end - self.start`` 在数组上直接就是
+    向量化的运算. ``radius`` 中的 ``abs(self.length)`` 也会自动递归的在数组上计算.
+3. 有些 hybrid 的 Python 实现没法向量化 (例如用了 ``if`` 或者 ``math`` 模块), 这时可以用
+    :func:`compile_numpy` 把 hybrid 的 SQL 表达式树 (``Interval.radius.expression``)
+    翻译成 NumPy 的 ufunc.
+
+知识点:
+
+- hybrid 的 Python 实现只要只用了运算符, 就天然支持 NumPy 数组.
+- SQL 表达式树可以用 ``BinaryExpression.operator``, ``FunctionElement.name`` 等属性遍历.
+
+在 100 万个 Interval 上计算 "包含某个点的 interval 的平均 radius", 结果如下. 数组读进内存
+之后, 可以反复做各种分析, 每次只需要几毫秒::
+
+    orm objects: 11.812 sec
+    numpy by python hybrid: load 0.989 sec, compute 12.4 ms
+    numpy by sql expression: compute 8.4 ms
+    sql aggregate: 67.4 ms
+"""
+
+import typing as T
+import functools
+import operator
+import time
+
+import numpy as np
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method, HybridExtensionType
+from sqlalchemy.sql import elements, functions, visitors
+import sqlalchemy_mate as sam
+from learn_sqlalchemy.db import engine_sqlite as engine
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+class Interval(ExtendedBase):
+    __tablename__ = "interval"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    start = sa.Column(sa.Integer, nullable=False)
+    end = sa.Column(sa.Integer, nullable=False)
+    name = sa.Column(sa.String)
+    weight = sa.Column(sa.Numeric(10, 2))
+
+    @hybrid_property
+    def length(self):
+        return self.end - self.start
+
+    @hybrid_method
+    def contains(self, point):
+        return (self.start <= point) & (point <= self.end)
+
+    @hybrid_property
+    def radius(self):
+        return abs(self.length) / 2
+
+    @radius.expression
+    def radius(cls):
+        return sa.func.abs(cls.length) / 2
+
+    @hybrid_property
+    def weighted_length(self):
+        return self.length * self.weight
+
+
+def _dtype(column: sa.Column) -> np.dtype:
+    """
+    列类型对应的 NumPy dtype. 没有对应的 (例如 String) 用 object.
+    """
+    type_ = column.type
+    if isinstance(type_, sa.Boolean):
+        return np.dtype(np.bool_)
+    if isinstance(type_, sa.Integer):
+        return np.dtype(np.int64)
+    # Float 是 Numeric 的子类. Numeric 读出来是 Decimal, 转成 float64 会损失精度
+    if isinstance(type_, sa.Numeric):
+        return np.dtype(np.float64)
+    if isinstance(type_, sa.DateTime):
+        return np.dtype("datetime64[us]")
+    if isinstance(type_, sa.Date):
+        return np.dtype("datetime64[D]")
+    return np.dtype(object)
+
+
+def load_arrays(
+    conn: sa.Connection,
+    columns: T.List[sa.Column],
+    where: T.Optional[sa.ColumnElement] = None,
+    chunk_size: int = 100000,
+) -> T.Dict[str, np.ndarray]:
+    """
+    把若干列读成 NumPy 数组, 返回 {column.key: array}.
+
+    可以为 NULL 的数值, 布尔, 日期列返回 ``np.ma.MaskedArray``, NULL 的位置被 mask 掉,
+    之后的运算和 ``mean()`` 之类的统计会自动跳过它们. object 类型的列直接用 None 表示
+    NULL.
+    """
+    stmt_count = sa.select(sa.func.count()).select_from(columns[0].table)
+    stmt = sa.select(*columns)
+    if where is not None:
+        stmt_count = stmt_count.where(where)
+        stmt = stmt.where(where)
+    n = conn.execute(stmt_count).scalar()
+    dtypes = [_dtype(col) for col in columns]
+    arrays = [np.empty(n, dtype=dtype) for dtype in dtypes]
+    masks = [
+        np.zeros(n, dtype=np.bool_) if col.nullable and dtype != object else None
+        for col, dtype in zip(columns, dtypes)
+    ]
+    # 绕过 SQLAlchemy 的 Row, 直接用 DBAPI cursor 执行编译好的 SQL
+    compiled = stmt.compile(conn)
+    if compiled.positiontup is None:
+        params = compiled.params
+    else:
+        params = [compiled.params[key] for key in compiled.positiontup]
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(str(compiled), params)
+        i = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            # 按列分别转换, 不同类型的列混在一个 np.array 里会被转成同一个类型
+            for arr, mask, values in zip(arrays, masks, zip(*rows)):
+                if mask is not None:
+                    is_null = np.fromiter((v is None for v in values), np.bool_, len(rows))
+                    if is_null.any():
+                        mask[i:i + len(rows)] = is_null
+                        fill = np.zeros(1, dtype=arr.dtype)[0]
+                        values = [fill if v is None else v for v in values]
+                arr[i:i + len(rows)] = values
+            i += len(rows)
+    finally:
+        cursor.close()
+    return {
+        col.key: arr if mask is None else np.ma.MaskedArray(arr, mask=mask)
+        for col, arr, mask in zip(columns, arrays, masks)
+    }
+
+
+class ColumnArrays:
+    """
+    在列数组上计算 hybrid. 访问列名返回数组, 访问 hybrid_property 返回对整个数组计算
+    的结果, 访问 hybrid_method 返回一个可以调用的函数.
+    """
+
+    def __init__(self, klass: T.Type[Base], arrays: T.Dict[str, np.ndarray]):
+        self._klass = klass
+        self._arrays = arrays
+        self._descriptors = orm.class_mapper(klass).all_orm_descriptors
+
+    def __len__(self):
+        return len(next(iter(self._arrays.values())))
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._arrays:
+            return self._arrays[name]
+        descriptor = self._descriptors.get(name)
+        if descriptor is not None:
+            if descriptor.extension_type is HybridExtensionType.HYBRID_PROPERTY:
+                return descriptor.fget(self)
+            if descriptor.extension_type is HybridExtensionType.HYBRID_METHOD:
+                return functools.partial(descriptor.func, self)
+        raise AttributeError(f"{self._klass.__name__} has no column or hybrid {name!r}")
+
+    @classmethod
+    def load(
+        cls,
+        conn: sa.Connection,
+        klass: T.Type[Base],
+        attributes: T.Iterable[T.Any],
+        where: T.Optional[sa.ColumnElement] = None,
+    ) -> "ColumnArrays":
+        """
+        只读 attributes 用到的列.
+
+        :param attributes: 之后要计算的列, hybrid_property 或者 hybrid_method 的 SQL
+            表达式, 例如 ``[Interval.radius, Interval.contains(0)]``. 参数的值无所谓,
+            只用来找出表达式中引用了哪些列.
+        """
+        table = klass.__table__
+        columns = dict()
+        for attribute in attributes:
+            expr = getattr(attribute, "expression", attribute)
+            for element in visitors.iterate(expr):
+                if isinstance(element, sa.Column) and element.table is table:
+                    columns.setdefault(element.key, table.c[element.key])
+        return cls(klass, load_arrays(conn, list(columns.values()), where))
+
+
+_BINARY_OPERATORS = {
+    operator.add: np.add,
+    operator.sub: np.subtract,
+    operator.mul: np.multiply,
+    operator.truediv: np.true_divide,
+    operator.floordiv: np.floor_divide,
+    operator.mod: np.mod,
+    operator.lt: np.less,
+    operator.le: np.less_equal,
+    operator.gt: np.greater,
+    operator.ge: np.greater_equal,
+    operator.eq: np.equal,
+    operator.ne: np.not_equal,
+    operator.and_: np.logical_and,
+    operator.or_: np.logical_or,
+}
+
+_FUNCTIONS = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "ln": np.log,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "round": np.round,
+}
+
+
+def compile_numpy(expr: sa.ColumnElement) -> T.Callable[[T.Dict[str, np.ndarray]], np.ndarray]:
+    """
+    把 SQL 表达式树编译成一个接受 {column.key: array} 的 NumPy 函数.
+
+    只支持常见的算术, 比较, 逻辑运算和少数几个函数, 遇到不支持的节点时抛出
+    ``NotImplementedError``.
+    """
+    expr = getattr(expr, "expression", expr)  # hybrid 的 QueryableAttribute
+    if isinstance(expr, (elements.Label, elements.Grouping)):
+        return compile_numpy(expr.element)
+    if isinstance(expr, sa.Column):
+        key = expr.key
+        return lambda arrays: arrays[key]
+    if isinstance(expr, elements.BindParameter):
+        value = expr.effective_value
+        return lambda arrays: value
+    if isinstance(expr, elements.BinaryExpression):
+        op = _BINARY_OPERATORS.get(expr.operator)
+        if op is None:
+            raise NotImplementedError(f"operator {expr.operator} is not supported")
+        left = compile_numpy(expr.left)
+        right = compile_numpy(expr.right)
+        return lambda arrays: op(left(arrays), right(arrays))
+    if isinstance(expr, elements.BooleanClauseList):
+        op = _BINARY_OPERATORS[expr.operator]
+        clauses = [compile_numpy(clause) for clause in expr.clauses]
+        return lambda arrays: functools.reduce(op, [clause(arrays) for clause in clauses])
+    if isinstance(expr, elements.UnaryExpression) and expr.operator is operator.neg:
+        element = compile_numpy(expr.element)
+        return lambda arrays: np.negative(element(arrays))
+    if isinstance(expr, elements.UnaryExpression) and expr.operator is operator.inv:
+        element = compile_numpy(expr.element)
+        return lambda arrays: np.logical_not(element(arrays))
+    if isinstance(expr, functions.FunctionElement):
+        func = _FUNCTIONS.get(expr.name.lower())
+        if func is None:
+            raise NotImplementedError(f"function {expr.name} is not supported")
+        args = [compile_numpy(arg) for arg in expr.clauses]
+        return lambda arrays: func(*[arg(arrays) for arg in args])
+    raise NotImplementedError(f"{expr.__class__.__name__} is not supported")
+
+
+Base.metadata.create_all(engine)
+
+with orm.Session(engine) as ses:
+    ses.add_all([
+        Interval(id=1, start=5, end=10, name="a", weight=1.5),
+        Interval(id=2, start=8, end=1),
+        Interval(id=3, start=0, end=3, name="c", weight=0.5),
+    ])
+    ses.commit()
+
+with engine.connect() as conn:
+    arrays = ColumnArrays.load(conn, Interval, [Interval.radius, Interval.contains(0)])
+    # 只读了 hybrid 用到的列
+    assert sorted(arrays._arrays) == ["end", "start"]
+    assert arrays.length.tolist() == [5, -7, 3]
+    assert arrays.radius.tolist() == [2.5, 3.5, 1.5]
+    assert arrays.contains(8).tolist() == [True, False, False]
+
+    radius = compile_numpy(Interval.radius)
+    assert radius(arrays._arrays).tolist() == [2.5, 3.5, 1.5]
+    contains = compile_numpy(Interval.contains(8))
+    assert contains(arrays._arrays).tolist() == [True, False, False]
+
+    # 只读一部分行
+    arrays = ColumnArrays.load(conn, Interval, [Interval.id], where=Interval.start >= 5)
+    assert arrays.id.tolist() == [1, 2]
+
+    # 字符串列是 object 数组. 可以为 NULL 的数值列是 masked array, 计算时跳过 NULL
+    arrays = ColumnArrays.load(conn, Interval, [Interval.name, Interval.weighted_length])
+    assert arrays.name.tolist() == ["a", None, "c"]
+    assert isinstance(arrays.weight, np.ma.MaskedArray)
+    assert arrays.weight.tolist() == [1.5, None, 0.5]
+    assert arrays.weighted_length.tolist() == [7.5, None, 1.5]
+    assert arrays.weighted_length.mean() == 4.5
+
+with engine.begin() as conn:
+    conn.execute(sa.delete(Interval))
+
+# --- Benchmark
+N_INTERVAL = 1000000
+
+rng = np.random.default_rng(1)
+starts = rng.integers(0, 1000000, size=N_INTERVAL)
+ends = starts + rng.integers(-1000, 1000, size=N_INTERVAL)
+with engine.begin() as conn:
+    conn.execute(
+        sa.insert(Interval.__table__),
+        [
+            dict(id=i, start=start, end=end)
+            for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist()), start=1)
+        ],
+    )
+
+# 统计: 包含 500000 这个点的 interval 中, radius 的平均值
+with orm.Session(engine) as ses:
+    st = time.perf_counter()
+    intervals = ses.scalars(sa.select(Interval)).all()
+    radius = [interval.radius for interval in intervals if interval.contains(500000)]
+    expected = sum(radius) / len(radius)
+    elapsed = time.perf_counter() - st
+    print(f"orm objects: {elapsed:.3f} sec")
+    del intervals
+
+with engine.connect() as conn:
+    st = time.perf_counter()
+    arrays = ColumnArrays.load(conn, Interval, [Interval.radius, Interval.contains(0)])
+    elapsed_load = time.perf_counter() - st
+
+    st = time.perf_counter()
+    result = arrays.radius[arrays.contains(500000)].mean()
+    elapsed = time.perf_counter() - st
+    print(f"numpy by python hybrid: load {elapsed_load:.3f} sec, compute {elapsed * 1000:.1f} ms")
+    assert abs(result - expected) < 1e-9
+
+    radius = compile_numpy(Interval.radius)
+    contains = compile_numpy(Interval.contains(500000))
+    st = time.perf_counter()
+    result = radius(arrays._arrays)[contains(arrays._arrays)].mean()
+    elapsed = time.perf_counter() - st
+    print(f"numpy by sql expression: compute {elapsed * 1000:.1f} ms")
+    assert abs(result - expected) < 1e-9
+
+    # 作为对照, 直接在数据库中计算
+    st = time.perf_counter()
+    result = conn.execute(
+        sa.select(sa.func.avg(Interval.radius)).where(Interval.contains(500000))
+    ).scalar()
+    elapsed = time.perf_counter() - st
+    print(f"sql aggregate: {elapsed * 1000:.1f} ms")
+    assert abs(result - expected) < 1e-9
@@ -33,11 +33,16 @@
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 import sqlalchemy_mate as sam
+from learn_sqlalchemy.base import SqliteWithoutRowidMixin
 
 Base = orm.declarative_base()
 
 
-class ExtendedBase(Base, sam.ExtendedBase):
+class ExtendedBase(Base, sam.ExtendedBase, SqliteWithoutRowidMixin):
+    """
+    纯关联表 (例如 ``asso_channel_and_video``) 在 SQLite 上自动使用 WITHOUT ROWID,
+    ``comment`` 这种有其他列的复合主键表不受影响.
+    """
     __abstract__ = True
 
 
@@ -6,6 +6,7 @@ from sqlalchemy import Integer, String, ForeignKey
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
+from learn_sqlalchemy.base import sqlite_without_rowid
 
 # --- Initiate connection ---
 database = ":memory:"
@@ -165,6 +166,8 @@ class Genre(Base):
         return "Genre(id=%r, name=%r, n_movie=%r)" % (self.id, self.name, len(self.movies))
 
 
+# movie_and_genre 等关联表在 SQLite 上使用 WITHOUT ROWID
+sqlite_without_rowid(Base.metadata)
 Base.metadata.create_all(engine)
 
 # --- unittest ---
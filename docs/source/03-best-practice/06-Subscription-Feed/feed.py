@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+
+"""
+在 Youtube 的例子中, 我们想要显示 "我订阅的用户最近发布的视频". 最直观的写法是
+``User.subscribed_users`` 然后对每个 user 访问 ``.videos``, 这是一个典型的 N + 1
+查询. 即使改写成一个 JOIN, 每次读的时候数据库也要扫描所有我关注的作者的视频, 再排序.
+
+本例实现了一个 Feed 子系统:
+
+1. 推模式 (Fan-out on Write): 作者发布视频时, 把 ``(粉丝, 发布时间, 视频)`` 写入
+    ``feed`` 表. 粉丝很多时分批 (chunk) 用 executemany 插入.
+2. 拉模式 (Fan-out on Read): 粉丝数超过阈值的大 V (celebrity) 发视频时不推送,
+    否则一条视频就要写几百万行. 读 Feed 的时候再把我关注的大 V 的视频拉过来合并.
+3. Feed 的读取使用 keyset pagination (也叫 seek method), 用上一页最后一行的
+    ``(create_at, video_id)`` 作为游标, 而不是 ``OFFSET``. 这样翻到第 1000 页和翻到
+    第 1 页的开销一样.
+
+``feed`` 表的主键是 ``(owner_user_id, create_at, video_id)``, 读 Feed 正好是一次
+主键索引上的范围扫描.
+"""
+
+import typing as T
+import functools
+import random
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy_mate as sam
+
+Base = orm.declarative_base()
+
+
+class ExtendedBase(Base, sam.ExtendedBase):
+    __abstract__ = True
+
+
+class UserAndFollower(ExtendedBase):
+    __tablename__ = "asso_user_and_follower"
+
+    subscriber_user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("user.user_id"),
+        primary_key=True,
+    )
+    publisher_user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("user.user_id"),
+        primary_key=True,
+    )
+
+    # 发布视频时需要根据 publisher 找到所有粉丝, 主键的第一列是 subscriber 用不上
+    __table_args__ = (
+        sa.Index(
+            "ix_asso_user_and_follower_publisher",
+            "publisher_user_id",
+            "subscriber_user_id",
+        ),
+    )
+
+
+class User(ExtendedBase):
+    __tablename__ = "user"
+
+    user_id = sa.Column(sa.Integer, primary_key=True)
+    # 粉丝数超过阈值的用户, 发视频时不推送, 由 refresh_celebrity 维护
+    is_celebrity = sa.Column(sa.Boolean, nullable=False, default=False)
+
+    videos = orm.relationship(
+        "Video",
+        primaryjoin="User.user_id == Video.author_id",
+        back_populates="author",
+    )
+    subscribed_users = orm.relationship(
+        "User",
+        secondary=UserAndFollower.__table__,
+        primaryjoin=user_id == UserAndFollower.subscriber_user_id,
+        secondaryjoin=user_id == UserAndFollower.publisher_user_id,
+        back_populates="followers",
+    )
+    followers = orm.relationship(
+        "User",
+        secondary=UserAndFollower.__table__,
+        primaryjoin=user_id == UserAndFollower.publisher_user_id,
+        secondaryjoin=user_id == UserAndFollower.subscriber_user_id,
+        back_populates="subscribed_users",
+    )
+
+
+class Video(ExtendedBase):
+    __tablename__ = "video"
+
+    video_id = sa.Column(sa.Integer, primary_key=True)
+    author_id = sa.Column(sa.Integer, sa.ForeignKey("user.user_id"), nullable=False)
+    # 发布时间, epoch seconds
+    create_at = sa.Column(sa.Integer, nullable=False)
+
+    author = orm.relationship(
+        "User",
+        foreign_keys=[author_id, ],
+        back_populates="videos",
+    )
+
+    # 拉模式以及 JOIN 查询都需要按作者取最新的视频
+    __table_args__ = (
+        sa.Index("ix_video_author_create_at", "author_id", "create_at", "video_id"),
+    )
+
+
+class Feed(ExtendedBase):
+    __tablename__ = "feed"
+
+    owner_user_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("user.user_id"),
+        primary_key=True,
+    )
+    create_at = sa.Column(sa.Integer, primary_key=True)
+    video_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("video.video_id"),
+        primary_key=True,
+    )
+
+
+CELEBRITY_THRESHOLD = 1000
+CHUNK_SIZE = 5000
+
+# 游标, 也就是上一页最后一行的 (create_at, video_id)
+T_CURSOR = T.Tuple[int, int]
+
+
+def _push_videos(ses: orm.Session, *where, skip_existing: bool = True):
+    """
+    用一条 ``INSERT ... SELECT`` 把满足 ``where`` 的 (视频, 粉丝) 写入 ``feed`` 表, 数据不需要
+    在 Python 中走一遍. ``skip_existing`` 为 True 时跳过已经推送过的行.
+    """
+    select = (
+        sa.select(
+            UserAndFollower.subscriber_user_id,
+            Video.create_at,
+            Video.video_id,
+        )
+        .join(UserAndFollower, UserAndFollower.publisher_user_id == Video.author_id)
+        .where(*where)
+    )
+    if skip_existing:
+        select = select.where(
+            ~sa.exists().where(
+                Feed.owner_user_id == UserAndFollower.subscriber_user_id,
+                Feed.create_at == Video.create_at,
+                Feed.video_id == Video.video_id,
+            )
+        )
+    stmt = sa.insert(Feed.__table__).from_select(
+        ["owner_user_id", "create_at", "video_id"],
+        select,
+    )
+    ses.execute(stmt)
+
+
+def refresh_celebrity(
+    ses: orm.Session,
+    threshold: int = CELEBRITY_THRESHOLD,
+) -> T.List[int]:
+    """
+    根据粉丝数重新计算 ``User.is_celebrity``. 可以放在定时任务里跑.
+
+    - 变成大 V 的用户: 之前发布的视频已经推送到了粉丝的 Feed 中, 之后的视频走拉模式,
+        所以 :func:`read_feed` 在合并两部分结果时需要去重.
+    - 不再是大 V 的用户: 拉模式不再返回他的视频, 所以要把他的视频补推到粉丝的 Feed 中
+        (已经推送过的跳过), 否则做大 V 期间发布的视频会从 Feed 中消失.
+
+    :return: 不再是大 V 的用户的 id.
+    """
+    n_follower = (
+        sa.select(sa.func.count(UserAndFollower.subscriber_user_id))
+        .where(UserAndFollower.publisher_user_id == User.user_id)
+        .scalar_subquery()
+    )
+    demoted = ses.scalars(
+        sa.select(User.user_id).where(User.is_celebrity.is_(True), n_follower < threshold)
+    ).all()
+    stmt = (
+        sa.update(User)
+        .values(is_celebrity=n_follower >= threshold)
+        .execution_options(synchronize_session=False)
+    )
+    ses.execute(stmt)
+    if demoted:
+        _push_videos(ses, Video.author_id.in_(demoted))
+    return demoted
+
+
+def follow(ses: orm.Session, subscriber_user_id: int, publisher_user_id: int):
+    """
+    关注. 非大 V 的视频走推模式, 要把他已经发布的视频补推到我的 Feed 中; 大 V 的视频
+    读的时候会拉过来.
+    """
+    ses.execute(
+        sa.insert(UserAndFollower.__table__),
+        dict(subscriber_user_id=subscriber_user_id, publisher_user_id=publisher_user_id),
+    )
+    is_celebrity = ses.execute(
+        sa.select(User.is_celebrity).where(User.user_id == publisher_user_id)
+    ).scalar_one()
+    if not is_celebrity:
+        _push_videos(
+            ses,
+            Video.author_id == publisher_user_id,
+            UserAndFollower.subscriber_user_id == subscriber_user_id,
+        )
+
+
+def unfollow(ses: orm.Session, subscriber_user_id: int, publisher_user_id: int):
+    """
+    取消关注, 并删除我的 Feed 中他的视频 (包括他成为大 V 之前推送的).
+    """
+    ses.execute(
+        sa.delete(UserAndFollower.__table__).where(
+            UserAndFollower.subscriber_user_id == subscriber_user_id,
+            UserAndFollower.publisher_user_id == publisher_user_id,
+        )
+    )
+    ses.execute(
+        sa.delete(Feed.__table__).where(
+            Feed.owner_user_id == subscriber_user_id,
+            Feed.video_id.in_(
+                sa.select(Video.video_id).where(Video.author_id == publisher_user_id)
+            ),
+        )
+    )
+
+
+def publish_video(
+    ses: orm.Session,
+    video: Video,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """
+    发布一个视频, 并把它推送到所有粉丝的 Feed 中. 如果作者是大 V 则不推送.
+
+    :return: 写入 ``feed`` 表的行数.
+    """
+    ses.add(video)
+    ses.flush()
+    is_celebrity = ses.execute(
+        sa.select(User.is_celebrity).where(User.user_id == video.author_id)
+    ).scalar_one()
+    if is_celebrity:
+        return 0
+
+    # 非大 V 的粉丝数小于阈值, 可以放心的一次性取回内存
+    stmt = sa.select(UserAndFollower.subscriber_user_id).where(
+        UserAndFollower.publisher_user_id == video.author_id
+    )
+    follower_ids = ses.scalars(stmt).all()
+    # 直接用 Core 的 insert 做 executemany, 不经过 ORM 的 unit of work
+    insert = sa.insert(Feed.__table__)
+    for i in range(0, len(follower_ids), chunk_size):
+        ses.execute(
+            insert,
+            [
+                dict(
+                    owner_user_id=user_id,
+                    create_at=video.create_at,
+                    video_id=video.video_id,
+                )
+                for user_id in follower_ids[i:i + chunk_size]
+            ],
+        )
+    return len(follower_ids)
+
+
+def backfill_feed(ses: orm.Session):
+    """
+    为所有非大 V 的历史视频重建 Feed. 适用于第一次上线 Feed 功能, 或是 ``feed`` 表被
+    清空之后的情况, 所以不检查已经存在的行.
+    """
+    _push_videos(
+        ses,
+        Video.author_id.in_(sa.select(User.user_id).where(User.is_celebrity.is_(False))),
+        skip_existing=False,
+    )
+
+
+def _paginate(
+    stmt: sa.Select,
+    create_at: sa.Column,
+    video_id: sa.Column,
+    limit: int,
+    has_cursor: bool,
+) -> sa.Select:
+    if has_cursor:
+        stmt = stmt.where(
+            sa.tuple_(create_at, video_id)
+            < sa.tuple_(sa.bindparam("cursor_create_at"), sa.bindparam("cursor_video_id"))
+        )
+    return stmt.order_by(create_at.desc(), video_id.desc()).limit(limit)
+
+
+def _bind(user_id: int, cursor: T.Optional[T_CURSOR]) -> dict:
+    params = dict(user_id=user_id)
+    if cursor is not None:
+        params["cursor_create_at"], params["cursor_video_id"] = cursor
+    return params
+
+
+# 读 Feed 是最热的路径, 语句用 bindparam 只构造一次, 原因见 index.rst 的 Benchmark
+@functools.lru_cache(maxsize=None)
+def _read_feed_stmt(limit: int, has_cursor: bool) -> sa.CompoundSelect:
+    # 推模式的部分, 只访问 feed 表的主键索引
+    stmt_push = _paginate(
+        sa.select(Feed.create_at, Feed.video_id).where(
+            Feed.owner_user_id == sa.bindparam("user_id")
+        ),
+        Feed.create_at,
+        Feed.video_id,
+        limit,
+        has_cursor,
+    )
+    # 推模式这一页最后一行的 create_at, 不满一页时为 NULL
+    lower_bound = (
+        stmt_push.with_only_columns(Feed.create_at)
+        .offset(limit - 1)
+        .limit(1)
+        .scalar_subquery()
+    )
+    # 拉模式的部分, 只针对我关注的大 V, 数量很少. 如果推模式已经拿到了一整页, 那么
+    # 比这一页最后一行还要旧的视频不可能出现在这一页中, 所以可以加一个下界, 让数据库只
+    # 在 (author_id, create_at, video_id) 索引上扫描一小段, 而不是把大 V 的所有视频
+    # 都拿出来排序.
+    stmt_pull = _paginate(
+        sa.select(Video.create_at, Video.video_id)
+        .join(UserAndFollower, UserAndFollower.publisher_user_id == Video.author_id)
+        .join(User, User.user_id == Video.author_id)
+        .where(
+            UserAndFollower.subscriber_user_id == sa.bindparam("user_id"),
+            User.is_celebrity.is_(True),
+            Video.create_at >= sa.func.coalesce(lower_bound, 0),
+        ),
+        Video.create_at,
+        Video.video_id,
+        limit,
+        has_cursor,
+    )
+    # 两部分在一次数据库往返中完成, 最多返回 2 * limit 行
+    return sa.union_all(
+        stmt_push.subquery().select(),
+        stmt_pull.subquery().select(),
+    )
+
+
+def read_feed(
+    ses: orm.Session,
+    user_id: int,
+    limit: int = 20,
+    cursor: T.Optional[T_CURSOR] = None,
+) -> T.Tuple[T.List[T_CURSOR], T.Optional[T_CURSOR]]:
+    """
+    读取一页 Feed, 按发布时间倒序.
+
+    :param cursor: 上一页返回的 ``next_cursor``, 第一页为 None.
+
+    :return: ``(rows, next_cursor)``, rows 是 ``(create_at, video_id)`` 的列表.
+        ``next_cursor`` 为 None 表示没有下一页了.
+    """
+    stmt = _read_feed_stmt(limit, cursor is not None)
+    rows_all = sorted(
+        [tuple(row) for row in ses.execute(stmt, _bind(user_id, cursor))],
+        reverse=True,
+    )
+
+    # 在 Python 中合并两部分的结果并去重
+    rows = list()
+    seen = set()
+    for row in rows_all:
+        if row[1] in seen:
+            continue
+        seen.add(row[1])
+        rows.append(row)
+        if len(rows) == limit:
+            break
+
+    next_cursor = rows[-1] if len(rows) == limit else None
+    return rows, next_cursor
+
+
+@functools.lru_cache(maxsize=None)
+def _read_feed_by_join_stmt(limit: int, has_cursor: bool) -> sa.Select:
+    return _paginate(
+        sa.select(Video.create_at, Video.video_id)
+        .join(UserAndFollower, UserAndFollower.publisher_user_id == Video.author_id)
+        .where(UserAndFollower.subscriber_user_id == sa.bindparam("user_id")),
+        Video.create_at,
+        Video.video_id,
+        limit,
+        has_cursor,
+    )
+
+
+def read_feed_by_join(
+    ses: orm.Session,
+    user_id: int,
+    limit: int = 20,
+    cursor: T.Optional[T_CURSOR] = None,
+) -> T.Tuple[T.List[T_CURSOR], T.Optional[T_CURSOR]]:
+    """
+    不使用 feed 表, 直接 JOIN ``asso_user_and_follower`` 和 ``video`` 的实现.
+    作为对照组.
+    """
+    stmt = _read_feed_by_join_stmt(limit, cursor is not None)
+    rows = [tuple(row) for row in ses.execute(stmt, _bind(user_id, cursor))]
+    next_cursor = rows[-1] if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def read_all(func, ses: orm.Session, user_id: int, limit: int) -> T.List[T_CURSOR]:
+    rows = list()
+    cursor = None
+    while True:
+        page, cursor = func(ses, user_id, limit=limit, cursor=cursor)
+        rows.extend(page)
+        if cursor is None:
+            return rows
+
+
+# --- Benchmark
+# 粉丝数服从幂律分布: 少数用户有大量粉丝, 大多数用户只有几个粉丝.
+# 发视频的频率跟粉丝数无关, 每个用户都有一批历史视频.
+N_USER = 1000
+N_FOLLOW_PER_USER = 60
+N_HISTORY_VIDEO = 100000
+N_NEW_VIDEO = 2000
+N_READ = 500
+CELEBRITY_THRESHOLD_FOR_BENCHMARK = 300
+
+random.seed(1)
+
+engine = sam.EngineCreator().create_sqlite()
+Base.metadata.create_all(engine)
+
+with orm.Session(engine) as ses:
+    user_ids = list(range(1, 1 + N_USER))
+    ses.execute(
+        sa.insert(User.__table__),
+        [dict(user_id=user_id, is_celebrity=False) for user_id in user_ids],
+    )
+    weights = [1.0 / rank for rank in range(1, 1 + N_USER)]
+    edges = set()
+    for subscriber_user_id in user_ids:
+        for publisher_user_id in random.choices(user_ids, weights, k=N_FOLLOW_PER_USER):
+            if publisher_user_id != subscriber_user_id:
+                edges.add((subscriber_user_id, publisher_user_id))
+    ses.execute(
+        sa.insert(UserAndFollower.__table__),
+        [
+            dict(subscriber_user_id=s, publisher_user_id=p)
+            for s, p in edges
+        ],
+    )
+    refresh_celebrity(ses, threshold=CELEBRITY_THRESHOLD_FOR_BENCHMARK)
+
+    n_celebrity = ses.scalar(
+        sa.select(sa.func.count()).where(User.is_celebrity.is_(True))
+    )
+    print(f"{N_USER} users, {len(edges)} follows, {n_celebrity} celebrities")
+
+    ses.execute(
+        sa.insert(Video.__table__),
+        [
+            dict(
+                video_id=video_id,
+                author_id=random.choice(user_ids),
+                create_at=1_600_000_000 + video_id,
+            )
+            for video_id in range(1, 1 + N_HISTORY_VIDEO)
+        ],
+    )
+    st = time.perf_counter()
+    backfill_feed(ses)
+    ses.commit()
+    elapsed = time.perf_counter() - st
+    print(f"backfill {N_HISTORY_VIDEO} history videos, elapsed {elapsed:.3f} sec")
+
+    st = time.perf_counter()
+    n_feed = 0
+    for video_id in range(1 + N_HISTORY_VIDEO, 1 + N_HISTORY_VIDEO + N_NEW_VIDEO):
+        video = Video(
+            video_id=video_id,
+            author_id=random.choice(user_ids),
+            create_at=1_600_000_000 + video_id,
+        )
+        n_feed += publish_video(ses, video)
+    ses.commit()
+    elapsed = time.perf_counter() - st
+    print(
+        f"publish {N_NEW_VIDEO} videos, write {n_feed} feed rows, "
+        f"{elapsed / N_NEW_VIDEO * 1000:.3f} ms per video"
+    )
+
+    # 关注, 取消关注, 以及大 V 的变化之后, Feed 仍然和 JOIN 的结果一致
+    for _ in range(200):
+        subscriber_user_id, publisher_user_id = random.sample(user_ids, 2)
+        if (subscriber_user_id, publisher_user_id) in edges:
+            unfollow(ses, subscriber_user_id, publisher_user_id)
+            edges.remove((subscriber_user_id, publisher_user_id))
+        else:
+            follow(ses, subscriber_user_id, publisher_user_id)
+            edges.add((subscriber_user_id, publisher_user_id))
+    demoted = refresh_celebrity(ses, threshold=CELEBRITY_THRESHOLD_FOR_BENCHMARK * 2)
+    assert demoted
+    ses.commit()
+
+with orm.Session(engine) as ses:
+    # 两种实现的结果必须完全一致
+    for user_id in random.sample(user_ids, 20):
+        assert read_all(read_feed, ses, user_id, 50) == read_all(read_feed_by_join, ses, user_id, 50)
+
+    readers = random.sample(user_ids, N_READ)
+    for func in [read_feed_by_join, read_feed]:
+        st = time.perf_counter()
+        for user_id in readers:
+            rows, cursor = func(ses, user_id)
+            # 第二页
+            func(ses, user_id, cursor=cursor)
+        elapsed = time.perf_counter() - st
+        print(f"{func.__name__}: {elapsed / N_READ * 1000:.3f} ms per reader (2 pages)")
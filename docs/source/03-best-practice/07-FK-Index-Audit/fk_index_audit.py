@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+检查 ``MetaData`` 中每一个外键是否有以它开头的索引, 没有的话生成缺少的索引.
+
+- 关联表 (所有主键列都是外键) 的主键是 ``(a, b)`` 时, 从 a 查 b 可以用主键索引, 从 b 查 a
+    就只能全表扫描. 这时生成反向的 ``(b, a)`` 索引, 它同时也是覆盖索引, 不需要回表.
+- 普通表上的外键 (例如 ``video.author_id``) 生成单列索引.
+- 主键, 现有的索引和 unique 约束只要以外键的列开头 (顺序不限) 就认为已经覆盖.
+
+对每个缺少的索引给出两个数字:
+
+- 估算的加速比: 没有索引时要读 N 行, 有索引时大约读 ``log2(N) + N / distinct`` 行.
+    N 和 distinct 来自 ``count(*)`` 和 ``count(DISTINCT fk)``.
+- 实测的加速比: 用随机的外键值执行 ``WHERE fk = ?``, 比较建索引前后的耗时.
+"""
+
+import typing as T
+import io
+import math
+import time
+import random
+import runpy
+import contextlib
+from pathlib import Path
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy_mate as sam
+
+dir_here = Path(__file__).absolute().parent
+
+
+class MissingFkIndex:
+    """
+    一个没有被索引覆盖的外键, 以及建议创建的索引.
+    """
+
+    def __init__(self, constraint: sa.ForeignKeyConstraint):
+        self.constraint = constraint
+        self.table: sa.Table = constraint.table
+        self.columns: T.Tuple[str, ...] = tuple(c.name for c in constraint.columns)
+        # 关联表的反向索引把其余的主键列也加上, 成为覆盖索引
+        pk_columns = tuple(c.name for c in self.table.primary_key.columns)
+        if set(self.columns) < set(pk_columns) and _is_association_table(self.table):
+            self.index_columns = self.columns + tuple(
+                c for c in pk_columns if c not in self.columns
+            )
+        else:
+            self.index_columns = self.columns
+        self.estimated_speedup: T.Optional[float] = None
+        self.measured_speedup: T.Optional[float] = None
+        self._index: T.Optional[sa.Index] = None
+
+    @property
+    def name(self) -> str:
+        return "ix_{}_{}".format(self.table.name, "_".join(self.index_columns))
+
+    def to_index(self) -> sa.Index:
+        """
+        创建 ``sa.Index``, 它会被加到 ``self.table`` 上. 多次调用返回同一个对象.
+        """
+        if self._index is None:
+            self._index = sa.Index(self.name, *[self.table.c[c] for c in self.index_columns])
+        return self._index
+
+    def __repr__(self):
+        return "{}.{} -> {}: ({})".format(
+            self.table.name,
+            ", ".join(self.columns),
+            self.constraint.referred_table.name,
+            ", ".join(self.index_columns),
+        )
+
+
+def _is_association_table(table: sa.Table) -> bool:
+    pk_columns = list(table.primary_key.columns)
+    return len(pk_columns) >= 2 and all(c.foreign_keys for c in pk_columns)
+
+
+def _leading_columns(table: sa.Table) -> T.List[T.Tuple[str, ...]]:
+    result = [tuple(c.name for c in table.primary_key.columns)]
+    result += [tuple(c.name for c in index.columns) for index in table.indexes]
+    result += [
+        tuple(c.name for c in constraint.columns)
+        for constraint in table.constraints
+        if isinstance(constraint, sa.UniqueConstraint)
+    ]
+    return result
+
+
+def audit(metadata: sa.MetaData) -> T.List[MissingFkIndex]:
+    """
+    返回所有没有被索引覆盖的外键.
+    """
+    result = list()
+    for table in metadata.sorted_tables:
+        leading = _leading_columns(table)
+        for constraint in table.foreign_key_constraints:
+            columns = {c.name for c in constraint.columns}
+            if any(set(index[:len(columns)]) == columns for index in leading):
+                continue
+            result.append(MissingFkIndex(constraint))
+    return result
+
+
+def _lookup_stmt(issue: MissingFkIndex) -> sa.Select:
+    return sa.select(issue.table).where(*[
+        issue.table.c[c] == sa.bindparam(c) for c in issue.columns
+    ])
+
+
+def estimate(conn: sa.Connection, issue: MissingFkIndex) -> float:
+    """
+    按照读取的行数估算加速比. 空表上没有区别, 是 1.0.
+    """
+    columns = [issue.table.c[c] for c in issue.columns]
+    n_row = conn.execute(sa.select(sa.func.count()).select_from(issue.table)).scalar()
+    n_distinct = conn.execute(
+        sa.select(sa.func.count()).select_from(sa.select(*columns).distinct().subquery())
+    ).scalar()
+    if not n_row or not n_distinct:
+        issue.estimated_speedup = 1.0
+    else:
+        issue.estimated_speedup = n_row / (math.log2(n_row) + n_row / n_distinct)
+    return issue.estimated_speedup
+
+
+def _sample_keys(conn: sa.Connection, issue: MissingFkIndex, n: int) -> T.List[dict]:
+    columns = [issue.table.c[c] for c in issue.columns]
+    rows = conn.execute(sa.select(*columns).distinct()).all()
+    rows = random.sample(rows, min(n, len(rows)))
+    return [dict(zip(issue.columns, row)) for row in rows]
+
+
+def _lookup(conn: sa.Connection, stmt: sa.Select, keys: T.List[dict]) -> float:
+    st = time.perf_counter()
+    for key in keys:
+        conn.execute(stmt, key).all()
+    return time.perf_counter() - st
+
+
+def measure(conn: sa.Connection, issue: MissingFkIndex, n_lookup: int = 100) -> float:
+    """
+    实际创建索引, 比较创建前后按外键查找的耗时. 索引会留在数据库和 ``MetaData`` 中.
+    """
+    stmt = _lookup_stmt(issue)
+    keys = _sample_keys(conn, issue, n_lookup)
+    before = _lookup(conn, stmt, keys)
+    issue.to_index().create(conn)
+    after = _lookup(conn, stmt, keys)
+    # 空表上没有可以查找的值
+    issue.measured_speedup = before / after if keys and after else 1.0
+    return issue.measured_speedup
+
+
+def populate(
+    engine: sa.Engine,
+    metadata: sa.MetaData,
+    n_row: int,
+    fanout: int = 10,
+    seed: int = 1,
+):
+    """
+    用随机数据填充所有的表. 实体表有 ``n_row`` 行, 关联表有 ``n_row * fanout`` 行.
+    外键随机的指向父表 1 到 ``n_row`` 的主键.
+    """
+    random.seed(seed)
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            n = n_row * fanout if _is_association_table(table) else n_row
+            pk_names = [c.name for c in table.primary_key.columns]
+            rows = dict()
+            for i in range(1, 1 + n):
+                row = dict()
+                for column in table.columns:
+                    if column.primary_key and len(pk_names) == 1:
+                        row[column.name] = i
+                    elif column.foreign_keys:
+                        row[column.name] = random.randint(1, n_row)
+                    elif isinstance(column.type, sa.Integer):
+                        row[column.name] = random.randint(0, 100)
+                    else:
+                        row[column.name] = f"{column.name} {i}"
+                rows[tuple(row[name] for name in pk_names)] = row
+            conn.execute(sa.insert(table), list(rows.values()))
+
+
+def load_schema(filename: str) -> T.Dict[str, T.Any]:
+    """
+    执行 best practice 中的例子, 返回它的全局变量. 例子的输出会被丢弃.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return runpy.run_path(str(dir_here.parent / filename), run_name="schema")
+
+
+def report(name: str, engine: sa.Engine, metadata: sa.MetaData) -> T.List[MissingFkIndex]:
+    """
+    审计, 估算, 实测, 然后打印需要创建的索引.
+
+    注意: :func:`measure` 会在 ``engine`` 上真的创建这些索引, 而且会留下来, 只应该对测试用的
+    数据库 (或者副本) 调用. 只想看缺少哪些索引的话用 :func:`audit`.
+    """
+    issues = audit(metadata)
+    print(f"--- {name}: {len(issues)} foreign keys without index")
+    with engine.begin() as conn:
+        for issue in issues:
+            estimate(conn, issue)
+            measure(conn, issue)
+            print(
+                f"{issue!r:<60} "
+                f"estimated {issue.estimated_speedup:>7.1f}x, "
+                f"measured {issue.measured_speedup:>7.1f}x"
+            )
+    for issue in issues:
+        print(str(sa.schema.CreateIndex(issue.to_index()).compile(engine)).strip())
+    # 加上索引之后就没有问题了
+    assert audit(metadata) == []
+    return issues
+
+
+N_ROW = 20000
+
+# --- Youtube
+youtube = load_schema("04-relationship-youtube-example.py")
+User = youtube["User"]
+engine = sam.EngineCreator().create_sqlite()
+youtube["Base"].metadata.create_all(engine)
+populate(engine, youtube["Base"].metadata, N_ROW)
+
+
+def load_followers() -> T.Tuple[float, int]:
+    with orm.Session(engine) as ses:
+        users = ses.scalars(sa.select(User).where(User.user_id <= 200)).all()
+        st = time.perf_counter()
+        n_follower = sum(len(user.followers) for user in users)
+        return time.perf_counter() - st, n_follower
+
+
+elapsed, n_follower = load_followers()
+print(f"User.followers without index: {elapsed:.3f} sec, {n_follower} followers")
+
+issues = report("youtube", engine, youtube["Base"].metadata)
+assert {issue.name for issue in issues} >= {
+    "ix_asso_user_and_follower_publisher_user_id_subscriber_user_id",
+    "ix_asso_channel_and_follower_channel_id_subscriber_user_id",
+    "ix_asso_channel_and_video_video_id_channel_id",
+    "ix_asso_user_and_video_vote_video_id_user_id",
+    "ix_video_author_id",
+}
+
+# User.followers 的 lazy load 现在走 (publisher_user_id, subscriber_user_id) 索引
+elapsed, n_follower = load_followers()
+print(f"User.followers with index: {elapsed:.3f} sec, {n_follower} followers")
+
+# --- IMDB
+imdb = load_schema("05-relationship-imdb-example.py")
+engine = sam.EngineCreator().create_sqlite()
+imdb["Base"].metadata.create_all(engine)
+populate(engine, imdb["Base"].metadata, N_ROW)
+issues = report("imdb", engine, imdb["Base"].metadata)
+assert {issue.name for issue in issues} == {
+    "ix_movie_and_genre_genre_id_movie_id",
+    "ix_person_and_role_role_id_person_id",
+    "ix_movie_and_director_director_id_movie_id",
+    "ix_movie_and_writer_writer_id_movie_id",
+    "ix_movie_and_star_star_id_movie_id",
+    "ix_movie_maker_id",
+}
+
+# 空的数据库上估算和实测的加速比都是 1.0
+imdb = load_schema("05-relationship-imdb-example.py")
+engine = sam.EngineCreator().create_sqlite()
+imdb["Base"].metadata.create_all(engine)
+issues = report("imdb, empty", engine, imdb["Base"].metadata)
+assert [issue.estimated_speedup for issue in issues] == [1.0] * 6
+assert [issue.measured_speedup for issue in issues] == [1.0] * 6
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+"""
+跨 Session 的二级 identity cache.
+
+- :class:`IdentityCache`: 以 identity key 为 key, 保存一个对象的所有已加载的列属性的值
+    (detached state, 不是对象本身) 的副本, 以及对象实际的 mapper. LRU, 有容量上限和 TTL.
+- :func:`enable`: 对一个 mapper (以及它的继承体系中的所有子类) 打开缓存, 没有打开的 mapper 不受影响.
+- :class:`CachingSession`: ``Session.get`` 先查当前 Session 的 identity map, 再查二级缓存,
+    命中时用缓存的值构造一个新的对象加入 Session, 不访问数据库. 没有命中时查数据库并写入缓存.
+- Session 事件: ``after_flush`` 记录被修改和删除的对象的 identity key, ``after_commit``
+    时从缓存中删除; ``ses.execute(sa.update(...))`` 这种不知道主键的批量修改在 commit 时
+    清空整个 mapper 的缓存. rollback 时什么都不做.
+"""
+
+import typing as T
+import io
+import copy
+import time
+import random
+import runpy
+import threading
+import contextlib
+from collections import OrderedDict
+from pathlib import Path
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+
+dir_here = Path(__file__).absolute().parent
+
+_CLEAR = object()
+_WRITTEN = "identity_cache_written"
+
+
+class IdentityCache:
+    """
+    :param maxsize: 最多缓存多少个对象, 超过时删除最久没有被访问的.
+    :param ttl: 缓存的秒数. 从数据库读出之后的 ``ttl`` 秒内, 其他进程的修改可能看不到.
+    :param clock: 返回当前时间 (秒) 的函数.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10000,
+        ttl: float = 60.0,
+        clock: T.Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data: T.OrderedDict[tuple, T.Tuple[float, T.Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple) -> T.Optional[T.Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expire_at, values = item
+            if expire_at <= self.clock():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return values
+
+    def put(self, key: tuple, values: T.Any):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl, values)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+
+_caches: T.Dict[orm.Mapper, IdentityCache] = dict()
+
+
+def enable(model: T.Type, **kwargs) -> IdentityCache:
+    """
+    对 ``model`` 打开二级缓存, ``kwargs`` 传给 :class:`IdentityCache`. 同一个继承体系中的
+    所有 mapper 的 identity key 相同, 所以共用 base mapper 的缓存.
+    """
+    mapper = sa.inspect(model).base_mapper
+    _caches[mapper] = IdentityCache(**kwargs)
+    return _caches[mapper]
+
+
+def _snapshot(state: orm.InstanceState) -> T.Tuple[orm.Mapper, dict]:
+    # 只保存列属性. 没有加载的 deferred 列不保存, 恢复之后访问时再加载.
+    # JSON 这种可变的值要复制一份, 否则原地修改 (即使之后回滚了) 会改变缓存中的值
+    return state.mapper, {
+        attr.key: copy.deepcopy(state.dict[attr.key])
+        for attr in state.mapper.column_attrs
+        if attr.key in state.dict
+    }
+
+
+def _restore(mapper: orm.Mapper, values: dict):
+    # mapper 是缓存的对象的实际的类 (多态加载时可能是子类)
+    obj = mapper.class_manager.new_instance()
+    for key, value in values.items():
+        orm.attributes.set_committed_value(obj, key, copy.deepcopy(value))
+    # 有了 identity key, 成为 detached 状态, 没有的属性被标记为 expired
+    orm.make_transient_to_detached(obj)
+    return obj
+
+
+def _identity_key(mapper: orm.Mapper, ident) -> tuple:
+    if isinstance(ident, dict):
+        ident = [
+            ident[mapper.get_property_by_column(column).key]
+            for column in mapper.primary_key
+        ]
+    elif not isinstance(ident, (tuple, list)):
+        ident = [ident]
+    return mapper.identity_key_from_primary_key(list(ident))
+
+
+class CachingSession(orm.Session):
+    """
+    ``get`` 会使用二级缓存的 Session. 带有 ``options``, ``populate_existing``,
+    ``with_for_update`` 等参数的 ``get`` 直接查数据库.
+    """
+
+    def get(self, entity, ident, **kwargs):
+        mapper = sa.inspect(entity)
+        cache = _caches.get(mapper.base_mapper)
+        if cache is None or any(kwargs.values()):
+            return super(CachingSession, self).get(entity, ident, **kwargs)
+        key = _identity_key(mapper, ident)
+        # 当前 Session 中已经有了, 或者当前事务修改过它, 都不使用缓存
+        written = self.info.get(_WRITTEN, ())
+        if (
+            key in self.identity_map
+            or (mapper.base_mapper, key) in written
+            or (mapper.base_mapper, _CLEAR) in written
+        ):
+            return super(CachingSession, self).get(entity, ident, **kwargs)
+        item = cache.get(key)
+        # ses.get(SubA, 1) 而缓存的是 SubB 时, 交给数据库处理
+        if item is not None and item[0].isa(mapper):
+            obj = _restore(*item)
+            self.add(obj)
+            return obj
+        obj = super(CachingSession, self).get(entity, ident, **kwargs)
+        if obj is not None:
+            cache.put(key, _snapshot(sa.inspect(obj)))
+        return obj
+
+
+def _record(session: orm.Session, item):
+    session.info.setdefault(_WRITTEN, set()).add(item)
+
+
+@event.listens_for(orm.Session, "after_flush")
+def _after_flush(session: orm.Session, flush_context):
+    if not _caches:
+        return
+    # after_flush 时 dirty / deleted 仍然是 flush 之前的状态
+    for obj in list(session.dirty) + list(session.deleted):
+        state = sa.inspect(obj)
+        if state.mapper.base_mapper in _caches and state.key is not None:
+            _record(session, (state.mapper.base_mapper, state.key))
+
+
+@event.listens_for(orm.Session, "do_orm_execute")
+def _do_orm_execute(orm_execute_state: orm.ORMExecuteState):
+    if not _caches:
+        return
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        for mapper in orm_execute_state.all_mappers:
+            if mapper.base_mapper in _caches:
+                _record(orm_execute_state.session, (mapper.base_mapper, _CLEAR))
+
+
+@event.listens_for(orm.Session, "after_commit")
+def _after_commit(session: orm.Session):
+    for mapper, key in session.info.pop(_WRITTEN, ()):
+        if key is _CLEAR:
+            _caches[mapper].clear()
+        else:
+            _caches[mapper].invalidate(key)
+
+
+@event.listens_for(orm.Session, "after_rollback")
+def _after_rollback(session: orm.Session):
+    session.info.pop(_WRITTEN, None)
+
+
+def load_schema(filename: str) -> T.Dict[str, T.Any]:
+    """
+    执行 best practice 中的例子, 返回它的全局变量. 例子的输出会被丢弃.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return runpy.run_path(str(dir_here.parent / filename), run_name="schema")
+
+
+# --- LRU 和 TTL
+now = [0.0]
+cache = IdentityCache(maxsize=2, ttl=10, clock=lambda: now[0])
+cache.put(("a",), dict(v=1))
+cache.put(("b",), dict(v=2))
+assert cache.get(("a",)) == dict(v=1)
+cache.put(("c",), dict(v=3))  # b 最久没有被访问, 被删除
+assert cache.get(("b",)) is None and len(cache) == 2
+now[0] = 10
+assert cache.get(("a",)) is None  # 过期
+
+# --- Youtube
+youtube = load_schema("04-relationship-youtube-example.py")
+User, Video, UserAndVideoVote = youtube["User"], youtube["Video"], youtube["UserAndVideoVote"]
+engine = sa.create_engine("sqlite://", poolclass=sa.pool.StaticPool)
+# 点赞数的子查询按 video_id 查关联表, 先补上 07-FK-Index-Audit 指出的缺少的索引
+sa.Index("ix_asso_user_and_video_vote_video_id_user_id", UserAndVideoVote.video_id, UserAndVideoVote.user_id)
+youtube["Base"].metadata.create_all(engine)
+
+N_USER = 1000
+N_VIDEO = 20000
+N_VOTE = 200000
+N_REQUEST = 5000
+N_GET_PER_REQUEST = 10
+WRITE_RATIO = 0.01
+
+random.seed(1)
+with engine.begin() as conn:
+    conn.execute(sa.insert(User), [dict(user_id=i) for i in range(1, 1 + N_USER)])
+    conn.execute(sa.insert(Video), [
+        dict(video_id=i, author_id=random.randint(1, N_USER)) for i in range(1, 1 + N_VIDEO)
+    ])
+    votes = {
+        (random.randint(1, N_USER), random.randint(1, N_VIDEO)): random.randint(0, 1)
+        for _ in range(N_VOTE)
+    }
+    conn.execute(sa.insert(UserAndVideoVote), [
+        dict(user_id=user_id, video_id=video_id, vote=vote)
+        for (user_id, video_id), vote in votes.items()
+    ])
+
+# 热门的视频被读得多, 第 n 热门的视频的访问概率和 1 / n 成正比
+video_ids = list(range(1, 1 + N_VIDEO))
+weights = [1 / rank for rank in range(1, 1 + N_VIDEO)]
+requests = [
+    (
+        random.choices(video_ids, weights, k=N_GET_PER_REQUEST),
+        random.random() < WRITE_RATIO,
+    )
+    for _ in range(N_REQUEST)
+]
+
+n_statement = [0]
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    n_statement[0] += 1
+
+
+def run_workload(session_class: T.Type[orm.Session]) -> T.List[int]:
+    """
+    每个请求一个新的 Session, 读 10 个视频的作者和点赞数, 1% 的请求修改第一个视频的作者.
+    """
+    n_statement[0] = 0
+    result = list()
+    st = time.perf_counter()
+    for video_ids, is_write in requests:
+        with session_class(engine) as ses:
+            for video_id in video_ids:
+                video = ses.get(Video, video_id)
+                result.append((video.author_id, video.thumb_up_count))
+            if is_write:
+                video = ses.get(Video, video_ids[0])
+                video.author_id = video.author_id % N_USER + 1
+                ses.commit()
+    elapsed = time.perf_counter() - st
+    n_get = N_REQUEST * N_GET_PER_REQUEST
+    print(
+        f"{session_class.__name__}: {elapsed:.3f} sec, "
+        f"{elapsed / n_get * 1000000:.1f} us per get, "
+        f"{n_statement[0]} SQL statements"
+    )
+    return result
+
+
+expected = run_workload(orm.Session)
+
+# run_workload 修改了数据, 重新开始之前把作者改回去
+with engine.begin() as conn:
+    for video_ids, is_write in reversed(requests):
+        if is_write:
+            conn.execute(
+                sa.update(Video)
+                .where(Video.video_id == video_ids[0])
+                .values(author_id=(Video.author_id + N_USER - 2) % N_USER + 1)
+            )
+
+video_cache = enable(Video, maxsize=5000, ttl=60)
+actual = run_workload(CachingSession)
+print(
+    f"hit rate: {video_cache.hit_rate:.1%}, "
+    f"size: {len(video_cache)}, "
+    f"evictions: {video_cache.evictions}, "
+    f"invalidations: {video_cache.invalidations}"
+)
+# 修改之后的读取看到的都是新的值
+assert actual == expected
+
+# 没有提交的修改不会影响缓存, 用 UPDATE 语句修改之后整个 mapper 的缓存被清空
+with CachingSession(engine) as ses:
+    video = ses.get(Video, 1)
+    author_id = video.author_id
+    video.author_id = author_id % N_USER + 1
+    ses.flush()
+    ses.rollback()
+with CachingSession(engine) as ses:
+    assert ses.get(Video, 1).author_id == author_id
+    ses.execute(sa.update(Video).where(Video.video_id == 1).values(author_id=author_id % N_USER + 1))
+    ses.commit()
+assert len(video_cache) == 0
+with CachingSession(engine) as ses:
+    assert ses.get(Video, 1).author_id == author_id % N_USER + 1
+
+# --- 多态和可变的值
+Base2 = orm.declarative_base()
+
+
+class Media(Base2):
+    __tablename__ = "media"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    kind = sa.Column(sa.String)
+    meta = sa.Column(sa.JSON)
+
+    __mapper_args__ = dict(polymorphic_on=kind, polymorphic_identity="media")
+
+
+class Clip(Media):
+    __tablename__ = "clip"
+
+    id = sa.Column(sa.ForeignKey("media.id"), primary_key=True)
+    seconds = sa.Column(sa.Integer)
+
+    __mapper_args__ = dict(polymorphic_identity="clip")
+
+
+engine2 = sa.create_engine("sqlite://", poolclass=sa.pool.StaticPool)
+Base2.metadata.create_all(engine2)
+media_cache = enable(Media)
+with orm.Session(engine2) as ses:
+    ses.add(Clip(id=1, meta=dict(x=1), seconds=10))
+    ses.commit()
+
+with CachingSession(engine2) as ses:
+    ses.get(Media, 1)
+# 缓存的是子类, 通过基类和子类 get 都得到子类的对象
+with CachingSession(engine2) as ses:
+    hits = media_cache.hits
+    clip = ses.get(Media, 1)
+    assert type(clip) is Clip and ses.get(Clip, 1) is clip
+    assert media_cache.hits == hits + 1
+    # 原地修改 JSON 之后回滚, 缓存中的值不变
+    clip.meta["x"] = 99
+    ses.rollback()
+with CachingSession(engine2) as ses:
+    assert ses.get(Media, 1).meta == dict(x=1)
+
+# 子类的修改也会让缓存失效; 当前事务 flush 过的对象, 即使已经不在 identity map 中也不读缓存
+with CachingSession(engine2) as ses:
+    ses.get(Clip, 1).meta = dict(x=2)
+    ses.flush()
+    ses.expunge_all()
+    assert ses.get(Clip, 1).meta == dict(x=2)
+    ses.commit()
+with CachingSession(engine2) as ses:
+    assert ses.get(Clip, 1).meta == dict(x=2)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+例子中共用的 declarative base 选项.
+
+SQLite 的普通表是一个以 rowid 为 key 的 B-tree, 复合主键还会再建一个 ``sqlite_autoindex``
+索引. 纯关联表 (所有列都是主键, 而且都是外键) 的数据因此被存了两次. ``WITHOUT ROWID``
+的表直接以主键为 key 组织 B-tree, 只存一份.
+
+用法::
+
+    Base = orm.declarative_base()
+
+    class ExtendedBase(Base, sam.ExtendedBase, SqliteWithoutRowidMixin):
+        __abstract__ = True
+
+Core 中定义的 ``sa.Table`` 用 :func:`sqlite_without_rowid` 处理.
+"""
+
+import typing as T
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+import sqlalchemy.event as event
+
+
+def is_association_table(table: sa.Table) -> bool:
+    """
+    复合主键, 每个主键列都是外键, 而且没有主键以外的列.
+    """
+    pk_columns = table.primary_key.columns
+    return (
+        len(pk_columns) >= 2
+        and len(pk_columns) == len(table.columns)
+        and all(column.foreign_keys for column in pk_columns)
+    )
+
+
+def set_sqlite_without_rowid(table: sa.Table, flag: T.Optional[bool] = None):
+    """
+    :param flag: ``None`` 时只有关联表使用 WITHOUT ROWID, ``True`` / ``False`` 强制打开 / 关闭.
+    """
+    if flag is None:
+        flag = is_association_table(table)
+    table.dialect_options["sqlite"]["with_rowid"] = not flag
+
+
+def sqlite_without_rowid(metadata: sa.MetaData):
+    """
+    MetaData 中所有的关联表在 SQLite 上使用 WITHOUT ROWID, 其他方言会忽略这个选项.
+    """
+    for table in metadata.tables.values():
+        if is_association_table(table):
+            set_sqlite_without_rowid(table, True)
+
+
+class SqliteWithoutRowidMixin:
+    """
+    在 declarative base 上加一个类属性 ``__sqlite_without_rowid__``:
+
+    - ``None`` (默认): 关联表自动使用 WITHOUT ROWID. 有其他列的复合主键表,
+        例如 ``comment (video_id, nth_comment, ...)``, 不受影响.
+    - ``True`` / ``False``: 强制打开 / 关闭.
+
+    WITHOUT ROWID 适合行比较小 (小于 page 大小的 1/20) 的表, 而且不能有 AUTOINCREMENT.
+    """
+
+    __sqlite_without_rowid__: T.Optional[bool] = None
+
+
+@event.listens_for(SqliteWithoutRowidMixin, "after_mapper_constructed", propagate=True)
+def _set_sqlite_with_rowid(mapper: orm.Mapper, class_: T.Type[SqliteWithoutRowidMixin]):
+    table = mapper.local_table
+    # 单表继承的子类和父类共用一张表, 由父类决定
+    if mapper.inherits is not None and mapper.inherits.local_table is table:
+        return
+    if not isinstance(table, sa.Table):  # pragma: no cover
+        return
+    set_sqlite_without_rowid(table, class_.__sqlite_without_rowid__)
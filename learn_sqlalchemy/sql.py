@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+"""
+例子中共用的 SQL 表达式工具.
+"""
+
+import typing as T
+
+import sqlalchemy as sa
+from sqlalchemy.sql import visitors, elements
+
+
+def inline_literals(
+    expr: sa.ColumnElement,
+    types: T.Optional[T.Tuple[T.Type[sa.types.TypeEngine], ...]] = None,
+) -> sa.ColumnElement:
+    """
+    把表达式中的绑定参数改成执行时渲染为字面值 (``literal_execute``).
+
+    表达式索引的 DDL 中只能是字面值, 查询中的同一个常量如果是绑定参数 ``?``, 数据库就认为
+    它和索引不是同一个表达式, 用不上索引.
+
+    :param types: 只替换这些类型的绑定参数, 默认全部替换.
+    """
+
+    def replace(element):
+        if (
+            isinstance(element, elements.BindParameter)
+            and not element.literal_execute
+            and (types is None or isinstance(element.type, types))
+        ):
+            return sa.bindparam(
+                element.key, element.effective_value, type_=element.type,
+                literal_execute=True, unique=True,
+            )
+        return None
+
+    return visitors.replacement_traverse(expr, {}, replace)